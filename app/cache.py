@@ -0,0 +1,94 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable, Optional, Tuple
+
+
+class TTLCache:
+    """
+    A bounded, thread safe LRU whose entries expire `ttl` seconds after they were loaded.
+    Meant to sit in front of lookups by id, with every write to a row invalidating its key.
+    """
+
+    def __init__(self, max_entries: int = 4096, ttl: float = 60.0, clock: Callable[[], float] = time.monotonic):
+        self.max_entries = max(1, max_entries)
+        self.ttl = ttl
+        self._clock = clock
+        self._lock = threading.Lock()
+        # Key -> (expires at, value), least recently used first
+        self._entries: "OrderedDict[Hashable, Tuple[float, Any]]" = OrderedDict()
+        # Bumped by every invalidation, a load that overlapped one may have read the old row and isn't kept
+        self._generation = 0
+        self._hits = 0
+        self._misses = 0
+        self._expired = 0
+        self._evictions = 0
+        self._invalidations = 0
+
+    def get_or_load(self, key: Hashable, load: Callable[[Hashable], Any]) -> Any:
+        """The cached value for `key`, otherwise what `load(key)` returns. None is never cached."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                expires_at, value = entry
+                if expires_at > self._clock():
+                    self._entries.move_to_end(key)
+                    self._hits += 1
+                    return value
+                del self._entries[key]
+                self._expired += 1
+            self._misses += 1
+            generation = self._generation
+
+        value = load(key)
+        if value is None:
+            return None
+
+        with self._lock:
+            if generation == self._generation:
+                self._store(key, value)
+        return value
+
+    def _store(self, key: Hashable, value: Any):
+        self._entries[key] = (self._clock() + self.ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self._evictions += 1
+
+    def put(self, key: Hashable, value: Any):
+        """Keep `value` for `key`, for values that were worked out without going through get_or_load."""
+        with self._lock:
+            self._store(key, value)
+
+    def invalidate(self, key: Hashable):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._generation += 1
+            self._invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._generation += 1
+            self._invalidations += 1
+
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            lookups = self._hits + self._misses
+            return {
+                "entries": len(self._entries),
+                "hits": self._hits,
+                "misses": self._misses,
+                "hit_rate": self._hits / lookups if lookups else 0.0,
+                "expired": self._expired,
+                "evictions": self._evictions,
+                "invalidations": self._invalidations,
+            }
+
+
+def cached_lookup(cache: Optional[TTLCache], key: Hashable, load: Callable[[Hashable], Any]) -> Any:
+    """`load(key)` through `cache`, or straight from `load` when caching is off."""
+    if cache is None:
+        return load(key)
+    return cache.get_or_load(key, load)
@@ -0,0 +1,60 @@
+import logging
+import sqlite3
+import threading
+from datetime import datetime, timedelta, timezone
+from typing import Optional
+
+from db.chat_data_controller import ChatDataController
+from db.types.exceptions.db_error import DBError
+
+logger = logging.getLogger(__name__)
+
+
+class ChatArchiver:
+    """
+    Background thread that moves chat messages older than `archive_after` out of the live table every
+    `interval` seconds, `batch_size` at a time so the writer is never held for long.
+    """
+
+    def __init__(self, chat_controller: ChatDataController, archive_after: timedelta, interval: float = 3600.0,
+                 batch_size: int = 1000):
+        self.chat_controller = chat_controller
+        self.archive_after = archive_after
+        self.interval = interval
+        self.batch_size = max(1, batch_size)
+        self._stopped = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="chat-archiver", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def run_once(self) -> int:
+        """Archive everything that is old enough now and return how many messages were moved."""
+        # Timestamps are stored in UTC, without a timezone
+        older_than = datetime.now(timezone.utc).replace(tzinfo=None) - self.archive_after
+        archived = 0
+        while not self._stopped.is_set():
+            moved = self.chat_controller.archive_chat_messages(older_than, self.batch_size)
+            archived += moved
+            if moved < self.batch_size:
+                break
+        self.chat_controller.purge_archived_conversations()
+        return archived
+
+    def _run(self):
+        # The first run also finishes a move that was interrupted by a restart
+        while not self._stopped.is_set():
+            try:
+                archived = self.run_once()
+                if archived:
+                    logger.info("Archived %d chat messages", archived)
+            except (sqlite3.Error, DBError):
+                logger.exception("Could not archive chat messages")
+            self._stopped.wait(self.interval)
@@ -0,0 +1,101 @@
+import logging
+import sqlite3
+import threading
+from typing import Callable, List, Optional
+
+from db.image_data_controller import ImageDataController
+from db.types.classification_job import ClassificationJob
+from db.types.exceptions.db_error import DBError
+
+logger = logging.getLogger(__name__)
+
+
+class ClassificationWorkerPool:
+    """
+    Background threads that drain the image controller's classification job queue.
+    `on_classified(user_id, image_id, classified_as)` is called after each job finishes,
+    with classified_as set to None if the job failed for good. A failed job is retried after `backoff`
+    seconds, doubling with each further attempt up to `max_backoff`.
+    """
+
+    def __init__(self, image_controller: ImageDataController, workers: int = 2, poll_interval: float = 1.0,
+                 max_attempts: int = 3, backoff: float = 1.0, max_backoff: float = 60.0,
+                 on_classified: Optional[Callable[[int, int, Optional[str]], None]] = None):
+        self.image_controller = image_controller
+        self.workers = max(1, workers)
+        self.poll_interval = poll_interval
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.on_classified = on_classified
+        self._wake = threading.Event()
+        self._stopped = threading.Event()
+        self._threads: List[threading.Thread] = []
+
+    def start(self):
+        # Anything still marked running was interrupted by a restart
+        self.image_controller.reset_running_classification_jobs()
+        self.image_controller.on_classification_queued = self.wake
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._run, name=f"classification-worker-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def wake(self):
+        self._wake.set()
+
+    def stop(self):
+        self._stopped.set()
+        self._wake.set()
+        for thread in self._threads:
+            thread.join()
+        self._threads.clear()
+        self.image_controller.on_classification_queued = None
+
+    def _run(self):
+        while not self._stopped.is_set():
+            try:
+                job = self.image_controller.claim_classification_job()
+            except (sqlite3.Error, DBError):
+                logger.exception("Could not claim a classification job")
+                job = None
+
+            if job is None:
+                self._wake.wait(self.poll_interval)
+                self._wake.clear()
+                continue
+
+            self._process(job)
+
+    def _finish(self, job: ClassificationJob, status: str, error: Optional[str] = None, retry_in: float = 0.0):
+        # Left running the job would never be claimed again, so keep trying while e.g. the database is locked
+        while True:
+            try:
+                self.image_controller.finish_classification_job(job.job_id, status, error, retry_in=retry_in)
+                return
+            except Exception:
+                logger.exception("Could not record classification job %s as %s", job.job_id, status)
+            if self._stopped.wait(self.poll_interval):
+                return  # Still running, the next start puts it back in the queue
+
+    def _backoff_delay(self, attempts: int) -> float:
+        return min(self.max_backoff, self.backoff * 2 ** (attempts - 1))
+
+    def _process(self, job: ClassificationJob):
+        try:
+            classified_as = self.image_controller.classify_image(job.image_id)
+        except Exception as e:
+            logger.exception("Classification of image %s failed", job.image_id)
+            if job.attempts < self.max_attempts:
+                self._finish(job, "pending", str(e), retry_in=self._backoff_delay(job.attempts))
+                return
+            self._finish(job, "failed", str(e))
+            classified_as = None
+        else:
+            self._finish(job, "done")
+
+        if self.on_classified is not None:
+            try:
+                self.on_classified(job.user_id, job.image_id, classified_as)
+            except Exception:
+                logger.exception("Could not deliver classification of image %s", job.image_id)
@@ -1,21 +1,36 @@
 import threading
+from datetime import timedelta
+from functools import partial
 from pathlib import Path
-from typing import Callable, Tuple, Dict
+from typing import Callable, Tuple, Dict, List, Optional
 
 from flask import Flask
 
+from app.cache import TTLCache
+from app.chat_archiver import ChatArchiver
+from app.classification_workers import ClassificationWorkerPool
+from chatbots.batching_chatbot import BatchingChatBot
+from chatbots.caching_chatbot import CachingChatBot
+from chatbots.chatbot_controller import ChatBotController
 from chatbots.huggingface.flan_t5_chatbot import FlanT5ChatBot
-from classifiers.resnet import ResNetClassifier
+from classifiers.batching_classifier import BatchingClassifier
+from classifiers.image_classifier import ImageClassifier
+from classifiers.process_pool_classifier import ProcessPoolClassifier
+from classifiers.resnet import ResNetClassifier, transform_resnet_image, resnet_model_id
 from db.chat_data_controller import ChatDataController
 from db.image_data_controller import ImageDataController
 from db.sqlite.chat.sqlite3_chat_controller import SQLite3ChatController
 from db.sqlite.image.sqlite3_image_controller import SQLite3ImageController
 from db.sqlite.sqlite_db_adaptor import SQLiteDBAdaptor
 from db.sqlite.user.sqlite3_user_controller import SQLite3UserController
+from db.storage.content_addressed_image_storage import ContentAddressedImageStorage
+from db.storage.flat_image_storage import FlatImageStorage
+from db.storage.image_storage import ImageStorage
+from db.storage.image_variant_cache import ImageVariantCache
 from db.user_data_controller import UserDataController
 
 
-def _chatbot_not_ready(json: Dict[str, str]) -> Tuple[Dict[str, str], int, int]:
+def _chatbot_not_ready(json: Dict[str, str], on_chunk=None) -> Tuple[Dict[str, str], int, int]:
     return {
         "error": "Chatbot is not ready yet!"
     }, -1, -1
@@ -28,7 +43,25 @@ class DataResourceManager:
     _chat_data_controller = None
     _image_data_controller = None
     _socket = None
-    _lock = threading.Lock()
+    _session_store = None
+    _classification_workers = None
+    _chat_archiver = None
+    _chatbot_cache = None
+    # Read-through caches by name, see _create_cache
+    _caches: Dict[str, TTLCache] = {}
+    _adaptor_lock = threading.Lock()
+    _controller_locks = {
+        'user': threading.Lock(),
+        'chat': threading.Lock(),
+        'image': threading.Lock(),
+    }
+    _state_lock = threading.Lock()
+    _states = {
+        'database': "not_started",
+        'user': "not_started",
+        'chat': "not_started",
+        'image': "not_started",
+    }
 
     _chat_callback = _chatbot_not_ready
 
@@ -45,22 +78,58 @@ class DataResourceManager:
         return DataResourceManager._get_data_controller(flask_app, 'image')
 
     @staticmethod
-    def change_chat_callback(function: Callable[[Dict[str, str]], Tuple[Dict[str, str], int, int]]):
+    def change_chat_callback(function: Callable[..., Tuple[Dict[str, str], int, int]]):
         DataResourceManager._chat_callback = function
 
     @staticmethod
-    def get_chat_callback(json: Dict[str, str]) -> Tuple[Dict[str, str], int, int]:
-        return DataResourceManager._chat_callback(json)
+    def get_chat_callback(json: Dict[str, str],
+                          on_chunk: Optional[Callable[[str], None]] = None) -> Tuple[Dict[str, str], int, int]:
+        if on_chunk is None:
+            return DataResourceManager._chat_callback(json)
+        return DataResourceManager._chat_callback(json, on_chunk)
+
+    @staticmethod
+    def set_socket(socket):
+        DataResourceManager._socket = socket
+
+    @staticmethod
+    def set_session_store(session_store):
+        DataResourceManager._session_store = session_store
+
+    @staticmethod
+    def _push_classification(user_id: int, image_id: int, classified_as: Optional[str]):
+        if DataResourceManager._socket is not None:
+            DataResourceManager._socket.emit('image_classified', {
+                "image_id": image_id,
+                "classified_as": classified_as,
+                "status": "done" if classified_as is not None else "failed"
+            }, to=str(user_id), namespace='/chat')
+
+    @staticmethod
+    def stop_background_tasks():
+        """Stop the archiver, sweepers and classification workers, letting whatever they are doing finish."""
+        for attribute in ('_chat_archiver', '_chatbot_cache', '_classification_workers', '_session_store'):
+            task = getattr(DataResourceManager, attribute)
+            if task is not None:
+                setattr(DataResourceManager, attribute, None)
+                task.stop()
 
     @staticmethod
     def shutdown(testing=False):
-        with DataResourceManager._lock:
-            if DataResourceManager._user_data_controller:
-                DataResourceManager._user_data_controller.shutdown_controller(testing)
-            if DataResourceManager._chat_data_controller:
-                DataResourceManager._chat_data_controller.shutdown_controller(testing)
-            if DataResourceManager._image_data_controller:
-                DataResourceManager._image_data_controller.shutdown_controller(testing)
+        # Runs after every request, so it must not wait on a controller that is still being built
+        for controller_type in ('user', 'chat', 'image'):
+            controller = getattr(DataResourceManager, f"_{controller_type}_data_controller")
+            if controller:
+                controller.shutdown_controller(testing)
+
+    @staticmethod
+    def _get_db_adaptor(app: Flask):
+        if DataResourceManager._db_adaptor is None:
+            with DataResourceManager._adaptor_lock:
+                if DataResourceManager._db_adaptor is None:
+                    DataResourceManager._set_db_adaptor(app)
+                    DataResourceManager._set_state('database', "ready")
+        return DataResourceManager._db_adaptor
 
     @staticmethod
     def _set_db_adaptor(app: Flask):
@@ -69,8 +138,17 @@ class DataResourceManager:
             active_db = db["ACTIVE"]
             if active_db == "sqlite":
                 db_config = db["SQLITE"]
+                pool_config = db_config.get("POOL", {})
+                write_queue_config = db_config.get("WRITE_QUEUE", {})
+                archive_config = db_config.get("ARCHIVE", {})
                 DataResourceManager._db_adaptor = SQLiteDBAdaptor(
                     db_filename=db_config["DB_FILENAME"],
+                    pool_size=pool_config.get("SIZE", 8) if pool_config.get("ENABLED", False) else 0,
+                    pool_timeout=pool_config.get("TIMEOUT", 5.0),
+                    pragmas=db_config.get("PRAGMAS"),
+                    write_queue=write_queue_config if write_queue_config.get("ENABLED", False) else None,
+                    attached={"archive": archive_config.get("DB_FILENAME", "jjdmdata_archive.db")}
+                    if archive_config.get("ENABLED", False) else None,
                     user_table_name=db["USERS_TABLE_NAME"],
                     chat_table_name=db["CHAT_TABLE_NAME"],
                     image_table_name=db["IMAGES_TABLE_NAME"]
@@ -78,28 +156,263 @@ class DataResourceManager:
             else:
                 raise ValueError(f"Unsupported database adaptor: {active_db}")
 
+    @staticmethod
+    def _create_classifier(app: Flask) -> ImageClassifier:
+        recognition_config = app.config["MODULES"]["IMAGE_RECOGNITION"]
+        classes_path = Path(app.root_path) / "imagenet_classes.txt"
+        resnet_config = recognition_config["RESNET"]
+        image_resize = resnet_config.get("IMAGE_RESIZE", 256)
+        engine = resnet_config.get("ENGINE") or {}
+        pool_config = recognition_config.get("PROCESS_POOL", {})
+        parallel_batches = 1
+        if pool_config.get("ENABLED", False):
+            # The model is only loaded inside the worker processes
+            parallel_batches = pool_config.get("WORKERS", 2)
+            classifier = ProcessPoolClassifier(
+                worker_factory=partial(ResNetClassifier, class_file=classes_path, image_resize=image_resize, engine=engine),
+                transform_image=partial(transform_resnet_image, image_resize=image_resize),
+                model_id=resnet_model_id(engine),
+                workers=parallel_batches,
+                threads_per_worker=pool_config.get("THREADS_PER_WORKER", 0),
+                queue_size=pool_config.get("QUEUE_SIZE", 16),
+                queue_timeout=pool_config.get("QUEUE_TIMEOUT", 5.0),
+                request_timeout=pool_config.get("REQUEST_TIMEOUT", 60.0),
+                health_check_interval=pool_config.get("HEALTH_CHECK_INTERVAL", 1.0),
+                restart_backoff=pool_config.get("RESTART_BACKOFF_SECONDS", 1.0),
+                max_restart_backoff=pool_config.get("MAX_RESTART_BACKOFF_SECONDS", 60.0),
+                max_failed_starts=pool_config.get("MAX_FAILED_STARTS", 5),
+                # Reported by /health/ready once the workers can't be brought back
+                on_failed=partial(DataResourceManager._set_state, 'image', "failed")
+            )
+        else:
+            classifier = ResNetClassifier(class_file=classes_path, image_resize=image_resize, engine=engine)
+        batching_config = recognition_config.get("BATCHING", {})
+        if batching_config.get("ENABLED", False):
+            classifier = BatchingClassifier(
+                classifier,
+                max_batch_size=batching_config.get("MAX_BATCH_SIZE", 8),
+                max_wait_ms=batching_config.get("MAX_WAIT_MS", 10),
+                max_in_flight=parallel_batches
+            )
+        return classifier
+
+    @staticmethod
+    def _create_cache(app: Flask, name: str) -> Optional[TTLCache]:
+        cache_config = app.config["DATABASE"].get("CACHE", {})
+        if not cache_config.get("ENABLED", False):
+            return None
+        cache = TTLCache(max_entries=cache_config.get("MAX_ENTRIES", 4096), ttl=cache_config.get("TTL_SECONDS", 60))
+        DataResourceManager._caches[name] = cache
+        return cache
+
+    @staticmethod
+    def get_metrics() -> Dict[str, Dict[str, float]]:
+        """Counters of the database, caches and classifier that are running, nothing is started for them."""
+        metrics = {}
+        if DataResourceManager._db_adaptor is not None:
+            metrics["database"] = DataResourceManager._db_adaptor.stats()
+        if DataResourceManager._session_store is not None:
+            metrics["sessions"] = DataResourceManager._session_store.stats()
+        for name, cache in DataResourceManager._caches.items():
+            metrics[f"{name}_cache"] = cache.stats()
+        chat_controller = DataResourceManager._chat_data_controller
+        if chat_controller is not None and chat_controller.chatbot_controller is not None:
+            metrics["chatbot"] = chat_controller.chatbot_controller.stats()
+        image_controller = DataResourceManager._image_data_controller
+        if image_controller is not None:
+            metrics["classification_cache"] = image_controller.get_classification_cache_stats()
+            if image_controller.variant_cache is not None:
+                metrics["image_variants"] = image_controller.variant_cache.stats()
+        return metrics
+
+    @staticmethod
+    def _create_user_controller(app: Flask) -> UserDataController:
+        user_controller = SQLite3UserController(DataResourceManager._get_db_adaptor(app),
+                                                cache=DataResourceManager._create_cache(app, "user"))
+        user_controller.on_images_deleted = DataResourceManager._forget_images
+        user_controller.init_controller()
+        return user_controller
+
+    @staticmethod
+    def _forget_images(image_ids: List[int]):
+        # Without an image controller yet there is no image cache that could hold them
+        if DataResourceManager._image_data_controller is not None:
+            DataResourceManager._image_data_controller.forget_images(image_ids)
+
+    @staticmethod
+    def _create_chatbot(app: Flask) -> ChatBotController:
+        chatbot_config = app.config["MODULES"]["CHATBOT"]
+        flan_t5 = FlanT5ChatBot(app)
+        chatbot = flan_t5
+        batching_config = chatbot_config.get("BATCHING", {})
+        if batching_config.get("ENABLED", False):
+            chatbot = BatchingChatBot(
+                chatbot,
+                max_batch_size=batching_config.get("MAX_BATCH_SIZE", 8),
+                max_wait_ms=batching_config.get("MAX_WAIT_MS", 5),
+                max_in_flight=batching_config.get("MAX_IN_FLIGHT", 4)
+            )
+        cache_config = chatbot_config.get("CACHE", {})
+        if not cache_config.get("ENABLED", False):
+            return chatbot
+        # In front of the batching, answers from the cache never wait for a batch to fill
+        persist = cache_config.get("PERSIST", False)
+        caching_chatbot = CachingChatBot(
+            chatbot,
+            model_id=flan_t5.api_url,
+            max_entries=cache_config.get("MAX_ENTRIES", 10_000),
+            ttl=cache_config.get("TTL_SECONDS", 86_400),
+            adaptor=DataResourceManager._get_db_adaptor(app) if persist else None,
+            sweep_interval=cache_config.get("SWEEP_INTERVAL_MINUTES", 10) * 60
+        )
+        if persist:
+            caching_chatbot.start_sweeper()
+            DataResourceManager._chatbot_cache = caching_chatbot
+        return caching_chatbot
+
+    @staticmethod
+    def _create_chat_controller(app: Flask) -> ChatDataController:
+        # The chatbot's user row lives in the user table
+        DataResourceManager._get_data_controller(app, 'user')
+        chatbot = DataResourceManager._create_chatbot(app)
+        archive_config = app.config["DATABASE"]["SQLITE"].get("ARCHIVE", {})
+        archive_enabled = archive_config.get("ENABLED", False)
+        chat_controller = SQLite3ChatController(DataResourceManager._get_db_adaptor(app), chatbot,
+                                                archive_schema="archive" if archive_enabled else None)
+        chat_controller.init_controller()
+        if archive_enabled:
+            archiver = ChatArchiver(
+                chat_controller,
+                archive_after=timedelta(days=archive_config.get("AFTER_DAYS", 180)),
+                interval=archive_config.get("INTERVAL_MINUTES", 60) * 60,
+                batch_size=archive_config.get("BATCH_SIZE", 1000)
+            )
+            archiver.start()
+            DataResourceManager._chat_archiver = archiver
+        return chat_controller
+
+    @staticmethod
+    def create_image_storage(app: Flask) -> ImageStorage:
+        upload_config = app.config["MODULES"]["IMAGE_UPLOAD"]
+        image_upload_directory = Path(app.root_path) / Path(upload_config["UPLOAD_DIRECTORY"])
+        storage_type = upload_config.get("STORAGE", "flat")
+        if storage_type == "content_addressed":
+            return ContentAddressedImageStorage(image_upload_directory)
+        elif storage_type == "flat":
+            return FlatImageStorage(image_upload_directory)
+        raise ValueError(f"Unsupported image storage: {storage_type}")
+
+    @staticmethod
+    def _create_variant_cache(app: Flask, storage: ImageStorage) -> Optional[ImageVariantCache]:
+        variants_config = app.config["MODULES"]["IMAGE_UPLOAD"].get("VARIANTS", {})
+        if not variants_config.get("ENABLED", False):
+            return None
+        # Kept inside the upload directory so a sendfile offload can reach them the same way
+        return ImageVariantCache(
+            storage.root / variants_config.get("DIRECTORY", "variants"),
+            max_bytes=variants_config.get("MAX_CACHE_MB", 256) * 1024 * 1024,
+            sizes=variants_config.get("SIZES", [128, 256, 512, 1024]),
+            quality=variants_config.get("QUALITY", 80)
+        )
+
+    @staticmethod
+    def _create_image_controller(app: Flask) -> ImageDataController:
+        upload_config = app.config["MODULES"]["IMAGE_UPLOAD"]
+        storage = DataResourceManager.create_image_storage(app)
+        classifier = DataResourceManager._create_classifier(app)
+        image_controller = SQLite3ImageController(
+            DataResourceManager._get_db_adaptor(app), storage.root, classifier,
+            max_pixels=upload_config.get("MAX_PIXELS", 40_000_000),
+            max_dimension=upload_config.get("MAX_DIMENSION", 12_000),
+            storage=storage,
+            variant_cache=DataResourceManager._create_variant_cache(app, storage),
+            cache=DataResourceManager._create_cache(app, "image")
+        )
+        image_controller.init_controller()
+        async_config = app.config["MODULES"]["IMAGE_RECOGNITION"].get("ASYNC", {})
+        if async_config.get("ENABLED", False):
+            workers = ClassificationWorkerPool(
+                image_controller,
+                workers=async_config.get("WORKERS", 2),
+                poll_interval=async_config.get("POLL_INTERVAL", 1.0),
+                max_attempts=async_config.get("MAX_ATTEMPTS", 3),
+                backoff=async_config.get("BACKOFF_SECONDS", 1.0),
+                max_backoff=async_config.get("MAX_BACKOFF_SECONDS", 60.0),
+                on_classified=DataResourceManager._push_classification
+            )
+            workers.start()
+            DataResourceManager._classification_workers = workers
+        return image_controller
+
     @staticmethod
     def _get_data_controller(app: Flask, controller_type: str):
-        with DataResourceManager._lock:
-            if DataResourceManager._db_adaptor is None:
-                DataResourceManager._set_db_adaptor(app)
-            if controller_type == 'user' and DataResourceManager._user_data_controller is None:
-                user_controller = SQLite3UserController(DataResourceManager._db_adaptor)
-                user_controller.init_controller()
-                DataResourceManager._user_data_controller = user_controller
-            elif controller_type == 'chat' and DataResourceManager._chat_data_controller is None:
-                chatbot = FlanT5ChatBot(app)
-                chat_controller = SQLite3ChatController(DataResourceManager._db_adaptor, chatbot)
-                chat_controller.init_controller()
-                DataResourceManager._chat_data_controller = chat_controller
-            elif controller_type == 'image' and DataResourceManager._image_data_controller is None:
-                image_upload_directory = Path(app.root_path) / Path(app.config["MODULES"]["IMAGE_UPLOAD"]["UPLOAD_DIRECTORY"])
-                classes_path = Path(app.root_path) / "imagenet_classes.txt"
-                image_controller = SQLite3ImageController(DataResourceManager._db_adaptor, image_upload_directory, ResNetClassifier(class_file=classes_path))
-                image_controller.init_controller()
-                DataResourceManager._image_data_controller = image_controller
-            return {
-                'user': DataResourceManager._user_data_controller,
-                'chat': DataResourceManager._chat_data_controller,
-                'image': DataResourceManager._image_data_controller
-            }[controller_type]
+        attribute = f"_{controller_type}_data_controller"
+        controller = getattr(DataResourceManager, attribute)
+        if controller is not None:
+            return controller
+
+        # Each controller has its own lock, so a slow model load only holds up image requests
+        with DataResourceManager._controller_locks[controller_type]:
+            controller = getattr(DataResourceManager, attribute)
+            if controller is None:
+                warming = DataResourceManager.get_states()[controller_type] == "warming"
+                if not warming:
+                    DataResourceManager._set_state(controller_type, "loading")
+                try:
+                    controller = DataResourceManager._controller_factories[controller_type](app)
+                except Exception:
+                    DataResourceManager._set_state(controller_type, "failed")
+                    raise
+                setattr(DataResourceManager, attribute, controller)
+                if not warming:
+                    DataResourceManager._set_state(controller_type, "ready")
+            return controller
+
+    @staticmethod
+    def _warm_up(app: Flask):
+        for controller_type in ('user', 'chat'):
+            try:
+                DataResourceManager._get_data_controller(app, controller_type)
+            except Exception:
+                app.logger.exception("Failed to initialise the %s controller", controller_type)
+
+        # Mark the image subsystem as warming before it exists, so it isn't reported ready after the model loads
+        DataResourceManager._set_state('image', "warming")
+        try:
+            image_controller = DataResourceManager._get_data_controller(app, 'image')
+            image_controller.image_classifier.warm_up()
+        except Exception:
+            DataResourceManager._set_state('image', "failed")
+            app.logger.exception("Failed to warm up the image classifier")
+        else:
+            DataResourceManager._set_state('image', "ready")
+
+    @staticmethod
+    def start_warm_up(app: Flask) -> threading.Thread:
+        """
+        Initialise every controller and run a throwaway classification in the background,
+        see get_states for progress.
+        """
+        thread = threading.Thread(target=DataResourceManager._warm_up, args=(app,), name="warm-up", daemon=True)
+        thread.start()
+        return thread
+
+    @staticmethod
+    def _set_state(subsystem: str, state: str):
+        with DataResourceManager._state_lock:
+            DataResourceManager._states[subsystem] = state
+
+    @staticmethod
+    def get_states() -> Dict[str, str]:
+        """
+        State of each subsystem: not_started, loading, warming, ready or failed.
+        """
+        with DataResourceManager._state_lock:
+            return dict(DataResourceManager._states)
+
+
+DataResourceManager._controller_factories = {
+    'user': DataResourceManager._create_user_controller,
+    'chat': DataResourceManager._create_chat_controller,
+    'image': DataResourceManager._create_image_controller,
+}
@@ -0,0 +1,8 @@
+# Raised when a backing service (classifier workers, chatbot upstream...) can't take the request right now
+class ServiceUnavailable(Exception):
+
+    def __init__(self, message):
+        self.message = message
+
+    def __str__(self):
+        return f"Service unavailable: {self.message}"
@@ -0,0 +1,117 @@
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from queue import Queue, Empty
+from typing import Callable, Generic, List, TypeVar, Dict
+
+T = TypeVar("T")
+R = TypeVar("R")
+
+
+class MicroBatcher(Generic[T, R]):
+    """
+    Collects items submitted from many threads and hands them to `handler` as one list.
+    A batch is flushed once `max_batch_size` items are waiting, or `max_wait` seconds after
+    the first item of the batch arrived, whichever comes first. Up to `max_in_flight` batches
+    are handled at once, while they are all busy new items keep filling the next batch.
+    """
+
+    def __init__(self, handler: Callable[[List[T]], List[R]], max_batch_size: int = 8, max_wait: float = 0.01,
+                 name: str = "micro-batcher", max_in_flight: int = 1):
+        self.handler = handler
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait = max(0.0, max_wait)
+        self._in_flight = threading.BoundedSemaphore(max(1, max_in_flight))
+        self._executor = ThreadPoolExecutor(max_in_flight, thread_name_prefix=name) if max_in_flight > 1 else None
+        self._queue: Queue = Queue()
+        self._stopped = threading.Event()
+        self._stats_lock = threading.Lock()
+        self._batches = 0
+        self._items = 0
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self._thread.start()
+
+    def submit(self, item: T) -> Future:
+        """Queue an item, the returned future resolves to the handler's result for it."""
+        if self._stopped.is_set():
+            raise RuntimeError("Micro-batcher has been stopped")
+        future = Future()
+        self._queue.put((item, future))
+        return future
+
+    def stop(self):
+        self._stopped.set()
+        self._queue.put(None)  # Wake the worker up if it is waiting on an empty queue
+        self._thread.join()
+        if self._executor is not None:
+            self._executor.shutdown()
+
+    def stats(self) -> Dict[str, float]:
+        with self._stats_lock:
+            return {
+                "batches": self._batches,
+                "items": self._items,
+                "mean_batch_size": self._items / self._batches if self._batches else 0.0,
+            }
+
+    def _collect(self) -> list:
+        first = self._queue.get()
+        if first is None:
+            return []
+        batch = [first]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                entry = self._queue.get(timeout=remaining)
+            except Empty:
+                break
+            if entry is None:
+                break
+            batch.append(entry)
+        return batch
+
+    def _dispatch(self, batch: list):
+        try:
+            self._handle(batch)
+        finally:
+            self._in_flight.release()
+
+    def _handle(self, batch: list):
+        items = [item for item, _ in batch]
+        futures = [future for _, future in batch]
+        with self._stats_lock:
+            self._batches += 1
+            self._items += len(items)
+        try:
+            results = self.handler(items)
+            if len(results) != len(items):
+                raise RuntimeError(f"Batch handler returned {len(results)} results for {len(items)} items")
+        except Exception as e:
+            for future in futures:
+                future.set_exception(e)
+            return
+        for future, result in zip(futures, results):
+            future.set_result(result)
+
+    def _run(self):
+        while not self._stopped.is_set():
+            self._in_flight.acquire()
+            batch = self._collect()
+            if not batch:
+                self._in_flight.release()
+            elif self._executor is not None:
+                self._executor.submit(self._dispatch, batch)
+            else:
+                self._dispatch(batch)
+
+        # Anything still queued after stopping will never be run
+        while True:
+            try:
+                entry = self._queue.get_nowait()
+            except Empty:
+                break
+            if entry is not None:
+                entry[1].set_exception(RuntimeError("Micro-batcher has been stopped"))
@@ -0,0 +1,228 @@
+import logging
+import os
+import pickle
+import secrets
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Dict, Optional, Tuple
+
+from cachelib import BaseCache
+
+from db.sqlite.sqlite_db_adaptor import SQLiteDBAdaptor
+
+logger = logging.getLogger(__name__)
+
+# A session's expiry is only written again once it has moved by this share of its lifetime, so the
+# refresh Flask-Session does on every request doesn't turn every request into a database write
+EXPIRY_REFRESH_FRACTION = 0.1
+# cachelib's timeout of 0 means the entry never expires
+NEVER = float(2 ** 53)
+
+
+class SQLiteSessionCache(BaseCache):
+    """
+    Session store for Flask-Session's cachelib backend. Sessions live in an SQLite table with an index on
+    their expiry, the most recently used `memory_entries` are also kept in memory so most requests never
+    read the database. Expired rows are deleted by a background sweeper rather than while handling requests.
+
+    The memory tier belongs to one process, with several server processes set `memory_entries` to 0.
+    """
+
+    def __init__(self, db_filename: str, memory_entries: int = 10_000, default_timeout: int = 300,
+                 sweep_interval: float = 600.0, table_name: str = "sessions"):
+        super().__init__(default_timeout)
+        self.adaptor = SQLiteDBAdaptor(db_filename=db_filename, pool_size=4)
+        self.table_name = table_name
+        self.memory_entries = max(0, memory_entries)
+        self.sweep_interval = sweep_interval
+        self._lock = threading.Lock()
+        # Key -> (expires at, value) as persisted, least recently used first
+        self._memory: "OrderedDict[str, Tuple[float, Any]]" = OrderedDict()
+        self._stopped = threading.Event()
+        self._sweeper: Optional[threading.Thread] = None
+        self._hits = 0
+        self._misses = 0
+        self._writes = 0
+        self._skipped_writes = 0
+        self._swept = 0
+        self._create_table()
+
+    def _create_table(self):
+        with self.adaptor.get_write_connection() as conn:
+            conn.execute(f'''
+                CREATE TABLE IF NOT EXISTS {self.table_name} (
+                    session_key TEXT PRIMARY KEY,
+                    session_value BLOB NOT NULL,
+                    expires_at REAL NOT NULL
+                ) WITHOUT ROWID
+            ''')
+            conn.execute(f'CREATE INDEX IF NOT EXISTS {self.table_name}_expires_at ON {self.table_name} (expires_at)')
+            conn.commit()
+
+    def start_sweeper(self):
+        self._sweeper = threading.Thread(target=self._run_sweeper, name="session-sweeper", daemon=True)
+        self._sweeper.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._sweeper is not None:
+            self._sweeper.join()
+            self._sweeper = None
+        self.adaptor.close()
+
+    def _expires_at(self, timeout: Optional[int]) -> float:
+        timeout = self._normalize_timeout(timeout)
+        return time.time() + timeout if timeout else NEVER
+
+    def _remember(self, key: str, expires_at: float, value: Any):
+        if not self.memory_entries:
+            return
+        self._memory[key] = (expires_at, value)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_entries:
+            self._memory.popitem(last=False)
+
+    def _load(self, key: str) -> Optional[Tuple[float, Any]]:
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                if entry[0] > time.time():
+                    self._memory.move_to_end(key)
+                    self._hits += 1
+                    return entry
+                del self._memory[key]
+            self._misses += 1
+
+        with self.adaptor.get_connection() as conn:
+            row = conn.execute(f'''
+                SELECT session_value, expires_at FROM {self.table_name} WHERE session_key = ? AND expires_at > ?
+            ''', (key, time.time())).fetchone()
+        if row is None:
+            return None
+        entry = (row["expires_at"], pickle.loads(row["session_value"]))
+        with self._lock:
+            self._remember(key, *entry)
+        return entry
+
+    def get(self, key: str) -> Any:
+        entry = self._load(key)
+        return entry[1] if entry is not None else None
+
+    def has(self, key: str) -> bool:
+        return self._load(key) is not None
+
+    def set(self, key: str, value: Any, timeout: Optional[int] = None) -> bool:
+        expires_at = self._expires_at(timeout)
+        lifetime = expires_at - time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None and entry[1] == value and expires_at - entry[0] < lifetime * EXPIRY_REFRESH_FRACTION:
+                self._memory.move_to_end(key)
+                self._skipped_writes += 1
+                return True
+
+        def upsert(cursor):
+            cursor.execute(f'''
+                INSERT INTO {self.table_name} (session_key, session_value, expires_at) VALUES (?, ?, ?)
+                ON CONFLICT (session_key) DO UPDATE SET
+                    session_value = excluded.session_value, expires_at = excluded.expires_at
+            ''', (key, pickle.dumps(value), expires_at))
+
+        self.adaptor.write(upsert)
+        with self._lock:
+            self._remember(key, expires_at, value)
+            self._writes += 1
+        return True
+
+    def add(self, key: str, value: Any, timeout: Optional[int] = None) -> bool:
+        if self.has(key):
+            return False
+        return self.set(key, value, timeout)
+
+    def delete(self, key: str) -> bool:
+        with self._lock:
+            self._memory.pop(key, None)
+        deleted = self.adaptor.write(lambda cursor: cursor.execute(
+            f'DELETE FROM {self.table_name} WHERE session_key = ?', (key,)).rowcount)
+        return deleted > 0
+
+    def clear(self) -> bool:
+        with self._lock:
+            self._memory.clear()
+        self.adaptor.write(lambda cursor: cursor.execute(f'DELETE FROM {self.table_name}'))
+        return True
+
+    def sweep(self, batch_size: int = 1000) -> int:
+        """Delete every expired session and return how many there were."""
+        now = time.time()
+        with self._lock:
+            for key in [key for key, (expires_at, _) in self._memory.items() if expires_at <= now]:
+                del self._memory[key]
+
+        def delete_batch(cursor):
+            # A range of the expiry index, a batch at a time so logins don't wait on one long delete
+            return cursor.execute(f'''
+                DELETE FROM {self.table_name} WHERE session_key IN (
+                    SELECT session_key FROM {self.table_name} WHERE expires_at <= ? LIMIT ?
+                )
+            ''', (now, batch_size)).rowcount
+
+        swept = 0
+        while True:
+            deleted = self.adaptor.write(delete_batch)
+            swept += deleted
+            if deleted < batch_size:
+                break
+        with self._lock:
+            self._swept += swept
+        return swept
+
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            lookups = self._hits + self._misses
+            return {
+                "memory_entries": len(self._memory),
+                "hits": self._hits,
+                "misses": self._misses,
+                "hit_rate": self._hits / lookups if lookups else 0.0,
+                "writes": self._writes,
+                "skipped_writes": self._skipped_writes,
+                "swept": self._swept,
+            }
+
+    def _run_sweeper(self):
+        while not self._stopped.wait(self.sweep_interval):
+            try:
+                self.sweep()
+            except sqlite3.Error:
+                logger.exception("Could not sweep expired sessions")
+
+
+def load_secret_key(configured: Optional[str], key_file: Path) -> str:
+    """
+    The configured key, otherwise one generated on first start and kept in `key_file`, so sessions
+    survive restarts and deploys.
+    """
+    if configured:
+        return configured
+    try:
+        return key_file.read_text().strip()
+    except FileNotFoundError:
+        pass
+
+    key = secrets.token_hex(32)
+    temp_file = key_file.with_name(f".{key_file.name}-{os.getpid()}")
+    fd = os.open(temp_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, "w") as f:
+        f.write(key)
+    try:
+        # Linking fails if another process got there first, then everyone uses its key
+        os.link(temp_file, key_file)
+    except FileExistsError:
+        key = key_file.read_text().strip()
+    finally:
+        os.remove(temp_file)
+    return key
@@ -0,0 +1,128 @@
+"""
+Compares searching chat history through the full-text index against a LIKE scan of the chat table.
+
+    python -m benchmarks.chat_search --rows 1000000
+    python -m benchmarks.chat_search --rows 200000 --queries 50 --output search.json
+
+Fills a temporary database with `--rows` generated messages spread over a few dozen users, then times
+the same one and two word searches both ways and reports per-query latency.
+"""
+import argparse
+import itertools
+import json
+import random
+import statistics
+import tempfile
+import time
+from pathlib import Path
+from typing import Callable, List
+from unittest import mock
+
+from app.data_resource_manager import DataResourceManager
+from db.sqlite.chat.sqlite3_chat_controller import SQLite3ChatController
+from db.sqlite.sqlite_db_adaptor import SQLiteDBAdaptor
+from db.sqlite.user.sqlite3_user_controller import SQLite3UserController
+from db.types.user.user_container import UserContainer
+
+COMMON_WORDS = ("the a is what of and to in it you this that picture photo image can my me about").split()
+# Word frequencies in text roughly follow Zipf's law, so most words of a search are rare ones
+WORDS = COMMON_WORDS + [f"topic{i}" for i in range(20_000)]
+CUMULATIVE_WEIGHTS = list(itertools.accumulate(1 / rank for rank in range(1, len(WORDS) + 1)))
+
+
+def _percentile(samples: List[float], percentile: float) -> float:
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * percentile))]
+
+
+def _fill(adaptor: SQLiteDBAdaptor, chat_controller: SQLite3ChatController, rows: int, users: int):
+    with adaptor.get_write_connection() as conn:
+        conn.executemany(f'INSERT INTO {adaptor.user_table_name} '
+                         f'(user_username, user_email, user_password, user_type) VALUES (?, ?, ?, ?)',
+                         [(f"user{i}", f"user{i}@example.com", "x", "user") for i in range(users)])
+        conn.commit()
+
+    generator = random.Random(0)
+    batch = []
+    for i in range(rows):
+        user_id = generator.randint(1, users)
+        text = " ".join(generator.choices(WORDS, cum_weights=CUMULATIVE_WEIGHTS, k=generator.randint(4, 16)))
+        # Alternate between the user's messages and the chatbot's answers
+        batch.append((-1, user_id, text, "user") if i % 2 == 0 else (user_id, -1, text, "bot"))
+        if len(batch) == 10_000 or i == rows - 1:
+            with adaptor.get_write_connection() as conn:
+                conn.executemany(f'INSERT INTO {chat_controller.chat_table_name} '
+                                 f'(sender_id, to_id, chat_content, message_type) VALUES (?, ?, ?, ?)', batch)
+                conn.commit()
+            batch = []
+
+
+def _like_search(adaptor: SQLiteDBAdaptor, chat_table_name: str, user: UserContainer, query: str, limit: int):
+    conditions = " AND ".join("chat_content LIKE ?" for _ in query.split())
+    with adaptor.get_connection() as conn:
+        return conn.execute(f'''
+            SELECT * FROM {chat_table_name}
+            WHERE ((sender_id = ? AND to_id = -1) OR (sender_id = -1 AND to_id = ?)) AND {conditions}
+            ORDER BY chat_id DESC LIMIT ?
+        ''', (user.id, user.id, *[f"%{word}%" for word in query.split()], limit)).fetchall()
+
+
+def _time(search: Callable[[UserContainer, str], object], searches) -> dict:
+    latencies = []
+    for user, query in searches:
+        start = time.perf_counter()
+        search(user, query)
+        latencies.append((time.perf_counter() - start) * 1000)
+    return {
+        "mean_ms": statistics.mean(latencies),
+        "p50_ms": _percentile(latencies, 0.5),
+        "p95_ms": _percentile(latencies, 0.95),
+        "max_ms": max(latencies),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=1_000_000, help="Number of chat messages to generate")
+    parser.add_argument("--users", type=int, default=50, help="Number of users the messages are spread over")
+    parser.add_argument("--queries", type=int, default=100, help="Number of searches to time each way")
+    parser.add_argument("--limit", type=int, default=20, help="Results per search")
+    parser.add_argument("--output", help="Also write the report to this JSON file")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        adaptor = SQLiteDBAdaptor(db_filename=str(Path(directory) / "chat_search.db"), user_table_name="users",
+                                  chat_table_name="chat", image_table_name="images")
+        SQLite3UserController(adaptor).init_controller()
+        chat_controller = SQLite3ChatController(adaptor, None)
+        # The chatbot callback isn't needed to search
+        with mock.patch.object(DataResourceManager, "change_chat_callback"):
+            chat_controller.init_controller()
+
+        start = time.perf_counter()
+        _fill(adaptor, chat_controller, args.rows, args.users)
+        fill_seconds = time.perf_counter() - start
+
+        generator = random.Random(1)
+        searches = [(UserContainer(generator.randint(1, args.users)),
+                     " ".join(generator.choices(WORDS[:2_000], k=generator.randint(1, 2)))) for _ in range(args.queries)]
+
+        report = {
+            "rows": args.rows,
+            "users": args.users,
+            "queries": args.queries,
+            "fill_seconds": fill_seconds,
+            "fts": _time(lambda user, query: chat_controller.search_chat_messages(user, query, args.limit), searches),
+            "like": _time(lambda user, query: _like_search(adaptor, chat_controller.chat_table_name, user, query,
+                                                           args.limit), searches),
+        }
+        adaptor.close()
+
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
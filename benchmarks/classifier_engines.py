@@ -0,0 +1,121 @@
+"""
+Compares the configured ResNet inference engine against the plain eager model.
+
+    python -m benchmarks.classifier_engines --images path/to/images
+    python -m benchmarks.classifier_engines --synthetic 32 --mode script --quantize
+
+Engine options default to MODULES.IMAGE_RECOGNITION.RESNET.ENGINE in config.json, any flag
+given on the command line overrides them. The report covers per-image latency, batched
+throughput and how often both engines agree on the top-1 label.
+"""
+import argparse
+import json
+import statistics
+import time
+from pathlib import Path
+from typing import List
+
+import torch
+
+from classifiers.resnet import ResNetClassifier
+
+ROOT = Path(__file__).resolve().parent.parent
+
+
+def _load_inputs(classifier: ResNetClassifier, args) -> List[torch.Tensor]:
+    if args.images:
+        paths = sorted(p for p in Path(args.images).iterdir() if p.suffix.lower() in (".jpg", ".jpeg", ".png"))
+        if not paths:
+            raise SystemExit(f"No jpeg or png images found in {args.images}")
+        return [classifier.transform_image(p) for p in paths]
+    generator = torch.Generator().manual_seed(0)
+    return [torch.randn(1, 3, 224, 224, generator=generator) for _ in range(args.synthetic)]
+
+
+def _percentile(samples: List[float], percentile: float) -> float:
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * percentile))]
+
+
+def _measure(classifier: ResNetClassifier, inputs: List[torch.Tensor], batch_size: int, warmup: int):
+    for tensor in inputs[:warmup]:
+        classifier.predict_batch([tensor])
+
+    latencies = []
+    labels = []
+    for tensor in inputs:
+        start = time.perf_counter()
+        labels.extend(prediction.label for prediction in classifier.predict_batch([tensor]))
+        latencies.append((time.perf_counter() - start) * 1000)
+
+    start = time.perf_counter()
+    for i in range(0, len(inputs), batch_size):
+        classifier.predict_batch(inputs[i:i + batch_size])
+    throughput = len(inputs) / (time.perf_counter() - start)
+
+    return labels, {
+        "mean_ms": statistics.mean(latencies),
+        "p50_ms": _percentile(latencies, 0.50),
+        "p99_ms": _percentile(latencies, 0.99),
+        "batched_images_per_second": throughput,
+    }
+
+
+def main():
+    with open(ROOT / "config.json") as f:
+        resnet_config = json.load(f)["MODULES"]["IMAGE_RECOGNITION"]["RESNET"]
+    engine = dict(resnet_config.get("ENGINE", {}))
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--images", help="Directory of jpeg/png images to classify")
+    parser.add_argument("--synthetic", type=int, default=32, help="Random inputs to use when --images is not given")
+    parser.add_argument("--batch-size", type=int, default=8)
+    parser.add_argument("--warmup", type=int, default=3)
+    parser.add_argument("--mode", choices=["eager", "trace", "script"])
+    parser.add_argument("--quantize", action="store_true", default=None)
+    parser.add_argument("--channels-last", action="store_true", default=None)
+    parser.add_argument("--threads", type=int, help="Intra-op thread count")
+    parser.add_argument("--output", help="Also write the report as json to this file")
+    args = parser.parse_args()
+
+    for key, value in (("MODE", args.mode), ("QUANTIZE", args.quantize),
+                       ("CHANNELS_LAST", args.channels_last), ("INTRA_OP_THREADS", args.threads)):
+        if value is not None:
+            engine[key] = value
+
+    class_file = ROOT / "imagenet_classes.txt"
+    image_resize = resnet_config.get("IMAGE_RESIZE", 256)
+    # Threads are set by the candidate engine, the eager baseline runs with the same settings
+    candidate = ResNetClassifier(class_file, image_resize=image_resize, engine=engine)
+    baseline = ResNetClassifier(class_file, image_resize=image_resize, engine={"MODE": "eager"})
+
+    inputs = _load_inputs(baseline, args)
+    baseline_labels, baseline_stats = _measure(baseline, inputs, args.batch_size, args.warmup)
+    candidate_labels, candidate_stats = _measure(candidate, inputs, args.batch_size, args.warmup)
+    agreement = sum(a == b for a, b in zip(baseline_labels, candidate_labels)) / len(inputs)
+
+    report = {
+        "inputs": len(inputs),
+        "source": args.images or "synthetic",
+        "engine": candidate.engine,
+        "eager": baseline_stats,
+        "candidate": candidate_stats,
+        "top1_agreement": agreement,
+    }
+
+    print(f"Inputs: {len(inputs)} ({report['source']})")
+    print(f"Engine: {json.dumps(candidate.engine)}")
+    print(f"{'':12}{'mean ms':>10}{'p50 ms':>10}{'p99 ms':>10}{'img/s':>10}")
+    for name, stats in (("eager", baseline_stats), ("candidate", candidate_stats)):
+        print(f"{name:12}{stats['mean_ms']:10.1f}{stats['p50_ms']:10.1f}{stats['p99_ms']:10.1f}"
+              f"{stats['batched_images_per_second']:10.1f}")
+    print(f"Speed-up (mean latency): {baseline_stats['mean_ms'] / candidate_stats['mean_ms']:.2f}x")
+    print(f"Top-1 agreement: {agreement:.1%}")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,70 @@
+import threading
+from dataclasses import dataclass
+from typing import Any, Dict, Iterator, List, Optional
+
+from app.micro_batcher import MicroBatcher
+from chatbots.chatbot_controller import ChatBotController, BatchRejected
+
+
+@dataclass
+class _Answer:
+    response: Optional[str] = None
+    error: Optional[BaseException] = None
+
+
+class BatchingChatBot(ChatBotController):
+    """
+    Sits in front of another chatbot so that prompts asked at the same time go upstream as one request.
+    Prompts are collected for up to `max_wait_ms` or until `max_batch_size` are waiting. A batch the
+    chatbot rejects is asked again one prompt at a time, so every prompt still gets its own answer or error.
+    """
+
+    def __init__(self, chatbot: ChatBotController, max_batch_size: int = 8, max_wait_ms: float = 5,
+                 max_in_flight: int = 4):
+        self.chatbot = chatbot
+        self.fallback_response = chatbot.fallback_response
+        self._stats_lock = threading.Lock()
+        self._rejected_batches = 0
+        self.batcher = MicroBatcher(self._ask_batch, max_batch_size, max_wait_ms / 1000, name="chatbot-batcher",
+                                    max_in_flight=max_in_flight)
+
+    def ask_chatbot(self, message) -> str:
+        answer = self.batcher.submit(message).result()
+        if answer.error is not None:
+            raise answer.error
+        return answer.response
+
+    def ask_chatbot_batch(self, messages: List[str]) -> List[str]:
+        return self.chatbot.ask_chatbot_batch(messages)
+
+    def stream_chatbot(self, message) -> Iterator[str]:
+        # A batch only answers once every prompt in it is done, streams go upstream on their own
+        return self.chatbot.stream_chatbot(message)
+
+    def shutdown_chatbot(self, testing=False):
+        self.chatbot.shutdown_chatbot(testing)
+
+    def _ask_batch(self, messages: List[str]) -> List[_Answer]:
+        if len(messages) > 1:
+            try:
+                return [_Answer(response) for response in self.chatbot.ask_chatbot_batch(messages)]
+            except BatchRejected:
+                with self._stats_lock:
+                    self._rejected_batches += 1
+        return [self._ask_one(message) for message in messages]
+
+    def _ask_one(self, message: str) -> _Answer:
+        try:
+            return _Answer(self.chatbot.ask_chatbot(message))
+        except Exception as e:
+            return _Answer(error=e)
+
+    def stats(self) -> Dict[str, Any]:
+        stats = dict(self.chatbot.stats())
+        stats.update(self.batcher.stats())
+        with self._stats_lock:
+            stats["rejected_batches"] = self._rejected_batches
+        return stats
+
+    def shutdown(self):
+        self.batcher.stop()
@@ -0,0 +1,254 @@
+import hashlib
+import logging
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+from concurrent.futures import Future
+from typing import Dict, Iterator, Optional
+
+from app.cache import TTLCache
+from app.exceptions.service_unavailable import ServiceUnavailable
+from chatbots.chatbot_controller import ChatBotController
+from db.sqlite.chatbot.migrations import CHATBOT_CACHE_MIGRATIONS
+from db.sqlite.migrations import apply_migrations, reset_migrations
+from db.sqlite.sqlite_db_adaptor import SQLiteDBAdaptor
+from db.types.exceptions.db_error import DBError
+
+logger = logging.getLogger(__name__)
+
+
+def normalise_prompt(message: str) -> str:
+    """Prompts that only differ in case, spacing or closing punctuation get the same answer."""
+    message = unicodedata.normalize("NFKC", message).casefold()
+    message = " ".join(message.split())
+    return re.sub(r"[\s.!?]+$", "", message)
+
+
+class CachingChatBot(ChatBotController):
+    """
+    Answers prompts seen within the last `ttl` seconds without asking `chatbot` again. The most recent
+    `max_entries` answers are kept in memory, and given an adaptor every answer is also kept in an SQLite
+    table that survives restarts, expired rows are deleted every `sweep_interval` seconds once the sweeper
+    is started. Identical prompts that arrive while one is already being asked wait for that answer instead
+    of asking again.
+    """
+
+    def __init__(self, chatbot: ChatBotController, model_id: str, max_entries: int = 10_000, ttl: float = 86_400,
+                 adaptor: Optional[SQLiteDBAdaptor] = None, table_name: str = "chatbot_responses",
+                 sweep_interval: float = 600.0):
+        self.chatbot = chatbot
+        self.fallback_response = chatbot.fallback_response
+        # Part of every key, so answers of another model are never handed out
+        self.model_id = model_id
+        self.ttl = ttl
+        self.memory = TTLCache(max_entries=max_entries, ttl=ttl)
+        self.adaptor = adaptor
+        self.table_name = table_name
+        self.sweep_interval = sweep_interval
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._sweeper: Optional[threading.Thread] = None
+        self._in_flight: Dict[str, Future] = {}
+        self._coalesced = 0
+        self._stored_hits = 0
+        self._upstream_calls = 0
+        self._upstream_seconds = 0.0
+        self._swept = 0
+        if adaptor is not None:
+            apply_migrations(adaptor, table_name, CHATBOT_CACHE_MIGRATIONS, self)
+
+    def start_sweeper(self):
+        self._sweeper = threading.Thread(target=self._run_sweeper, name="chatbot-cache-sweeper", daemon=True)
+        self._sweeper.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._sweeper is not None:
+            self._sweeper.join()
+            self._sweeper = None
+
+    def sweep(self, batch_size: int = 1000) -> int:
+        """Delete every expired answer from the table and return how many there were."""
+        if self.adaptor is None:
+            return 0
+        expired_before = time.time() - self.ttl
+
+        def delete_batch(cursor):
+            # A range of the created_at index, a batch at a time so answers being stored don't wait long
+            return cursor.execute(f'''
+                DELETE FROM {self.table_name} WHERE prompt_key IN (
+                    SELECT prompt_key FROM {self.table_name} WHERE created_at <= ? LIMIT ?
+                )
+            ''', (expired_before, batch_size)).rowcount
+
+        swept = 0
+        while True:
+            deleted = self.adaptor.write(delete_batch)
+            swept += deleted
+            if deleted < batch_size:
+                break
+        with self._lock:
+            self._swept += swept
+        return swept
+
+    def _run_sweeper(self):
+        while not self._stopped.wait(self.sweep_interval):
+            try:
+                self.sweep()
+            except sqlite3.Error:
+                logger.exception("Could not sweep expired chatbot answers")
+
+    def shutdown_chatbot(self, testing=False):
+        if testing and self.adaptor is not None:
+            with self.adaptor.get_write_connection() as conn:
+                cursor = conn.cursor()
+                try:
+                    cursor.execute(f'DROP TABLE IF EXISTS {self.table_name}')
+                    reset_migrations(cursor, self.table_name)
+                    conn.commit()
+                except sqlite3.Error as e:
+                    raise DBError(f"Failed to drop table {self.table_name}: {e}")
+        self.chatbot.shutdown_chatbot(testing)
+
+    def _key(self, message: str) -> str:
+        return hashlib.sha256(f"{self.model_id}\0{normalise_prompt(message)}".encode()).hexdigest()
+
+    def ask_chatbot(self, message) -> str:
+        key = self._key(message)
+        response = self.memory.get_or_load(key, lambda _: self._load(key, message))
+        return response if response is not None else self.fallback_response
+
+    def stream_chatbot(self, message) -> Iterator[str]:
+        key = self._key(message)
+        # Memory or the table, never upstream, a cached answer comes as a single chunk
+        response = self.memory.get_or_load(key, self._load_stored)
+        if response is not None:
+            yield response
+            return
+
+        with self._lock:
+            future = self._in_flight.get(key)
+            leader = future is None
+            if leader:
+                future = Future()
+                self._in_flight[key] = future
+            else:
+                self._coalesced += 1
+
+        if not leader:
+            # The same prompt is already being asked, streamed or not, its answer comes as a single chunk
+            response = future.result()
+            yield response if response is not None else self.fallback_response
+            return
+
+        start = time.monotonic()
+        chunks = []
+        try:
+            for chunk in self.chatbot.stream_chatbot(message):
+                chunks.append(chunk)
+                yield chunk
+        except GeneratorExit:
+            # Whoever read the stream stopped early, the answer is incomplete
+            self._settle(key, future, exception=ServiceUnavailable("Chatbot stream was abandoned"))
+            raise
+        except BaseException as e:
+            self._settle(key, future, exception=e)
+            raise
+
+        with self._lock:
+            self._upstream_calls += 1
+            self._upstream_seconds += time.monotonic() - start
+        # Only kept once the stream has ended, a stream that broke off isn't the whole answer
+        response = "".join(chunks)
+        if response == self.fallback_response:
+            response = None
+        else:
+            self.memory.put(key, response)
+            self._store(key, response)
+        self._settle(key, future, response=response)
+
+    def _settle(self, key: str, future: Future, response: Optional[str] = None,
+                exception: Optional[BaseException] = None):
+        with self._lock:
+            del self._in_flight[key]
+        if exception is not None:
+            future.set_exception(exception)
+        else:
+            future.set_result(response)
+
+    def _load(self, key: str, message: str) -> Optional[str]:
+        with self._lock:
+            future = self._in_flight.get(key)
+            leader = future is None
+            if leader:
+                future = Future()
+                self._in_flight[key] = future
+            else:
+                self._coalesced += 1
+
+        if not leader:
+            return future.result()
+
+        try:
+            response = self._load_stored(key)
+            if response is None:
+                response = self._ask_upstream(key, message)
+        except BaseException as e:
+            self._settle(key, future, exception=e)
+            raise
+
+        self._settle(key, future, response=response)
+        return response
+
+    def _load_stored(self, key: str) -> Optional[str]:
+        if self.adaptor is None:
+            return None
+        with self.adaptor.get_connection() as conn:
+            row = conn.execute(f'SELECT response FROM {self.table_name} WHERE prompt_key = ? AND created_at > ?',
+                               (key, time.time() - self.ttl)).fetchone()
+        if row is None:
+            return None
+        with self._lock:
+            self._stored_hits += 1
+        return row["response"]
+
+    def _ask_upstream(self, key: str, message: str) -> Optional[str]:
+        start = time.monotonic()
+        response = self.chatbot.ask_chatbot(message)
+        with self._lock:
+            self._upstream_calls += 1
+            self._upstream_seconds += time.monotonic() - start
+        if response == self.fallback_response:
+            # Not a real answer, the next ask should try again. None is never cached
+            return None
+        self._store(key, response)
+        return response
+
+    def _store(self, key: str, response: str):
+        if self.adaptor is not None:
+            self.adaptor.submit_write(lambda cursor: cursor.execute(f'''
+                INSERT OR REPLACE INTO {self.table_name} (prompt_key, response, created_at) VALUES (?, ?, ?)
+            ''', (key, response, time.time())))
+
+    def stats(self) -> Dict[str, float]:
+        memory = self.memory.stats()
+        with self._lock:
+            # Every answer that didn't need an upstream call saved about an average call's time
+            answered_locally = memory["hits"] + self._coalesced + self._stored_hits
+            mean_upstream = self._upstream_seconds / self._upstream_calls if self._upstream_calls else 0.0
+            stats = {
+                "hits": memory["hits"],
+                "stored_hits": self._stored_hits,
+                "coalesced": self._coalesced,
+                "upstream_calls": self._upstream_calls,
+                "hit_rate": answered_locally / (answered_locally + self._upstream_calls)
+                if answered_locally + self._upstream_calls else 0.0,
+                "mean_upstream_ms": mean_upstream * 1000,
+                "saved_seconds": answered_locally * mean_upstream,
+                "entries": memory["entries"],
+                "swept": self._swept,
+            }
+        stats.update({f"model_{name}": value for name, value in self.chatbot.stats().items()})
+        return stats
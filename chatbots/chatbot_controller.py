@@ -1,7 +1,31 @@
 from abc import ABC, abstractmethod
+from typing import Dict, Iterator, List, Optional
+
+
+class BatchRejected(Exception):
+    """The chatbot won't take these prompts as one batch, they should be asked one at a time."""
 
 
 class ChatBotController(ABC):
+    # What ask_chatbot answers when the model gave nothing usable, not worth keeping
+    fallback_response: Optional[str] = None
+
     @abstractmethod
     def ask_chatbot(self, message) -> str:
-        pass
\ No newline at end of file
+        pass
+
+    def ask_chatbot_batch(self, messages: List[str]) -> List[str]:
+        """Answers to `messages` in order, from as few upstream calls as the chatbot can manage."""
+        raise BatchRejected(f"{type(self).__name__} can't answer prompts in batches")
+
+    def stream_chatbot(self, message) -> Iterator[str]:
+        """The answer to `message` in chunks as the model produces them, joined they are the whole answer."""
+        yield self.ask_chatbot(message)
+
+    def shutdown_chatbot(self, testing=False):
+        """Called as the chat controller shuts down, with `testing` anything the chatbot stored is dropped."""
+        pass
+
+    def stats(self) -> Dict[str, float]:
+        """Counters of the calls made to the chatbot, for /health/metrics."""
+        return {}
@@ -1,19 +1,174 @@
+import json
+import random
+import threading
+import time
+from collections import deque
+from typing import Dict, Iterator, List, Optional
+
 import requests
 from flask import Flask
+from requests.adapters import HTTPAdapter
+
+from app.exceptions.service_unavailable import ServiceUnavailable
+from chatbots.chatbot_controller import ChatBotController, BatchRejected
 
-from chatbots.chatbot_controller import ChatBotController
+DEFAULT_API_URL = "https://api-inference.huggingface.co/models/google/flan-t5-large"
+# Rate limited, or the model is still loading, both worth another try
+RETRY_STATUSES = {429, 503}
+# Calls the latency percentiles are taken over
+LATENCY_WINDOW = 1000
+FALLBACK_RESPONSE = "Sorry, I couldn't generate a proper response."
 
 
 class FlanT5ChatBot(ChatBotController):
+    fallback_response = FALLBACK_RESPONSE
 
     def __init__(self, flask_app: Flask):
         self.huggingface_token = flask_app.config["SECRETS"]["HUGGINGFACE"]
-        self.api_url = "https://api-inference.huggingface.co/models/google/flan-t5-large"
+        chatbot_config = flask_app.config["MODULES"]["CHATBOT"]
+        http_config = chatbot_config.get("HTTP", {})
+        self.api_url = chatbot_config.get("API_URL", DEFAULT_API_URL)
         self.request_headers = {"Authorization": "Bearer %s" % self.huggingface_token}
+        self.timeout = (http_config.get("CONNECT_TIMEOUT", 3.05), http_config.get("READ_TIMEOUT", 30.0))
+        self.max_retries = http_config.get("MAX_RETRIES", 3)
+        self.backoff = http_config.get("BACKOFF_SECONDS", 0.5)
+        self.max_backoff = http_config.get("MAX_BACKOFF_SECONDS", 8.0)
+
+        # One keep-alive connection pool for every call, so only the first pays for DNS, TCP and TLS
+        self.session = requests.Session()
+        self.session.headers.update(self.request_headers)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=http_config.get("POOL_SIZE", 10), max_retries=0)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+        self._stats_lock = threading.Lock()
+        self._latencies = deque(maxlen=LATENCY_WINDOW)
+        self._first_chunk_latencies = deque(maxlen=LATENCY_WINDOW)
+        self._calls = 0
+        self._failures = 0
+        self._retries = 0
 
     def ask_chatbot(self, message) -> str:
         prompt = {
             "inputs": message
         }
-        response = requests.post(self.api_url, headers=self.request_headers, json=prompt).json()
-        return response[0].get('generated_text', "Sorry, I couldn't generate a proper response.")
\ No newline at end of file
+        response = self._post(prompt).json()
+        return response[0].get('generated_text', FALLBACK_RESPONSE)
+
+    def ask_chatbot_batch(self, messages: List[str]) -> List[str]:
+        # The inference API takes a list of inputs and answers with one generation per input
+        response = self._post({"inputs": list(messages)}, allow_client_errors=True)
+        if 400 <= response.status_code < 500:
+            raise BatchRejected(f"Chatbot rejected a batch with HTTP {response.status_code}")
+        generations = response.json()
+        if not isinstance(generations, list) or len(generations) != len(messages):
+            raise BatchRejected("Chatbot didn't answer every prompt of the batch")
+        answers = []
+        for generation in generations:
+            # Some models wrap each input's generations in another list
+            if isinstance(generation, list):
+                generation = generation[0] if generation else {}
+            answers.append(generation.get('generated_text', FALLBACK_RESPONSE))
+        return answers
+
+    def stream_chatbot(self, message) -> Iterator[str]:
+        start = time.monotonic()
+        # The API answers a streamed generation with server-sent events, one per token
+        response = self._post({"inputs": message, "stream": True}, stream=True)
+        try:
+            if not response.headers.get("Content-Type", "").startswith("text/event-stream"):
+                # A model that can't stream answers in one piece
+                yield response.json()[0].get('generated_text', FALLBACK_RESPONSE)
+                return
+            first = True
+            for event in self._read_events(response):
+                if "error" in event:
+                    raise ServiceUnavailable(f"Chatbot stream failed: {event['error']}")
+                token = event.get("token") or {}
+                if token.get("special") or not token.get("text"):
+                    continue
+                if first:
+                    first = False
+                    with self._stats_lock:
+                        self._first_chunk_latencies.append(time.monotonic() - start)
+                yield token["text"]
+        finally:
+            response.close()
+
+    @staticmethod
+    def _read_events(response: requests.Response) -> Iterator[dict]:
+        # Server-sent events are always UTF-8, whatever the Content-Type leaves out
+        response.encoding = "utf-8"
+        try:
+            for line in response.iter_lines(decode_unicode=True):
+                if line and line.startswith("data:"):
+                    yield json.loads(line[len("data:"):])
+        except requests.RequestException as e:
+            raise ServiceUnavailable("Chatbot stream broke off") from e
+
+    def _post(self, payload, allow_client_errors: bool = False, stream: bool = False) -> requests.Response:
+        """The upstream's answer, with `stream` the body is left to be read by the caller."""
+        start = time.monotonic()
+        attempt = 0
+        failed = True
+        try:
+            while True:
+                attempt += 1
+                try:
+                    response = self.session.post(self.api_url, json=payload, timeout=self.timeout, stream=stream)
+                except requests.ReadTimeout as e:
+                    # The upstream has it but is stuck, another attempt would most likely just wait as long again
+                    raise ServiceUnavailable("Chatbot took too long to answer") from e
+                except requests.ConnectionError as e:
+                    if attempt > self.max_retries:
+                        raise ServiceUnavailable("Chatbot could not be reached") from e
+                    delay = self._backoff_delay(attempt)
+                else:
+                    if response.status_code not in RETRY_STATUSES:
+                        if not response.ok and not (allow_client_errors and response.status_code < 500):
+                            raise ServiceUnavailable(f"Chatbot answered with HTTP {response.status_code}")
+                        failed = False
+                        return response
+                    if attempt > self.max_retries:
+                        raise ServiceUnavailable(f"Chatbot answered with HTTP {response.status_code}")
+                    delay = self._retry_after(response) or self._backoff_delay(attempt)
+                    response.close()
+                with self._stats_lock:
+                    self._retries += 1
+                time.sleep(delay)
+        finally:
+            with self._stats_lock:
+                self._calls += 1
+                self._failures += failed
+                self._latencies.append(time.monotonic() - start)
+
+    def _backoff_delay(self, attempt: int) -> float:
+        # Full jitter, so workers that failed together don't all come back at the same moment
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** (attempt - 1)))
+
+    def _retry_after(self, response: requests.Response) -> Optional[float]:
+        try:
+            return min(self.max_backoff, max(0.0, float(response.headers["Retry-After"])))
+        except (KeyError, ValueError):
+            return None
+
+    def stats(self) -> Dict[str, float]:
+        with self._stats_lock:
+            latencies = sorted(self._latencies)
+            first_chunk_latencies = sorted(self._first_chunk_latencies)
+            stats = {"calls": self._calls, "failures": self._failures, "retries": self._retries}
+        if latencies:
+            stats.update({
+                "mean_ms": sum(latencies) / len(latencies) * 1000,
+                "p50_ms": latencies[len(latencies) // 2] * 1000,
+                "p95_ms": latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))] * 1000,
+                "max_ms": latencies[-1] * 1000,
+            })
+        if first_chunk_latencies:
+            # Time to the first streamed token, what a user waits before the answer starts appearing
+            stats.update({
+                "first_chunk_p50_ms": first_chunk_latencies[len(first_chunk_latencies) // 2] * 1000,
+                "first_chunk_p95_ms": first_chunk_latencies[
+                    min(len(first_chunk_latencies) - 1, int(len(first_chunk_latencies) * 0.95))] * 1000,
+            })
+        return stats
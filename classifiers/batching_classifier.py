@@ -0,0 +1,48 @@
+from pathlib import Path
+from typing import List
+
+from app.micro_batcher import MicroBatcher
+from classifiers.image_classifier import ImageClassifier
+from classifiers.prediction import Prediction
+
+
+class BatchingClassifier(ImageClassifier):
+    """
+    Sits in front of another classifier so that concurrent predict calls share a single
+    forward pass. Images are decoded in the calling thread, only the model call is batched.
+    `max_in_flight` should match how many batches the wrapped classifier can run side by side.
+    """
+
+    def __init__(self, classifier: ImageClassifier, max_batch_size: int = 8, max_wait_ms: float = 10,
+                 max_in_flight: int = 1):
+        self.classifier = classifier
+        self.batcher = MicroBatcher(classifier.predict_batch, max_batch_size, max_wait_ms / 1000,
+                                    name="classifier-batcher", max_in_flight=max_in_flight)
+        super().__init__()
+
+    @property
+    def model_id(self) -> str:
+        return self.classifier.model_id
+
+    def warm_up(self):
+        self.classifier.warm_up()
+
+    def load_model(self):
+        return self.classifier.model
+
+    def load_classes(self):
+        return self.classifier.classes
+
+    def transform_image(self, image_path: Path):
+        return self.classifier.transform_image(image_path)
+
+    def predict_batch(self, image_tensors: List) -> List[Prediction]:
+        return self.classifier.predict_batch(image_tensors)
+
+    def predict(self, image_path: Path) -> Prediction:
+        return self.batcher.submit(self.transform_image(image_path)).result()
+
+    def shutdown(self):
+        self.batcher.stop()
+        if hasattr(self.classifier, "shutdown"):
+            self.classifier.shutdown()
@@ -1,5 +1,8 @@
 from abc import abstractmethod, ABC
 from pathlib import Path
+from typing import List
+
+from classifiers.prediction import Prediction
 
 
 class ImageClassifier(ABC):
@@ -8,6 +11,15 @@ class ImageClassifier(ABC):
         self.classes = self.load_classes()
         self.model = self.load_model()
 
+    @property
+    def model_id(self) -> str:
+        """Identifies the model and weights, results from different model ids are not interchangeable."""
+        return type(self).__name__
+
+    def warm_up(self):
+        """Run a throwaway prediction so the first real request doesn't pay for lazy initialisation."""
+        pass
+
     @abstractmethod
     def load_model(self):
         """Load and return the model."""
@@ -24,6 +36,11 @@ class ImageClassifier(ABC):
         pass
     
     @abstractmethod
-    def predict(self, image_path: Path):
+    def predict_batch(self, image_tensors: List) -> List[Prediction]:
+        """Run prediction on already transformed images, returning one prediction per image."""
+        pass
+
+    @abstractmethod
+    def predict(self, image_path: Path) -> Prediction:
         pass
         
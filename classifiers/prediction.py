@@ -0,0 +1,15 @@
+from dataclasses import dataclass, field
+from typing import Dict
+
+
+@dataclass
+class Prediction:
+    label: str
+    # Probabilities of the most likely labels, including the predicted one
+    scores: Dict[str, float] = field(default_factory=dict)
+
+    def to_dict(self):
+        return {
+            "label": self.label,
+            "scores": self.scores,
+        }
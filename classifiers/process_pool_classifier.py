@@ -0,0 +1,294 @@
+import itertools
+import logging
+import math
+import threading
+import time
+from concurrent.futures import Future
+from multiprocessing.connection import wait
+from pathlib import Path
+from typing import Callable, Dict, List, Tuple, Any, Optional
+
+import torch
+import torch.multiprocessing
+
+from app.exceptions.service_unavailable import ServiceUnavailable
+from classifiers.image_classifier import ImageClassifier
+from classifiers.prediction import Prediction
+
+logger = logging.getLogger(__name__)
+
+READY = "ready"
+
+
+def _worker_main(worker_factory: Callable[[], ImageClassifier], connection, threads: int):
+    """Entry point of a worker process, loads the model once then serves batches until told to stop."""
+    if threads:
+        torch.set_num_threads(threads)
+    classifier = worker_factory()
+    connection.send((READY, None, None))
+    while True:
+        try:
+            message = connection.recv()
+        except EOFError:
+            break
+        if message is None:
+            break
+        request_id, image_tensors = message
+        try:
+            if image_tensors is None:
+                classifier.warm_up()
+                connection.send((request_id, [], None))
+            else:
+                connection.send((request_id, classifier.predict_batch(image_tensors), None))
+        except Exception as e:
+            connection.send((request_id, None, f"{type(e).__name__}: {e}"))
+
+
+class _Worker:
+
+    def __init__(self, index: int, process, connection):
+        self.index = index
+        self.process = process
+        self.connection = connection
+        self.ready = False
+        self.send_lock = threading.Lock()
+        # request id -> (future, time the worker started on it)
+        self.in_flight: Dict[int, Tuple[Future, float]] = {}
+        # Set once the worker is gone, to when its replacement may be started
+        self.respawn_at: Optional[float] = None
+
+
+class ProcessPoolClassifier(ImageClassifier):
+    """
+    Runs predictions in separate worker processes so the model doesn't share the web process's GIL.
+    Every worker builds its own classifier with `worker_factory`, which has to be picklable. Images are
+    decoded here with `transform_image` and the resulting tensors reach the workers through shared memory.
+    A worker that dies before loading its model is replaced after `restart_backoff` seconds, doubled on every
+    further failure up to `max_restart_backoff`. After `max_failed_starts` in a row the pool gives up on it
+    and calls `on_failed`.
+    """
+
+    def __init__(self, worker_factory: Callable[[], ImageClassifier], transform_image: Callable[[Path], torch.Tensor],
+                 model_id: str, workers: int = 2, threads_per_worker: int = 0, queue_size: int = 16,
+                 queue_timeout: float = 5.0, request_timeout: float = 60.0, health_check_interval: float = 1.0,
+                 restart_backoff: float = 1.0, max_restart_backoff: float = 60.0, max_failed_starts: int = 5,
+                 on_failed: Optional[Callable[[], None]] = None):
+        self.worker_factory = worker_factory
+        self._transform_image = transform_image
+        self._model_id = model_id
+        self.worker_count = max(1, workers)
+        self.threads_per_worker = threads_per_worker
+        self.queue_timeout = queue_timeout
+        self.request_timeout = request_timeout
+        self.health_check_interval = health_check_interval
+        self.restart_backoff = restart_backoff
+        self.max_restart_backoff = max_restart_backoff
+        self.max_failed_starts = max(1, max_failed_starts)
+        self.on_failed = on_failed
+        self.restarts = 0
+        self.failed = False
+        # Deaths of each worker slot before its model loaded, since it last did
+        self._failed_starts = [0] * self.worker_count
+        self._context = torch.multiprocessing.get_context("spawn")
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(max(1, queue_size))
+        self._request_ids = itertools.count()
+        self._workers: List[_Worker] = []
+        self._stopped = threading.Event()
+        super().__init__()
+
+    @property
+    def model_id(self) -> str:
+        return self._model_id
+
+    def load_model(self):
+        """Start the worker processes, the model itself only lives in them."""
+        self._workers = [self._spawn(i) for i in range(self.worker_count)]
+        threading.Thread(target=self._receive_results, name="classifier-pool-results", daemon=True).start()
+        threading.Thread(target=self._check_health, name="classifier-pool-health", daemon=True).start()
+        return None
+
+    def load_classes(self):
+        # Labels are produced by the workers
+        return []
+
+    def transform_image(self, image_path: Path):
+        return self._transform_image(image_path)
+
+    def predict_batch(self, image_tensors: List[torch.Tensor]) -> List[Prediction]:
+        if not self._slots.acquire(timeout=self.queue_timeout):
+            raise ServiceUnavailable("Classifier queue is full")
+        try:
+            return self._submit(torch.cat(image_tensors)).result()
+        finally:
+            self._slots.release()
+
+    def predict(self, image_path: Path) -> Prediction:
+        return self.predict_batch([self.transform_image(image_path)])[0]
+
+    def warm_up(self):
+        # One request per worker, least-busy routing spreads them over the whole pool
+        futures = [self._submit(None) for _ in range(self.worker_count)]
+        for future in futures:
+            future.result()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "workers": len(self._workers),
+                "ready": sum(worker.ready for worker in self._workers),
+                "alive": sum(worker.process.is_alive() for worker in self._workers),
+                "in_flight": sum(len(worker.in_flight) for worker in self._workers),
+                "restarts": self.restarts,
+                "failed": self.failed,
+            }
+
+    def shutdown(self):
+        self._stopped.set()
+        with self._lock:
+            workers = list(self._workers)
+        for worker in workers:
+            try:
+                with worker.send_lock:
+                    worker.connection.send(None)
+            except OSError:
+                pass
+        for worker in workers:
+            worker.process.join(5)
+            if worker.process.is_alive():
+                worker.process.terminate()
+            self._fail_in_flight(worker, "Classifier pool has been shut down")
+
+    def _spawn(self, index: int) -> _Worker:
+        parent_connection, child_connection = self._context.Pipe()
+        process = self._context.Process(target=_worker_main, name=f"classifier-worker-{index}", daemon=True,
+                                        args=(self.worker_factory, child_connection, self.threads_per_worker))
+        process.start()
+        child_connection.close()
+        return _Worker(index, process, parent_connection)
+
+    def _submit(self, batch: Optional[torch.Tensor]) -> Future:
+        """Send a batch to the least busy worker, None asks the worker to warm its model up."""
+        future = Future()
+        with self._lock:
+            if self._stopped.is_set():
+                raise ServiceUnavailable("Classifier pool has been shut down")
+            workers = [worker for worker in self._workers if worker.respawn_at is None]
+            if not workers:
+                raise ServiceUnavailable("Classifier worker is not available")
+            # Least busy worker, preferring ones that have finished loading the model
+            worker = min(workers, key=lambda w: (not w.ready, len(w.in_flight)))
+            request_id = next(self._request_ids)
+            worker.in_flight[request_id] = (future, time.monotonic())
+        try:
+            # Tensors are moved to shared memory by torch's pickler, only a handle goes down the pipe
+            with worker.send_lock:
+                worker.connection.send((request_id, None if batch is None else [batch]))
+        except OSError:
+            # The health check will replace the worker
+            with self._lock:
+                worker.in_flight.pop(request_id, None)
+            raise ServiceUnavailable("Classifier worker is not available")
+        return future
+
+    def _receive_results(self):
+        while not self._stopped.is_set():
+            with self._lock:
+                by_connection = {worker.connection: worker for worker in self._workers if worker.respawn_at is None}
+            try:
+                readable = wait(list(by_connection), timeout=0.2)
+            except (OSError, ValueError):
+                continue  # A connection was closed by a restart while waiting on it
+            for connection in readable:
+                worker = by_connection[connection]
+                try:
+                    request_id, predictions, error = connection.recv()
+                except (EOFError, OSError):
+                    if not self._stopped.is_set():
+                        self._restart(worker, "Classifier worker exited")
+                    continue
+
+                with self._lock:
+                    if request_id == READY:
+                        worker.ready = True
+                        self._failed_starts[worker.index] = 0
+                        # Requests queued while the model loaded only start counting now
+                        now = time.monotonic()
+                        worker.in_flight = {key: (future, now) for key, (future, _) in worker.in_flight.items()}
+                        continue
+                    future, _ = worker.in_flight.pop(request_id, (None, None))
+                if future is None:
+                    continue
+                if error is not None:
+                    future.set_exception(RuntimeError(f"Classifier worker failed: {error}"))
+                else:
+                    future.set_result(predictions)
+
+    def _check_health(self):
+        while not self._stopped.wait(self.health_check_interval):
+            with self._lock:
+                workers = list(self._workers)
+            now = time.monotonic()
+            for worker in workers:
+                if worker.respawn_at is not None:
+                    if worker.respawn_at <= now:
+                        self._respawn(worker)
+                    continue
+                if not worker.process.is_alive():
+                    self._restart(worker, "Classifier worker exited")
+                    continue
+                with self._lock:
+                    oldest = min((started for _, started in worker.in_flight.values()), default=now)
+                if worker.ready and now - oldest > self.request_timeout:
+                    logger.warning("Classifier worker %s is not responding, restarting it", worker.index)
+                    worker.process.kill()
+                    self._restart(worker, "Classifier worker timed out")
+
+    def _restart(self, worker: _Worker, reason: str):
+        with self._lock:
+            if self._stopped.is_set() or self._workers[worker.index] is not worker or worker.respawn_at is not None:
+                return  # Already replaced or waiting to be
+            if not worker.ready:
+                # Never loaded its model, e.g. worker_factory keeps failing
+                self._failed_starts[worker.index] += 1
+            failed_starts = self._failed_starts[worker.index]
+            if failed_starts >= self.max_failed_starts:
+                worker.respawn_at = math.inf
+                self.failed = True
+            elif failed_starts:
+                backoff = min(self.max_restart_backoff, self.restart_backoff * 2 ** (failed_starts - 1))
+                worker.respawn_at = time.monotonic() + backoff
+            else:
+                # Replaced before its requests fail, so they can be retried straight away
+                worker.respawn_at = time.monotonic()
+                self._replace(worker)
+        worker.connection.close()
+        self._fail_in_flight(worker, reason)
+
+        if worker.respawn_at == math.inf:
+            logger.error("%s (exit code %s) %s times before loading the model, giving up on it",
+                         reason, worker.process.exitcode, failed_starts)
+            if self.on_failed is not None:
+                self.on_failed()
+        elif failed_starts:
+            logger.warning("%s (exit code %s) before loading the model, restarting it in %.1fs",
+                           reason, worker.process.exitcode, worker.respawn_at - time.monotonic())
+        else:
+            logger.warning("%s (exit code %s), started a replacement", reason, worker.process.exitcode)
+
+    def _respawn(self, worker: _Worker):
+        with self._lock:
+            if not self._stopped.is_set() and self._workers[worker.index] is worker:
+                self._replace(worker)
+
+    def _replace(self, worker: _Worker):
+        # Called with the lock held
+        self._workers[worker.index] = self._spawn(worker.index)
+        self.restarts += 1
+
+    def _fail_in_flight(self, worker: _Worker, reason: str):
+        with self._lock:
+            in_flight, worker.in_flight = worker.in_flight, {}
+        for future, _ in in_flight.values():
+            if not future.done():
+                future.set_exception(ServiceUnavailable(reason))
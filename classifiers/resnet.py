@@ -1,25 +1,109 @@
 from pathlib import Path
+from typing import List, Dict, Any, Optional
 
 from PIL import Image
 import torch
 from torchvision import models, transforms
 
 from classifiers.image_classifier import ImageClassifier
+from classifiers.prediction import Prediction
+
+ENGINE_MODES = ("eager", "trace", "script")
+
+WEIGHTS_VERSION = "resnet152-IMAGENET1K_V1"
+
+TOP_SCORES = 5
+
+DEFAULT_ENGINE = {
+    "MODE": "eager",  # eager, trace or script
+    "FREEZE": True,  # Freeze traced/scripted models, folding weights and batch norms into constants
+    "CHANNELS_LAST": False,
+    "QUANTIZE": False,  # Dynamic int8 quantization, only the Linear layers are affected
+    "INTRA_OP_THREADS": 0,  # 0 leaves torch's default
+    "INTER_OP_THREADS": 0,
+}
+
+
+def resnet_model_id(engine: Dict[str, Any]) -> str:
+    # Tracing, freezing and memory layout don't change the results, quantization does
+    return WEIGHTS_VERSION + ("-int8" if engine.get("QUANTIZE", False) else "")
+
+
+def to_engine_layout(batch: torch.Tensor, engine: Dict[str, Any]) -> torch.Tensor:
+    if engine["CHANNELS_LAST"]:
+        return batch.contiguous(memory_format=torch.channels_last)
+    return batch
+
+
+def compile_model(model: torch.nn.Module, engine: Dict[str, Any]) -> torch.nn.Module:
+    """Prepare an eval-mode model for the `engine` settings (see DEFAULT_ENGINE)."""
+    if engine["QUANTIZE"]:
+        model = torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+    if engine["CHANNELS_LAST"]:
+        model = model.to(memory_format=torch.channels_last)
+
+    mode = engine["MODE"]
+    if mode == "eager":
+        return model
+
+    with torch.no_grad():
+        if mode == "trace":
+            example = to_engine_layout(torch.rand(1, 3, 224, 224), engine)
+            compiled = torch.jit.trace(model, example)
+        else:
+            compiled = torch.jit.script(model)
+        if engine["FREEZE"]:
+            compiled = torch.jit.freeze(compiled)
+    return compiled
+
+
+def transform_resnet_image(image_path: Path, image_resize: int = 256) -> torch.Tensor:
+    """Transform the input image to match the model's input requirements."""
+    transform = transforms.Compose([
+        transforms.Resize(image_resize),
+        transforms.CenterCrop(224),
+        transforms.ToTensor(),
+        transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])
+    ])
+    # Open and transform the image
+    image = Image.open(image_path).convert('RGB')
+    return transform(image).unsqueeze(0)
 
 
 # From the labs
 class ResNetClassifier(ImageClassifier):
 
-    def __init__(self, class_file: Path):
-          # Set the class file explicitly
-          self.class_file = class_file
-          super().__init__()
+    def __init__(self, class_file: Path, image_resize: int = 256, engine: Optional[Dict[str, Any]] = None):
+        # Set the class file explicitly
+        self.class_file = class_file
+        self.image_resize = image_resize
+        self.engine = {**DEFAULT_ENGINE, **(engine or {})}
+        if self.engine["MODE"] not in ENGINE_MODES:
+            raise ValueError(f"Unsupported engine mode: {self.engine['MODE']}")
+        self._configure_threads()
+        super().__init__()
+
+    @property
+    def model_id(self) -> str:
+        return resnet_model_id(self.engine)
+
+    def _configure_threads(self):
+        intra_op_threads = self.engine["INTRA_OP_THREADS"]
+        inter_op_threads = self.engine["INTER_OP_THREADS"]
+        if intra_op_threads:
+            torch.set_num_threads(intra_op_threads)
+        if inter_op_threads:
+            try:
+                torch.set_num_interop_threads(inter_op_threads)
+            except RuntimeError:
+                # Can only be set once per process, before any inter-op work has started
+                pass
 
     def load_model(self):
-        """Load the pre-trained ResNet model."""
+        """Load the pre-trained ResNet model and compile it for the configured engine."""
         model = models.resnet152(pretrained=True)
         model.eval()  # Set the model to evaluation mode
-        return model
+        return compile_model(model, self.engine)
 
     def load_classes(self):
         """Load ImageNet classes from the specified class file."""
@@ -29,20 +113,24 @@ class ResNetClassifier(ImageClassifier):
 
     def transform_image(self, image_path: Path):
         """Transform the input image to match the model's input requirements."""
-        transform = transforms.Compose([
-            transforms.Resize(256),
-            transforms.CenterCrop(224),
-            transforms.ToTensor(),
-            transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])
-        ])
-        # Open and transform the image
-        image = Image.open(image_path).convert('RGB')
-        return transform(image).unsqueeze(0)
-    
-    def predict(self, image_path):
+        return transform_resnet_image(image_path, self.image_resize)
+
+    def warm_up(self):
+        self.predict_batch([torch.zeros(1, 3, 224, 224)])
+
+    def predict_batch(self, image_tensors: List[torch.Tensor]) -> List[Prediction]:
+        """Run prediction on several transformed images in a single forward pass."""
+        batch = to_engine_layout(torch.cat(image_tensors), self.engine)  # Each tensor already has a batch dimension of 1
+        with torch.inference_mode():
+            output = self.model(batch)  # Run the model
+            probabilities = torch.softmax(output, 1)
+            top_scores, top_indices = torch.topk(probabilities, TOP_SCORES)  # Sorted, so the first is the prediction
+        predictions = []
+        for scores, indices in zip(top_scores.tolist(), top_indices.tolist()):
+            labelled = {self.classes[index]: round(score, 6) for score, index in zip(scores, indices)}
+            predictions.append(Prediction(self.classes[indices[0]], labelled))
+        return predictions
+
+    def predict(self, image_path) -> Prediction:
         """Run prediction on the image."""
-        image_tensor = self.transform_image(image_path)  # Transform the image
-        with torch.no_grad():
-            output = self.model(image_tensor)  # Run the model
-            _, predicted = torch.max(output, 1)  # Get predicted class index
-        return self.classes[predicted.item()]  # Return class label
\ No newline at end of file
+        return self.predict_batch([self.transform_image(image_path)])[0]
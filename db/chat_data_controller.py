@@ -1,13 +1,22 @@
 from abc import abstractmethod, ABC
-from typing import List, Tuple, Dict, Any
+from datetime import datetime
+from typing import List, Tuple, Dict, Any, Iterable, Optional, Iterator, Callable
 
+from app.exceptions.invalid_data import InvalidData
 from chatbots.chatbot_controller import ChatBotController
 from db.data_controller import DataController
 from db.db_adaptor import DBAdaptor
 from db.types.chat_message import ChatMessage
+from db.types.chat_search_result import ChatSearchResult
 from db.types.user.user_container import UserContainer
 
 
+# Messages read at a time by iter_chat_messages
+STREAM_CHUNK_SIZE = 500
+# Below every message id, for a stream from the very start
+MIN_CHAT_ID = -2 ** 63
+
+
 class ChatDataController(DataController, ABC):
 
     CHATBOT_ID = -1
@@ -16,9 +25,11 @@ class ChatDataController(DataController, ABC):
         super().__init__(db_adaptor)
         self.chatbot_controller = chatbot
 
-    def chat_callback(self, data: Dict[str, Any]) -> Tuple[Dict[str, str], int, int]:
+    def chat_callback(self, data: Dict[str, Any],
+                      on_chunk: Optional[Callable[[str], None]] = None) -> Tuple[Dict[str, str], int, int]:
         """
-        Chat callback for the websocket chatbot
+        Chat callback for the websocket chatbot. Given `on_chunk` the chatbot's answer is streamed, every
+        chunk is passed to it as it arrives and the whole answer is saved once the stream has ended.
         """
         from_user_id = 0
         try:
@@ -37,11 +48,17 @@ class ChatDataController(DataController, ABC):
 
             if to_user_id == self.CHATBOT_ID:
                 # Message to the chatbot
-                chatbot_response = self.chatbot_controller.ask_chatbot(message)
-
-                # Save the user's message and chatbot's response in the database
-                user_message = self._save_chat_message_impl(chatbot, user, message, 'user')
-                bot_message = self._save_chat_message_impl(user, chatbot, chatbot_response, 'bot')
+                if on_chunk is None:
+                    chatbot_response = self.chatbot_controller.ask_chatbot(message)
+                else:
+                    chunks = []
+                    for chunk in self.chatbot_controller.stream_chatbot(message):
+                        chunks.append(chunk)
+                        on_chunk(chunk)
+                    chatbot_response = "".join(chunks)
+
+                # Save the user's message and chatbot's response in the database, both or neither
+                user_message, bot_message = self._save_chat_exchange_impl(user, chatbot, message, chatbot_response)
                 # Return the chatbot's response message
                 return bot_message.to_dict(), from_user_id, self.CHATBOT_ID
             else:
@@ -65,10 +82,91 @@ class ChatDataController(DataController, ABC):
     def load_chat_messages(self, user: UserContainer) -> List[ChatMessage]:
         pass
 
+    @abstractmethod
+    def load_chat_messages_page(self, user: UserContainer, limit: int, before: Optional[int] = None,
+                                after: Optional[int] = None) -> List[ChatMessage]:
+        """
+        Up to `limit` messages of the user's conversation in message id order. The newest ones before the message
+        id `before` (or overall), or the oldest ones after the message id `after`.
+        """
+        pass
+
+    def iter_chat_messages(self, user: UserContainer, after: Optional[int] = None,
+                           before: Optional[int] = None) -> Iterator[ChatMessage]:
+        """
+        The user's conversation between the message ids `after` and `before` (both optional), oldest first and
+        read as it is iterated. Each chunk is its own short read, so a slow reader never holds on to a connection.
+        """
+        after = after if after is not None else MIN_CHAT_ID
+        while True:
+            chunk = self.load_chat_messages_page(user, STREAM_CHUNK_SIZE, after=after)
+            for message in chunk:
+                if before is not None and message.message_id >= before:
+                    return
+                yield message
+            if len(chunk) < STREAM_CHUNK_SIZE:
+                return
+            after = chunk[-1].message_id
+
     @abstractmethod
     def _save_chat_message_impl(self, from_user: UserContainer, to_user: UserContainer, message: str, message_type: str) -> ChatMessage:
         pass
 
+    def search_chat_messages(self, user: UserContainer, query: str, limit: int,
+                             offset: int = 0) -> List[ChatSearchResult]:
+        """
+        Messages of the user's conversation containing every word of `query`, best matches first.
+        """
+        if not query or not query.strip():
+            raise InvalidData("A search query is required")
+        return self._search_chat_messages(user, query.strip(), limit, offset)
+
+    def import_chat_messages(self, messages: Iterable[ChatMessage], batch_size: int = 500) -> int:
+        """
+        Store existing conversations, e.g. from an export, and return how many messages were written.
+        Message ids are assigned on insert, messages without a timestamp are stamped with the current time.
+        Each batch is written as one transaction.
+        """
+        imported = 0
+        batch = []
+        for message in messages:
+            if message.type not in ('user', 'bot'):
+                raise InvalidData(f"Unknown message type: {message.type}")
+            batch.append(message)
+            if len(batch) >= batch_size:
+                imported += self._save_chat_messages_impl(batch)
+                batch = []
+        if batch:
+            imported += self._save_chat_messages_impl(batch)
+        return imported
+
+    def archive_chat_messages(self, older_than: datetime, batch_size: int = 1000) -> int:
+        """
+        Move up to `batch_size` messages sent before `older_than` (UTC) out of the live table and return how
+        many were moved. Archived messages are still read by the load and page methods, and searched.
+        Controllers without an archive keep everything live.
+        """
+        return 0
+
+    def purge_archived_conversations(self) -> int:
+        """Remove archived messages of deleted users and return how many users' messages were removed."""
+        return 0
+
+    @abstractmethod
+    def _save_chat_exchange_impl(self, user: UserContainer, chatbot: UserContainer, message: str,
+                                 response: str) -> Tuple[ChatMessage, ChatMessage]:
+        """Save a message to the chatbot and its response together, returns (user message, bot message)."""
+        pass
+
+    @abstractmethod
+    def _search_chat_messages(self, user: UserContainer, query: str, limit: int,
+                              offset: int) -> List[ChatSearchResult]:
+        pass
+
+    @abstractmethod
+    def _save_chat_messages_impl(self, messages: List[ChatMessage]) -> int:
+        pass
+
     @abstractmethod
     def delete_chat_message(self, user: UserContainer):
         pass
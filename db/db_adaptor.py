@@ -7,3 +7,6 @@ class DBAdaptor(ABC):
     def get_connection(self):
         pass
 
+    def get_write_connection(self):
+        # Databases without a single writer can write on any connection
+        return self.get_connection()
@@ -1,105 +1,340 @@
-from typing import Optional, Tuple
-import os
-import uuid
+from typing import Optional, Tuple, Dict, Callable, BinaryIO, List, Any
+import hashlib
+import tempfile
+import threading
+import time
 from abc import ABC, abstractmethod
 from pathlib import Path
-from mimetypes import guess_type
 
 from PIL import Image as PILImage
-from PIL import ImageFile
 
 import PIL
 from werkzeug.datastructures import FileStorage
 
+from app.cache import TTLCache, cached_lookup
 from app.exceptions.invalid_data import InvalidData
 from classifiers.image_classifier import ImageClassifier
+from classifiers.prediction import Prediction
 from db.data_controller import DataController
 from db.db_adaptor import DBAdaptor
-from db.sqlite.image.util import get_image_hash
+from db.storage.flat_image_storage import FlatImageStorage
+from db.storage.image_storage import ImageStorage
+from db.storage.image_variant_cache import ImageVariantCache
+from db.types.classification_job import ClassificationJob
 from db.types.image import Image
 from db.types.user.user_container import UserContainer
 
 
-# TODO: Refactor to use temp files ideally
+# Formats we accept, as detected from the file header rather than what the client claims
+ACCEPTED_FORMATS = {
+    "JPEG": ("image/jpeg", "jpeg"),
+    "PNG": ("image/png", "png"),
+}
+
+# Fields an image listing can be projected to
+IMAGE_LIST_FIELDS = ("id", "width", "height", "mime", "classified_as", "hash", "created_at")
+DEFAULT_IMAGE_LIST_FIELDS = ("id", "width", "height", "mime", "classified_as", "created_at")
+
+UPLOAD_CHUNK_SIZE = 64 * 1024
+# Uploads smaller than this never touch the disk unless they turn out to be new
+SPOOL_MAX_SIZE = 1024 * 1024
+
 
 class ImageDataController(DataController, ABC):
 
-    def __init__(self, db_adaptor: DBAdaptor, image_folder_path: Path, classifier: ImageClassifier):
+    def __init__(self, db_adaptor: DBAdaptor, image_folder_path: Path, classifier: ImageClassifier,
+                 max_pixels: int = 40_000_000, max_dimension: int = 12_000, storage: Optional[ImageStorage] = None,
+                 variant_cache: Optional[ImageVariantCache] = None, cache: Optional[TTLCache] = None):
         super().__init__(db_adaptor)
         self.image_folder_path = image_folder_path
         self.image_classifier = classifier
+        self.storage = storage if storage is not None else FlatImageStorage(image_folder_path)
+        self.variant_cache = variant_cache
+        # Image rows by id, the info and file routes look the same ones up over and over
+        self.cache = cache
+        self.max_pixels = max_pixels
+        self.max_dimension = max_dimension
+        self._cache_stats_lock = threading.Lock()
+        self._cache_hits = 0
+        self._cache_misses = 0
+        # Set by a worker pool so it hears about new jobs without waiting for its next poll
+        self.on_classification_queued: Optional[Callable[[], None]] = None
 
     def init_controller(self):
-        os.makedirs(self.image_folder_path, exist_ok=True)
+        self.storage.init_storage()
+        if self.variant_cache is not None:
+            self.variant_cache.init_cache()
+        # Picks up files left behind by images deleted through a cascade, e.g. when their user was deleted
+        self.reclaim_unreferenced_files()
+        # Results from any other model version can never be hit again
+        self._invalidate_classification_cache(self.image_classifier.model_id)
+
+    @staticmethod
+    def _spool_upload(sent_image: FileStorage) -> Tuple[BinaryIO, str]:
+        """
+        Copy the upload into a spooled temp file, hashing the raw bytes on the way through.
+        """
+        spool = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE)
+        hash_sha256 = hashlib.sha256()
+        while chunk := sent_image.stream.read(UPLOAD_CHUNK_SIZE):
+            hash_sha256.update(chunk)
+            spool.write(chunk)
+        spool.seek(0)
+        return spool, hash_sha256.hexdigest()
 
-    def _write_image(self, sent_image: FileStorage) -> Tuple[str, int, int, str, str, Path]:
+    def _inspect_image(self, spool: BinaryIO) -> Tuple[int, int, str, str]:
+        """
+        Validate the image from its header alone, returns width, height, mime type and extension.
+        """
         try:
-            extension = sent_image.content_type.split('/')[1]
-            image_name = str(uuid.uuid4()) + "." + extension
-            image = PILImage.open(sent_image.stream)
-            path = self.image_folder_path / Path(image_name)
-            image.save(path)
-            image_hash = get_image_hash(path)
-            return image_name, image.width, image.height, image_hash, sent_image.content_type, path
-        except PIL.UnidentifiedImageError:
+            # Opening is lazy, only the header is parsed here
+            with PILImage.open(spool) as image:
+                image_format = image.format
+                width, height = image.size
+        except (PIL.UnidentifiedImageError, PILImage.DecompressionBombError):
             raise InvalidData("Invalid image file")
+        finally:
+            spool.seek(0)
+
+        if image_format not in ACCEPTED_FORMATS:
+            raise InvalidData(f"Unsupported image format {image_format}")
+        if width <= 0 or height <= 0 or max(width, height) > self.max_dimension or width * height > self.max_pixels:
+            raise InvalidData(f"Image dimensions {width}x{height} not allowed")
+        mime, extension = ACCEPTED_FORMATS[image_format]
+        return width, height, mime, extension
 
     def save_image(self, image: FileStorage, user: UserContainer) -> Image:
-        # Process the image to get metadata
-        image_name, image_width, image_height, image_hash, image_mime, image_path = self._write_image(image)
+        spool, image_hash = self._spool_upload(image)
+        with spool:
+            image_width, image_height, image_mime, extension = self._inspect_image(spool)
+
+            # Check if the image is unique by checking the hash in the database, before anything is written
+            existing_image = self._get_image_from_db_by_hash(image_hash)
+            if existing_image:
+                return existing_image.copy_with_not_unique()
+
+            image_name = self.storage.store(spool, image_hash, extension)
 
-        # Check if the image is unique by checking the hash in the database
-        existing_image = self._get_image_from_db_by_hash(image_hash)
+            def ensure_stored():
+                # Runs under the writer connection, like every reclaim. Identical content shares a path, so a
+                # delete may have reclaimed the file since it was stored above and before our row points at it
+                if not self.storage.path_for(image_name).exists():
+                    spool.seek(0)
+                    self.storage.store(spool, image_hash, extension)
 
-        if existing_image:
-            # If the image is not unique (exists in the database), return the existing image object
-            # easy way, dont like it
-            os.remove(image_path)
-            return existing_image.copy_with_not_unique()
+            # Save image to the database and retrieve the saved image object
+            returned_image = self._save_image_to_db(image_name, image_width, image_height, image_hash, image_mime,
+                                                    user, ensure_stored)
+        if not returned_image.unique:
+            # An upload the user already had updates their existing row
+            self._invalidate_image(returned_image.id)
 
-        # Save image to the database and retrieve the saved image object
-        returned_image = self._save_image_to_db(image_name, image_width, image_height, image_hash, image_mime, user)
+        if returned_image.relative_filepath != image_name:
+            # Lost a race to another upload of the same image, our copy may be nobody's
+            self.reclaim_unreferenced_files([image_name])
 
         return returned_image
 
+    def delete_image(self, image_id: int):
+        image = self._get_image(image_id)
+        relative_path = self._delete_image_from_db(image_id)
+        self._invalidate_image(image_id)
+        if relative_path is not None:
+            self.reclaim_unreferenced_files([relative_path])
+        if self.variant_cache is not None and image is not None and image.image_hash is not None:
+            # Otherwise they would only go once evicted to make room
+            self.variant_cache.discard(image.image_hash)
+
+    def reclaim_unreferenced_files(self, relative_paths: Optional[List[str]] = None):
+        """
+        Remove files no image row points to any more, either the given ones or every one the database knows of.
+        """
+        self._remove_unreferenced_files(relative_paths, self.storage.remove)
+
     def classify_image(self, image_id: int) -> Optional[str]:
         # Ensure you retrieve the image correctly from the database using image_id
-        image = self._get_image_from_db_id(image_id)
+        image = self._get_image(image_id)
 
         if image is None:
             raise ValueError(f"Image with ID {image_id} does not exist.")
 
-        # Perform classification (assuming you have an external image classifier)
-        classified_as = self.image_classifier.predict(
-            self.image_folder_path / image.relative_filepath)  # This will depend on your classifier logic
+        # The same bytes always classify the same way, so check the hash before running the model
+        model_id = self.image_classifier.model_id
+        prediction = None
+        if image.image_hash is not None:
+            prediction = self._get_cached_classification(image.image_hash, model_id)
+        self._count_cache_lookup(prediction is not None)
+
+        if prediction is None:
+            prediction = self.image_classifier.predict(self.storage.path_for(image.relative_filepath))
+            if image.image_hash is not None:
+                self._save_cached_classification(image.image_hash, model_id, prediction)
 
         # Update the database with the classification result
-        self._update_classified_as(image_id, classified_as)
+        self._update_classified_as(image_id, prediction.label)
+        self._invalidate_image(image_id)
+
+        return prediction.label
+
+    def queue_classification(self, image_id: int, user: UserContainer):
+        """
+        Classify the image in the background instead, the job survives restarts until a worker finishes it.
+        """
+        self._enqueue_classification_job(image_id, user.id)
+        if self.on_classification_queued is not None:
+            self.on_classification_queued()
 
-        return classified_as
+    def claim_classification_job(self) -> Optional[ClassificationJob]:
+        """
+        Mark the oldest pending job that is due as running and return it, None when there is no work.
+        """
+        return self._claim_classification_job(time.time())
+
+    def finish_classification_job(self, job_id: int, status: str, error: Optional[str] = None,
+                                  retry_in: float = 0.0):
+        """
+        Record how a claimed job went. A job put back as 'pending' is not claimed again for `retry_in` seconds.
+        """
+        self._finish_classification_job(job_id, status, error, time.time() + retry_in)
+
+    def reset_running_classification_jobs(self):
+        """
+        Put jobs left running by a previous process back in the queue.
+        """
+        self._reset_running_classification_jobs()
+
+    def get_classification_status(self, image: Image) -> Optional[str]:
+        """
+        'done' once the image has a label, otherwise the state of its background job if it has one.
+        """
+        if image.classified_as is not None:
+            return "done"
+        return self._get_classification_job_status(image.id)
+
+    def _count_cache_lookup(self, hit: bool):
+        with self._cache_stats_lock:
+            if hit:
+                self._cache_hits += 1
+            else:
+                self._cache_misses += 1
+
+    def get_classification_cache_stats(self) -> Dict[str, float]:
+        with self._cache_stats_lock:
+            lookups = self._cache_hits + self._cache_misses
+            return {
+                "hits": self._cache_hits,
+                "misses": self._cache_misses,
+                "hit_rate": self._cache_hits / lookups if lookups else 0.0,
+            }
 
     def get_id_image_filepath(self, image_id: int):
-        image = self._get_image_from_db_id(image_id)
+        image = self._get_image(image_id)
         if image is not None:
-            return self.image_folder_path / image.relative_filepath
+            return self.storage.path_for(image.relative_filepath)
         return None
 
+    def get_image_variant_filepath(self, image: Image, size: int, image_format: str) -> Path:
+        """Path of a resized copy of the image, see ImageVariantCache."""
+        if self.variant_cache is None:
+            raise InvalidData("Image variants are not enabled")
+        relative_path = self.variant_cache.get(self.storage.path_for(image.relative_filepath), image.image_hash,
+                                               size, image_format)
+        return self.variant_cache.path_for(relative_path)
+
     def get_current_image_filepath(self, user: UserContainer):
         image = self._get_image_from_current(user)
         if image is not None:
-            return self.image_folder_path / image.relative_filepath, image.id
+            return self.storage.path_for(image.relative_filepath), image.id
         return None
 
     def get_current_image(self, user: UserContainer) -> Optional[FileStorage]:
         return self._get_image_from_current(user)
 
     def get_image_from_id(self, image_id: int) -> Optional[FileStorage]:
-        return self._get_image_from_db_id(image_id)
+        return self._get_image(image_id)
+
+    def forget_images(self, image_ids: List[int]):
+        """Drop images deleted behind the controller's back, e.g. along with their user, from the cache."""
+        for image_id in image_ids:
+            self._invalidate_image(image_id)
+
+    def _get_image(self, image_id: int) -> Optional[Image]:
+        return cached_lookup(self.cache, self._cache_key(image_id), self._get_image_from_db_id)
+
+    def _invalidate_image(self, image_id: Optional[int]):
+        if self.cache is not None and image_id is not None:
+            self.cache.invalidate(self._cache_key(image_id))
+
+    @staticmethod
+    def _cache_key(image_id) -> int:
+        # Always the int id, an entry cached under "5" would never be invalidated by a write to image 5
+        if isinstance(image_id, bool):
+            raise InvalidData(f"Invalid image id {image_id!r}")
+        try:
+            return int(image_id)
+        except (TypeError, ValueError):
+            raise InvalidData(f"Invalid image id {image_id!r}")
+
+    def list_images(self, user: UserContainer, limit: int, after: Optional[Tuple[str, int]] = None,
+                    classified_as: Optional[str] = None, fields: Optional[List[str]] = None) -> List[Dict[str, Any]]:
+        """
+        The user's images newest first, only with the requested `fields` (see IMAGE_LIST_FIELDS).
+        `after` is the (created_at, id) of the last image of the previous page.
+        """
+        fields = list(fields) if fields else list(DEFAULT_IMAGE_LIST_FIELDS)
+        unknown = set(fields) - set(IMAGE_LIST_FIELDS)
+        if unknown:
+            raise InvalidData(f"Unknown image fields: {', '.join(sorted(unknown))}")
+        return self._list_images(user, limit, after, classified_as, fields)
 
     @abstractmethod
     def _update_classified_as(self, image_id, classified_as):
         pass
 
+    @abstractmethod
+    def _list_images(self, user: UserContainer, limit: int, after: Optional[Tuple[str, int]],
+                     classified_as: Optional[str], fields: List[str]) -> List[Dict[str, Any]]:
+        """Rows of the requested fields, always with the id and created_at that make up the page cursor."""
+        pass
+
+    @abstractmethod
+    def _get_cached_classification(self, image_hash: str, model_id: str) -> Optional[Prediction]:
+        pass
+
+    @abstractmethod
+    def _save_cached_classification(self, image_hash: str, model_id: str, prediction: Prediction):
+        pass
+
+    @abstractmethod
+    def _invalidate_classification_cache(self, current_model_id: str):
+        """
+        Drop cached classifications made by any model other than `current_model_id`.
+        """
+        pass
+
+    @abstractmethod
+    def _enqueue_classification_job(self, image_id: int, user_id: int):
+        pass
+
+    @abstractmethod
+    def _claim_classification_job(self, now: float) -> Optional[ClassificationJob]:
+        """
+        Atomically mark the oldest pending job with next_attempt_at <= now as running and return it.
+        """
+        pass
+
+    @abstractmethod
+    def _finish_classification_job(self, job_id: int, status: str, error: Optional[str], next_attempt_at: float):
+        pass
+
+    @abstractmethod
+    def _reset_running_classification_jobs(self):
+        pass
+
+    @abstractmethod
+    def _get_classification_job_status(self, image_id: int) -> Optional[str]:
+        pass
+
     @abstractmethod
     def _get_image_from_current(self, user: UserContainer) -> Optional[Image]:
         pass
@@ -117,9 +352,26 @@ class ImageDataController(DataController, ABC):
 
     @abstractmethod
     def _save_image_to_db(self, image_filename, image_width, image_height, image_hash, image_mime,
-                          user: UserContainer) -> Image:
+                          user: UserContainer, ensure_stored: Optional[Callable[[], None]] = None) -> Image:
+        """
+        Insert or update the user's row for the image. `ensure_stored` is called in the same write, before the
+        row points at the file.
+        """
         pass
 
     @abstractmethod
-    def delete_image(self, image_id: int):
+    def _delete_image_from_db(self, image_id: int) -> Optional[str]:
+        """
+        Delete the row and return the relative path of its file, None if there was no such image.
+        """
+        pass
+
+    @abstractmethod
+    def _remove_unreferenced_files(self, relative_paths: Optional[List[str]],
+                                   remove: Callable[[str], None]) -> List[str]:
+        """
+        Forget files whose reference count has dropped to zero, limited to `relative_paths` when given, and
+        return their relative paths. Each is passed to `remove` before the write lock is given up, so no upload
+        of the same content can start pointing at it in between.
+        """
         pass
@@ -0,0 +1,92 @@
+from db.sqlite.migrations import Migration
+
+
+def _create_chat(cursor, controller):
+    # IF NOT EXISTS adopts databases created before migrations were tracked
+    cursor.execute(f'''
+        CREATE TABLE IF NOT EXISTS {controller.chat_table_name} (
+            chat_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            chat_timestamp TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            chat_content TEXT NOT NULL,
+            sender_id INTEGER,
+            to_id INTEGER, -- Points to either the user or chatbot
+            message_type TEXT CHECK(message_type IN ('user', 'bot')),  -- To differentiate user and bot messages
+            FOREIGN KEY (sender_id) REFERENCES {controller.user_table_name}(user_id)
+            ON DELETE CASCADE,
+            FOREIGN KEY (to_id) REFERENCES {controller.user_table_name}(user_id)
+            ON DELETE CASCADE
+        )
+    ''')
+
+
+def _index_conversations(cursor, controller):
+    # Both halves of a conversation are looked up by sender and receiver, and read in order
+    cursor.execute(f'''
+        CREATE INDEX IF NOT EXISTS {controller.chat_table_name}_conversation
+        ON {controller.chat_table_name} (sender_id, to_id, chat_timestamp)
+    ''')
+    # Deleting a user cascades through to_id
+    cursor.execute(f'''
+        CREATE INDEX IF NOT EXISTS {controller.chat_table_name}_to_id ON {controller.chat_table_name} (to_id)
+    ''')
+
+
+def _index_message_ids(cursor, controller):
+    # Pages of a conversation are cut by message id
+    cursor.execute(f'''
+        CREATE INDEX IF NOT EXISTS {controller.chat_table_name}_conversation_id
+        ON {controller.chat_table_name} (sender_id, to_id, chat_id)
+    ''')
+
+
+def _message_owner(row: str) -> str:
+    """SQL for the search owner token of a message, the user on the human side of a conversation with the bot."""
+    return (f"'u' || CASE WHEN {row}.to_id = -1 THEN {row}.sender_id "
+            f"WHEN {row}.sender_id = -1 THEN {row}.to_id END")
+
+
+def _create_search_index(cursor, controller):
+    chat, fts = controller.chat_table_name, controller.search_table_name
+    # External content, the text itself is only stored once in the chat table. The owner column lets a search
+    # be limited to one user's conversation inside the index rather than by filtering its results
+    cursor.execute(f'''
+        CREATE VIEW IF NOT EXISTS {fts}_source AS
+        SELECT chat_id, chat_content, {_message_owner(chat)} AS owner FROM {chat}
+    ''')
+    cursor.execute(f'''
+        CREATE VIRTUAL TABLE IF NOT EXISTS {fts} USING fts5(
+            chat_content, owner, content='{fts}_source', content_rowid='chat_id',
+            tokenize='unicode61 remove_diacritics 2'
+        )
+    ''')
+    cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS {fts}_insert AFTER INSERT ON {chat}
+        BEGIN
+            INSERT INTO {fts} (rowid, chat_content, owner) VALUES (NEW.chat_id, NEW.chat_content, {_message_owner("NEW")});
+        END
+    ''')
+    cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS {fts}_delete AFTER DELETE ON {chat}
+        BEGIN
+            INSERT INTO {fts} ({fts}, rowid, chat_content, owner)
+            VALUES ('delete', OLD.chat_id, OLD.chat_content, {_message_owner("OLD")});
+        END
+    ''')
+    cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS {fts}_update AFTER UPDATE OF chat_content, sender_id, to_id ON {chat}
+        BEGIN
+            INSERT INTO {fts} ({fts}, rowid, chat_content, owner)
+            VALUES ('delete', OLD.chat_id, OLD.chat_content, {_message_owner("OLD")});
+            INSERT INTO {fts} (rowid, chat_content, owner) VALUES (NEW.chat_id, NEW.chat_content, {_message_owner("NEW")});
+        END
+    ''')
+    # Index the messages that already exist
+    cursor.execute(f"INSERT INTO {fts} ({fts}) VALUES ('rebuild')")
+
+
+CHAT_MIGRATIONS = [
+    Migration(1, "Create the chat table", _create_chat),
+    Migration(2, "Index conversations by sender, receiver and time", _index_conversations),
+    Migration(3, "Index conversations by sender, receiver and message id", _index_message_ids),
+    Migration(4, "Full-text search index over messages", _create_search_index),
+]
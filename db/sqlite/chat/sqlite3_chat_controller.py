@@ -1,110 +1,354 @@
+import re
 import sqlite3
+import zlib
 from datetime import datetime
-from typing import List
+from typing import List, Tuple, Optional
 
 from chatbots.chatbot_controller import ChatBotController
 from db.chat_data_controller import ChatDataController
+from db.sqlite.chat.migrations import CHAT_MIGRATIONS
+from db.sqlite.migrations import apply_migrations, reset_migrations
 from db.sqlite.sqlite_db_adaptor import SQLiteDBAdaptor
 from db.types.chat_message import ChatMessage
+from db.types.chat_search_result import ChatSearchResult
 from db.types.exceptions.db_error import DBError
 from db.types.user.user_container import UserContainer
 
+# Bounds for a cursor that hasn't been given
+MAX_CHAT_ID = 2 ** 63 - 1
+
+
+def _owner(row) -> str:
+    """The search owner token of a message, see _message_owner in the migrations."""
+    return f"u{row['sender_id'] if row['to_id'] == -1 else row['to_id']}"
+
+
+def _snippet(message: str, words: List[str], width: int = 12) -> str:
+    """Up to `width` words of `message` around the first match, with the matching words wrapped in [ and ]."""
+    wanted = {word.casefold() for word in words}
+    tokens = message.split()
+    matches = [i for i, token in enumerate(tokens) if set(re.findall(r"\w+", token.casefold())) & wanted]
+    start = max(0, min(matches[0] - width // 2, len(tokens) - width)) if matches else 0
+    shown = [f"[{token}]" if i in matches else token for i, token in enumerate(tokens)][start:start + width]
+    return ("…" if start > 0 else "") + " ".join(shown) + ("…" if start + width < len(tokens) else "")
+
+
+def _compress(message: str):
+    """The message zlib compressed, or as it is when that isn't any smaller."""
+    data = message.encode()
+    compressed = zlib.compress(data, 9)
+    return compressed if len(compressed) < len(data) else message
+
+
 class SQLite3ChatController(ChatDataController):
 
-    def __init__(self, sqlite_adaptor: SQLiteDBAdaptor, chatbot: ChatBotController):
+    def __init__(self, sqlite_adaptor: SQLiteDBAdaptor, chatbot: ChatBotController, archive_schema: Optional[str] = None):
         super().__init__(sqlite_adaptor, chatbot)
         self.user_table_name = sqlite_adaptor.user_table_name
         self.chat_table_name = sqlite_adaptor.chat_table_name
+        self.search_table_name = f"{self.chat_table_name}_search"
+        # Old messages are moved to a database the adaptor attaches under this name, see archive_chat_messages
+        self.archive_schema = archive_schema
+        self.archive_table_name = f"{archive_schema}.{self.chat_table_name}_archive" if archive_schema else None
+        self.archive_search_table_name = f"{self.archive_table_name}_search" if archive_schema else None
+
+    def _insert_chat_message(self, cursor, from_user: UserContainer, to_user: UserContainer, message: str,
+                             message_type: str) -> ChatMessage:
+        # Unknown senders or receivers are rejected by the foreign keys, no need to look them up first
+        query = f'''
+            INSERT INTO {self.chat_table_name} 
+            (chat_content, sender_id, to_id, message_type) 
+            VALUES (?, ?, ?, ?)
+            RETURNING chat_id, chat_timestamp
+        '''
+        to_id = to_user.id if to_user else self.CHATBOT_ID
+        row = cursor.execute(query, (message, from_user.id, to_id, message_type)).fetchone()
+        return ChatMessage(row["chat_id"], from_user.id, to_id, message, message_type, row["chat_timestamp"])
 
     def _save_chat_message_impl(self, from_user: UserContainer, to_user: UserContainer, message: str, message_type: str) -> ChatMessage:
         try:
-            with self.db_adaptor.get_connection() as conn:
-                cursor = conn.cursor()
+            return self.db_adaptor.write(
+                lambda cursor: self._insert_chat_message(cursor, from_user, to_user, message, message_type))
+        except sqlite3.IntegrityError as e:
+            raise DBError("Failed to save chat message, the sender or receiver does not exist.") from e
 
-                # First, ensure the sender exists in the user table
-                cursor.execute(f"SELECT user_id FROM {self.user_table_name} WHERE user_id = ?", (from_user.id,))
-                sender_exists = cursor.fetchone()
-                if not sender_exists:
-                    raise DBError(f"Sender user with id {from_user.id} does not exist.")
-
-                # If to_user exists, ensure they also exist in the user table
-                if to_user:
-                    cursor.execute(f"SELECT user_id FROM {self.user_table_name} WHERE user_id = ?", (to_user.id,))
-                    receiver_exists = cursor.fetchone()
-                    if not receiver_exists:
-                        raise DBError(f"Receiver user with id {to_user.id} does not exist.")
-                else:
-                    receiver_exists = True  # If there's no receiver, assume valid for chatbot
-
-                # Insert the message into the chat table
-                query = f'''
-                    INSERT INTO {self.chat_table_name} 
-                    (chat_content, sender_id, to_id, message_type) 
-                    VALUES (?, ?, ?, ?)
-                '''
-                cursor.execute(query, (message, from_user.id, to_user.id if to_user else -1, message_type))
+    def _save_chat_exchange_impl(self, user: UserContainer, chatbot: UserContainer, message: str,
+                                 response: str) -> Tuple[ChatMessage, ChatMessage]:
+        # Stored the way the conversation is read back, see load_chat_messages
+        def save(cursor):
+            return (self._insert_chat_message(cursor, chatbot, user, message, 'user'),
+                    self._insert_chat_message(cursor, user, chatbot, response, 'bot'))
 
-                # Fetch the timestamp for the inserted row
-                last_row_id = cursor.lastrowid
-                timestamp_query = f'''
-                    SELECT chat_timestamp FROM {self.chat_table_name} WHERE chat_id = ?
-                '''
-                cursor.execute(timestamp_query, (last_row_id,))
-                created_at = cursor.fetchone()["chat_timestamp"]
-                conn.commit()
+        try:
+            return self.db_adaptor.write(save)
+        except sqlite3.IntegrityError as e:
+            raise DBError("Failed to save chat messages, the user does not exist.") from e
 
-                # Return the ChatMessage with the timestamp
-                return ChatMessage(last_row_id, from_user.id, to_user.id if to_user else -1, message, message_type, created_at)
+    def _save_chat_messages_impl(self, messages: List[ChatMessage]) -> int:
+        def save(cursor):
+            query = f'''
+                INSERT INTO {self.chat_table_name} 
+                (chat_content, sender_id, to_id, message_type, chat_timestamp) 
+                VALUES (?, ?, ?, ?, COALESCE(?, CURRENT_TIMESTAMP))
+            '''
+            cursor.executemany(query, [
+                (message.message, message.sender_id, message.receiver_id, message.type,
+                 str(message.timestamp) if message.timestamp else None)
+                for message in messages
+            ])
+            return cursor.rowcount
 
+        try:
+            return self.db_adaptor.write(save)
         except sqlite3.IntegrityError as e:
-            raise DBError("Failed to save chat message due to database integrity error.") from e
+            raise DBError("Failed to import chat messages, a sender or receiver does not exist.") from e
 
     def load_chat_messages(self, user: UserContainer) -> List[ChatMessage]:
         with self.db_adaptor.get_connection() as conn:
             cursor = conn.cursor()
-            query = f'''
-                SELECT * FROM {self.chat_table_name} 
-                WHERE (sender_id = ? AND to_id = -1) 
-                OR (sender_id = -1 AND to_id = ?)
-                ORDER BY chat_timestamp
-            '''
-            rows = cursor.execute(query, (user.id, user.id)).fetchall()
-            return [
-                ChatMessage(
-                    message_id=row['chat_id'],
-                    sender_id=row['sender_id'],
-                    receiver_id=row['to_id'],
-                    type=row['message_type'],
-                    message=row['chat_content'],
-                    timestamp=row['chat_timestamp'],
+            rows = []
+            for table in self._tables():
+                query = f'''
+                    SELECT * FROM {table} 
+                    WHERE (sender_id = ? AND to_id = -1) 
+                    OR (sender_id = -1 AND to_id = ?)
+                    ORDER BY chat_timestamp, chat_id
+                '''
+                rows += cursor.execute(query, (user.id, user.id)).fetchall()
+        if self.archive_table_name is not None:
+            rows = sorted(self._unique_rows(rows), key=lambda row: (row['chat_timestamp'], row['chat_id']))
+        return [self._row_to_chat_message(row) for row in rows]
+
+    def _tables(self) -> List[str]:
+        """The live chat table and the archive, when there is one."""
+        return [self.chat_table_name] + ([self.archive_table_name] if self.archive_table_name else [])
+
+    @staticmethod
+    def _unique_rows(rows) -> list:
+        # A message is in both tables if an archive run stopped between copying and deleting it
+        return list({row['chat_id']: row for row in rows}.values())
+
+    @staticmethod
+    def _row_to_chat_message(row) -> ChatMessage:
+        message = row['chat_content']
+        if isinstance(message, bytes):
+            message = zlib.decompress(message).decode()
+        return ChatMessage(
+            message_id=row['chat_id'],
+            sender_id=row['sender_id'],
+            receiver_id=row['to_id'],
+            type=row['message_type'],
+            message=message,
+            timestamp=row['chat_timestamp'],
+        )
+
+    def load_chat_messages_page(self, user: UserContainer, limit: int, before: Optional[int] = None,
+                                after: Optional[int] = None) -> List[ChatMessage]:
+        # Each half of the conversation is a range seek on its index, only `limit` rows of each are read
+        if after is not None:
+            condition, order, bound = "chat_id > ?", "ASC", after
+        else:
+            condition, order, bound = "chat_id < ?", "DESC", before if before is not None else MAX_CHAT_ID
+        parameters = (user.id, bound, limit, user.id, bound, limit, limit)
+        with self.db_adaptor.get_connection() as conn:
+            rows = conn.execute(self._page_query(self.chat_table_name, condition, order), parameters).fetchall()
+            if self._page_reaches_archive(conn, rows, limit, order, bound):
+                rows += conn.execute(self._page_query(self.archive_table_name, condition, order), parameters).fetchall()
+                rows = sorted(self._unique_rows(rows), key=lambda row: row['chat_id'], reverse=order == "DESC")[:limit]
+        messages = [self._row_to_chat_message(row) for row in rows]
+        if order == "DESC":
+            messages.reverse()
+        return messages
+
+    @staticmethod
+    def _page_query(table: str, condition: str, order: str) -> str:
+        return f'''
+            SELECT * FROM (
+                SELECT * FROM (
+                    SELECT * FROM {table} WHERE sender_id = ? AND to_id = -1 AND {condition}
+                    ORDER BY chat_id {order} LIMIT ?
+                )
+                UNION ALL
+                SELECT * FROM (
+                    SELECT * FROM {table} WHERE sender_id = -1 AND to_id = ? AND {condition}
+                    ORDER BY chat_id {order} LIMIT ?
+                )
+            )
+            ORDER BY chat_id {order} LIMIT ?
+        '''
+
+    def _page_reaches_archive(self, conn, rows, limit: int, order: str, bound: int) -> bool:
+        """Whether archived messages could belong on a page, most pages are served from the live table alone."""
+        if self.archive_table_name is None:
+            return False
+        archived_up_to = conn.execute(f'SELECT MAX(chat_id) FROM {self.archive_table_name}').fetchone()[0]
+        if archived_up_to is None:
+            return False
+        if order == "ASC":
+            return bound < archived_up_to
+        return len(rows) < limit or rows[-1]['chat_id'] < archived_up_to
+
+    def _search_chat_messages(self, user: UserContainer, query: str, limit: int,
+                              offset: int) -> List[ChatSearchResult]:
+        # Every word is quoted, so nothing the user types is read as FTS5 query syntax
+        words = re.findall(r"\w+", query)
+        if not words:
+            return []
+        match = " AND ".join([f'owner : "u{int(user.id)}"'] + [f'chat_content : "{word}"' for word in words])
+        fts = self.search_table_name
+        search_query = f'''
+            SELECT chat.*, snippet({fts}, 0, '[', ']', '…', 12) AS snippet, bm25({fts}, 1.0, 0.0) AS rank
+            FROM {fts} JOIN {self.chat_table_name} AS chat ON chat.chat_id = {fts}.rowid
+            WHERE {fts} MATCH ?
+            ORDER BY rank, chat.chat_id
+            LIMIT ? OFFSET ?
+        '''
+        with self.db_adaptor.get_connection() as conn:
+            if self.archive_table_name is None:
+                rows = conn.execute(search_query, (match, limit, offset)).fetchall()
+                return [ChatSearchResult(self._row_to_chat_message(row), row["snippet"], row["rank"]) for row in rows]
+
+            # Both indexes are read up to the end of the page, then merged by rank
+            live = [ChatSearchResult(self._row_to_chat_message(row), row["snippet"], row["rank"])
+                    for row in conn.execute(search_query, (match, offset + limit, 0)).fetchall()]
+            # An attached table is matched by its bare name
+            archive_fts = self.archive_search_table_name.split(".")[-1]
+            archived = conn.execute(f'''
+                SELECT chat.*, bm25({archive_fts}, 1.0, 0.0) AS rank
+                FROM {self.archive_search_table_name}
+                JOIN {self.archive_table_name} AS chat ON chat.chat_id = {archive_fts}.rowid
+                WHERE {archive_fts} MATCH ?
+                ORDER BY rank, chat.chat_id
+                LIMIT ?
+            ''', (match, offset + limit)).fetchall()
+        live_ids = {result.message.message_id for result in live}
+        # The archive index doesn't keep the text, so its snippets are cut here
+        results = live + [ChatSearchResult(message, _snippet(message.message, words), row["rank"])
+                          for row in archived
+                          for message in [self._row_to_chat_message(row)] if message.message_id not in live_ids]
+        results.sort(key=lambda result: (result.rank, result.message.message_id))
+        return results[offset:offset + limit]
+
+    def archive_chat_messages(self, older_than: datetime, batch_size: int = 1000) -> int:
+        if self.archive_table_name is None:
+            return 0
+
+        def copy(cursor):
+            rows = cursor.execute(f'''
+                SELECT chat_id, CAST(chat_timestamp AS TEXT) AS chat_timestamp, chat_content, sender_id, to_id, message_type
+                FROM {self.chat_table_name} WHERE chat_timestamp < ? ORDER BY chat_id LIMIT ?
+            ''', (older_than.strftime("%Y-%m-%d %H:%M:%S"), batch_size)).fetchall()
+            for row in rows:
+                cursor.execute(f'''
+                    INSERT OR IGNORE INTO {self.archive_table_name}
+                    (chat_id, chat_timestamp, chat_content, sender_id, to_id, message_type)
+                    VALUES (?, ?, ?, ?, ?, ?)
+                ''', (row['chat_id'], row['chat_timestamp'], _compress(row['chat_content']), row['sender_id'],
+                      row['to_id'], row['message_type']))
+                # Already there if a previous run was interrupted before deleting it, and then already indexed
+                if cursor.rowcount:
+                    self._index_archived(cursor, [row])
+            return [row['chat_id'] for row in rows]
+
+        def delete(cursor):
+            cursor.executemany(f'DELETE FROM {self.chat_table_name} WHERE chat_id = ?',
+                               [(chat_id,) for chat_id in chat_ids])
+
+        # A commit spanning two WAL databases isn't atomic, so the messages are copied and then deleted.
+        # If that is interrupted they are in both tables until the next run finishes the move
+        chat_ids = self.db_adaptor.write(copy)
+        if chat_ids:
+            self.db_adaptor.write(delete)
+        return len(chat_ids)
+
+    def purge_archived_conversations(self) -> int:
+        # The foreign keys that remove a deleted user's live messages can't reach into another database
+        if self.archive_table_name is None:
+            return 0
+        with self.db_adaptor.get_connection() as conn:
+            rows = conn.execute(f'''
+                SELECT user_id FROM (
+                    SELECT DISTINCT sender_id AS user_id FROM {self.archive_table_name}
+                    UNION SELECT DISTINCT to_id FROM {self.archive_table_name}
                 )
-                for row in rows
-            ]
+                WHERE user_id NOT IN (SELECT user_id FROM {self.user_table_name})
+            ''').fetchall()
+        user_ids = [row['user_id'] for row in rows]
+
+        def purge(cursor):
+            for user_id in user_ids:
+                self._delete_archived(cursor, "(sender_id = ? AND to_id = -1) OR (sender_id = -1 AND to_id = ?)",
+                                      (user_id, user_id))
+
+        if user_ids:
+            self.db_adaptor.write(purge)
+        return len(user_ids)
+
+    def _index_archived(self, cursor, rows):
+        """Add archived messages to the archive's search index, the rows have their uncompressed content."""
+        cursor.executemany(f'''
+            INSERT INTO {self.archive_search_table_name} (rowid, chat_content, owner) VALUES (?, ?, ?)
+        ''', [(row['chat_id'], self._content(row['chat_content']), _owner(row)) for row in rows])
+
+    def _delete_archived(self, cursor, condition: str, parameters: tuple):
+        # The index is contentless, a row can only be taken out of it with the values it was indexed with
+        rows = cursor.execute(f'''
+            SELECT chat_id, chat_content, sender_id, to_id FROM {self.archive_table_name} WHERE {condition}
+        ''', parameters).fetchall()
+        fts = self.archive_search_table_name
+        cursor.executemany(f'''
+            INSERT INTO {fts} ({fts.split(".")[-1]}, rowid, chat_content, owner) VALUES ('delete', ?, ?, ?)
+        ''', [(row['chat_id'], self._content(row['chat_content']), _owner(row)) for row in rows])
+        cursor.execute(f'DELETE FROM {self.archive_table_name} WHERE {condition}', parameters)
+
+    @staticmethod
+    def _content(chat_content) -> str:
+        return zlib.decompress(chat_content).decode() if isinstance(chat_content, bytes) else chat_content
 
     def init_controller(self):
         super().init_controller()
         self.create_dummy_user()
-        with self.db_adaptor.get_connection() as conn:
-            cursor = conn.cursor()
-            # Chat Table (stores messages between the user and the chatbot)
-            cursor.execute(f'''
-                CREATE TABLE IF NOT EXISTS {self.chat_table_name} (
-                    chat_id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    chat_timestamp TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
-                    chat_content TEXT NOT NULL,
+        apply_migrations(self.db_adaptor, self.chat_table_name, CHAT_MIGRATIONS, self)
+        if self.archive_table_name is not None:
+            self._create_archive()
+
+    def _create_archive(self):
+        # Lives in its own database file, so it isn't versioned with the main schema
+        table = f"{self.chat_table_name}_archive"
+        with self.db_adaptor.get_write_connection() as conn:
+            indexed = conn.execute(f"SELECT 1 FROM {self.archive_schema}.sqlite_master WHERE name = ?",
+                                   (f"{table}_search",)).fetchone() is not None
+            conn.execute(f'''
+                CREATE TABLE IF NOT EXISTS {self.archive_table_name} (
+                    chat_id INTEGER PRIMARY KEY,
+                    chat_timestamp TIMESTAMP NOT NULL,
+                    chat_content BLOB NOT NULL, -- zlib compressed, or the plain text if that is shorter
                     sender_id INTEGER,
-                    to_id INTEGER, -- Points to either the user or chatbot
-                    message_type TEXT CHECK(message_type IN ('user', 'bot')),  -- To differentiate user and bot messages
-                    FOREIGN KEY (sender_id) REFERENCES {self.user_table_name}(user_id)
-                    ON DELETE CASCADE,
-                    FOREIGN KEY (to_id) REFERENCES {self.user_table_name}(user_id)
-                    ON DELETE CASCADE
+                    to_id INTEGER,
+                    message_type TEXT
+                )
+            ''')
+            conn.execute(f'''
+                CREATE INDEX IF NOT EXISTS {self.archive_schema}.{table}_conversation_id
+                ON {table} (sender_id, to_id, chat_id)
+            ''')
+            # Contentless, the archive keeps the text compressed and the index only needs its terms
+            conn.execute(f'''
+                CREATE VIRTUAL TABLE IF NOT EXISTS {self.archive_search_table_name} USING fts5(
+                    chat_content, owner, content='', tokenize='unicode61 remove_diacritics 2'
                 )
             ''')
+            if not indexed:
+                # An archive from before it was searchable
+                rows = conn.execute(f'''
+                    SELECT chat_id, chat_content, sender_id, to_id FROM {self.archive_table_name}
+                ''')
+                while batch := rows.fetchmany(1000):
+                    self._index_archived(conn, batch)
             conn.commit()
 
     def create_dummy_user(self):
-        with self.db_adaptor.get_connection() as conn:
+        with self.db_adaptor.get_write_connection() as conn:
             cursor = conn.cursor()
             cursor.execute(f'''
                 INSERT OR IGNORE INTO {self.user_table_name} (user_id, user_email, user_username, user_password, user_type)
@@ -113,19 +357,26 @@ class SQLite3ChatController(ChatDataController):
             conn.commit()
 
     def delete_chat_message(self, message_id: int):
-        with self.db_adaptor.get_connection() as conn:
+        with self.db_adaptor.get_write_connection() as conn:
             cursor = conn.cursor()
-            delete_query = f'DELETE FROM {self.chat_table_name} WHERE chat_id = ?'
-            cursor.execute(delete_query, (message_id,))
+            cursor.execute(f'DELETE FROM {self.chat_table_name} WHERE chat_id = ?', (message_id,))
+            if self.archive_table_name is not None:
+                self._delete_archived(cursor, "chat_id = ?", (message_id,))
             conn.commit()
 
     def shutdown_controller(self, testing=False):
         if testing:
-            with self.db_adaptor.get_connection() as conn:
+            with self.db_adaptor.get_write_connection() as conn:
                 cursor = conn.cursor()
                 try:
                     # Drop the user table
                     cursor.execute(f'DROP TABLE IF EXISTS {self.chat_table_name}')
+                    cursor.execute(f'DROP TABLE IF EXISTS {self.search_table_name}')
+                    cursor.execute(f'DROP VIEW IF EXISTS {self.search_table_name}_source')
+                    if self.archive_table_name is not None:
+                        cursor.execute(f'DROP TABLE IF EXISTS {self.archive_table_name}')
+                    reset_migrations(cursor, self.chat_table_name)
                     conn.commit()
                 except sqlite3.Error as e:
                     raise DBError(f"Failed to drop table {self.chat_table_name}: {e}")
+        self.chatbot_controller.shutdown_chatbot(testing)
@@ -0,0 +1,21 @@
+from db.sqlite.migrations import Migration
+
+
+def _create_responses(cursor, controller):
+    # IF NOT EXISTS adopts tables created before the cache was versioned
+    cursor.execute(f'''
+        CREATE TABLE IF NOT EXISTS {controller.table_name} (
+            prompt_key TEXT PRIMARY KEY,
+            response TEXT NOT NULL,
+            created_at REAL NOT NULL
+        ) WITHOUT ROWID
+    ''')
+    # The sweeper deletes expired answers by age
+    cursor.execute(f'''
+        CREATE INDEX IF NOT EXISTS {controller.table_name}_created_at ON {controller.table_name} (created_at)
+    ''')
+
+
+CHATBOT_CACHE_MIGRATIONS = [
+    Migration(1, "Keep chatbot answers by prompt", _create_responses),
+]
@@ -0,0 +1,116 @@
+"""
+Moves images stored flat in the upload directory into the content addressed layout.
+
+    python -m db.sqlite.image.migrate_storage [--config config.json] [--dry-run] [--remove-orphans]
+
+Safe to stop and re-run: every file is linked into its new place before its row is updated,
+and the old name is only removed once no row points at it any more.
+"""
+import argparse
+import json
+import os
+import shutil
+from pathlib import Path
+from typing import Dict
+
+from db.sqlite.image.migrations import IMAGE_MIGRATIONS
+from db.sqlite.image.sqlite3_image_controller import SQLite3ImageController
+from db.sqlite.image.util import get_image_hash
+from db.sqlite.migrations import apply_migrations
+from db.sqlite.sqlite_db_adaptor import SQLiteDBAdaptor
+from db.storage.content_addressed_image_storage import ContentAddressedImageStorage
+
+
+def _link_or_copy(source: Path, target: Path):
+    os.makedirs(target.parent, exist_ok=True)
+    try:
+        os.link(source, target)
+    except OSError:
+        temp_target = target.with_name(".migrate-" + target.name)
+        shutil.copy2(source, temp_target)
+        os.replace(temp_target, target)
+
+
+def migrate_storage(adaptor: SQLiteDBAdaptor, root: Path, dry_run: bool = False,
+                    remove_orphans: bool = False) -> Dict[str, int]:
+    storage = ContentAddressedImageStorage(root)
+    # Only used for its bookkeeping, so no classifier is needed
+    controller = SQLite3ImageController(adaptor, root, None, storage=storage)
+    counts = {"migrated": 0, "deduplicated": 0, "already_migrated": 0, "missing": 0, "orphans": 0}
+
+    # Makes sure the reference counting triggers exist before any row is moved
+    apply_migrations(adaptor, controller.image_table_name, IMAGE_MIGRATIONS, controller)
+    with adaptor.get_connection() as conn:
+        rows = conn.execute(f'SELECT image_id, image_name FROM {controller.image_table_name}').fetchall()
+
+    for row in rows:
+        image_name = row["image_name"]
+        if "/" in image_name:
+            counts["already_migrated"] += 1
+            continue
+        source = root / image_name
+        if not source.is_file():
+            counts["missing"] += 1
+            continue
+
+        extension = source.suffix.lstrip(".")
+        relative_path = storage.relative_path_for(get_image_hash(source), extension)
+        target = storage.path_for(relative_path)
+        counts["deduplicated" if target.exists() else "migrated"] += 1
+        if dry_run:
+            continue
+
+        if not target.exists():
+            _link_or_copy(source, target)
+        with adaptor.get_write_connection() as conn:
+            # The reference count triggers move the row's count over to the new path
+            conn.execute(f'UPDATE {controller.image_table_name} SET image_name = ? WHERE image_id = ?',
+                         (relative_path, row["image_id"]))
+            conn.commit()
+
+    if not dry_run:
+        controller.reclaim_unreferenced_files()
+
+    # Anything left directly in the upload directory isn't referenced by any row
+    with adaptor.get_connection() as conn:
+        referenced = {row["image_name"] for row in
+                      conn.execute(f'SELECT image_name FROM {controller.image_table_name}').fetchall()}
+    for path in root.iterdir():
+        if path.is_file() and not path.name.startswith(".") and path.name not in referenced:
+            counts["orphans"] += 1
+            if remove_orphans and not dry_run:
+                os.remove(path)
+
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--config", default="config.json", help="Path to the server's config.json")
+    parser.add_argument("--dry-run", action="store_true", help="Only report what would be done")
+    parser.add_argument("--remove-orphans", action="store_true",
+                        help="Also delete files in the upload directory that no image row points at")
+    args = parser.parse_args()
+
+    config_path = Path(args.config).resolve()
+    with open(config_path) as f:
+        config = json.load(f)
+
+    # Relative paths in the config are relative to the server's root, where config.json lives
+    root = config_path.parent
+    db = config["DATABASE"]
+    adaptor = SQLiteDBAdaptor(
+        db_filename=str(root / db["SQLITE"]["DB_FILENAME"]),
+        user_table_name=db["USERS_TABLE_NAME"],
+        chat_table_name=db["CHAT_TABLE_NAME"],
+        image_table_name=db["IMAGES_TABLE_NAME"]
+    )
+    upload_directory = root / config["MODULES"]["IMAGE_UPLOAD"]["UPLOAD_DIRECTORY"]
+
+    counts = migrate_storage(adaptor, upload_directory, args.dry_run, args.remove_orphans)
+    for name, count in counts.items():
+        print(f"{name}: {count}")
+
+
+if __name__ == "__main__":
+    main()
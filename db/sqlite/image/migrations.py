@@ -0,0 +1,139 @@
+from db.sqlite.migrations import Migration
+
+
+def _create_images(cursor, controller):
+    # IF NOT EXISTS adopts databases created before migrations were tracked
+    cursor.execute(f'''
+        CREATE TABLE IF NOT EXISTS {controller.image_table_name} (
+            image_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            image_name INTEGER,
+            image_width INTEGER,
+            image_height INTEGER,
+            image_hash TEXT UNIQUE,
+            image_mime TEXT,
+            user_id INTEGER,
+            classified_as TEXT,  -- New column for classification category
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,  -- New timestamp column
+            FOREIGN KEY (user_id) REFERENCES {controller.user_table_name}(user_id)
+            ON DELETE CASCADE
+        )
+    ''')
+
+
+def _create_classification_cache(cursor, controller):
+    # Classification results by content, these outlive the image rows they were made for
+    cursor.execute(f'''
+        CREATE TABLE IF NOT EXISTS {controller.classification_table_name} (
+            image_hash TEXT NOT NULL,
+            model_id TEXT NOT NULL,
+            label TEXT NOT NULL,
+            scores TEXT NOT NULL,  -- JSON object of label to probability
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (image_hash, model_id)
+        )
+    ''')
+
+
+def _create_classification_jobs(cursor, controller):
+    # Durable queue for background classification
+    cursor.execute(f'''
+        CREATE TABLE IF NOT EXISTS {controller.job_table_name} (
+            job_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            image_id INTEGER NOT NULL UNIQUE,
+            user_id INTEGER NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending' CHECK(status IN ('pending', 'running', 'done', 'failed')),
+            attempts INTEGER NOT NULL DEFAULT 0,
+            error TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (image_id) REFERENCES {controller.image_table_name}(image_id)
+            ON DELETE CASCADE
+        )
+    ''')
+
+
+def _create_file_reference_counts(cursor, controller):
+    # How many image rows point at each stored file. Kept up to date by triggers, so deletes
+    # cascading from the user table are counted too. While image_hash is UNIQUE a content addressed
+    # file has at most one row, the count keeps reclaiming right should that ever be relaxed
+    cursor.execute(f'''
+        CREATE TABLE IF NOT EXISTS {controller.file_table_name} (
+            relative_path TEXT PRIMARY KEY,
+            refcount INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+    cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS {controller.file_table_name}_insert AFTER INSERT ON {controller.image_table_name}
+        BEGIN
+            INSERT INTO {controller.file_table_name} (relative_path, refcount) VALUES (NEW.image_name, 1)
+            ON CONFLICT (relative_path) DO UPDATE SET refcount = refcount + 1;
+        END
+    ''')
+    cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS {controller.file_table_name}_delete AFTER DELETE ON {controller.image_table_name}
+        BEGIN
+            UPDATE {controller.file_table_name} SET refcount = refcount - 1 WHERE relative_path = OLD.image_name;
+        END
+    ''')
+    cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS {controller.file_table_name}_update
+        AFTER UPDATE OF image_name ON {controller.image_table_name}
+        WHEN OLD.image_name IS NOT NEW.image_name
+        BEGIN
+            UPDATE {controller.file_table_name} SET refcount = refcount - 1 WHERE relative_path = OLD.image_name;
+            INSERT INTO {controller.file_table_name} (relative_path, refcount) VALUES (NEW.image_name, 1)
+            ON CONFLICT (relative_path) DO UPDATE SET refcount = refcount + 1;
+        END
+    ''')
+    # Count files of rows stored before reference counting existed
+    cursor.execute(f'''
+        INSERT INTO {controller.file_table_name} (relative_path, refcount)
+        SELECT image_name, COUNT(*) FROM {controller.image_table_name}
+        WHERE image_name NOT IN (SELECT relative_path FROM {controller.file_table_name})
+        GROUP BY image_name
+    ''')
+
+
+def _index_hot_paths(cursor, controller):
+    # A user's latest image
+    cursor.execute(f'''
+        CREATE INDEX IF NOT EXISTS {controller.image_table_name}_user_created
+        ON {controller.image_table_name} (user_id, created_at)
+    ''')
+    # Workers pick the oldest pending job
+    cursor.execute(f'''
+        CREATE INDEX IF NOT EXISTS {controller.job_table_name}_status
+        ON {controller.job_table_name} (status, job_id)
+    ''')
+
+
+def _index_classified_images(cursor, controller):
+    # Image listings filtered by label
+    cursor.execute(f'''
+        CREATE INDEX IF NOT EXISTS {controller.image_table_name}_user_classified_created
+        ON {controller.image_table_name} (user_id, classified_as, created_at)
+    ''')
+
+
+def _delay_classification_retries(cursor, controller):
+    # A failed job is not claimed again before next_attempt_at (unix time)
+    cursor.execute(f'''
+        ALTER TABLE {controller.job_table_name} ADD COLUMN next_attempt_at REAL NOT NULL DEFAULT 0
+    ''')
+    # Workers pick the oldest pending job that is due
+    cursor.execute(f"DROP INDEX IF EXISTS {controller.job_table_name}_status")
+    cursor.execute(f'''
+        CREATE INDEX IF NOT EXISTS {controller.job_table_name}_status_due
+        ON {controller.job_table_name} (status, next_attempt_at, job_id)
+    ''')
+
+
+IMAGE_MIGRATIONS = [
+    Migration(1, "Create the image table", _create_images),
+    Migration(2, "Cache classifications by image hash and model", _create_classification_cache),
+    Migration(3, "Queue background classification jobs", _create_classification_jobs),
+    Migration(4, "Count references to stored files", _create_file_reference_counts),
+    Migration(5, "Index images by user and upload time, jobs by status", _index_hot_paths),
+    Migration(6, "Index images by user, label and upload time", _index_classified_images),
+    Migration(7, "Delay retries of failed classification jobs", _delay_classification_retries),
+]
@@ -1,81 +1,89 @@
+import json
 import sqlite3
 from pathlib import Path
-from typing import Optional
+from typing import Optional, List, Tuple, Dict, Any, Callable
 
 from classifiers.image_classifier import ImageClassifier
+from classifiers.prediction import Prediction
 from db.image_data_controller import ImageDataController
+from db.sqlite.image.migrations import IMAGE_MIGRATIONS
+from db.sqlite.migrations import apply_migrations, reset_migrations
 from db.sqlite.sqlite_db_adaptor import SQLiteDBAdaptor
+from db.types.classification_job import ClassificationJob
 from db.types.exceptions.db_error import DBError
 from db.types.image import Image
 from db.types.user.user_container import UserContainer
 
 
+# Image listing field -> column
+IMAGE_LIST_COLUMNS = {
+    "id": "image_id",
+    "width": "image_width",
+    "height": "image_height",
+    "mime": "image_mime",
+    "classified_as": "classified_as",
+    "hash": "image_hash",
+    # Kept as stored, so it can be handed back as a cursor
+    "created_at": "CAST(created_at AS TEXT)",
+}
+
+
 class SQLite3ImageController(ImageDataController):
 
 
-    def __init__(self, sqlite_adaptor: SQLiteDBAdaptor, image_folder_path: Path, classifier: ImageClassifier):
-        super().__init__(sqlite_adaptor, image_folder_path, classifier)
+    def __init__(self, sqlite_adaptor: SQLiteDBAdaptor, image_folder_path: Path, classifier: ImageClassifier, **kwargs):
+        super().__init__(sqlite_adaptor, image_folder_path, classifier, **kwargs)
         self.image_folder_path = image_folder_path
         self.image_table_name = sqlite_adaptor.image_table_name
         self.user_table_name = sqlite_adaptor.user_table_name
+        self.classification_table_name = f"{self.image_table_name}_classifications"
+        self.job_table_name = f"{self.image_table_name}_classification_jobs"
+        self.file_table_name = f"{self.image_table_name}_files"
 
     def init_controller(self):
+        apply_migrations(self.db_adaptor, self.image_table_name, IMAGE_MIGRATIONS, self)
         super().init_controller()
-        with self.db_adaptor.get_connection() as conn:
-            cursor = conn.cursor()
-            cursor.execute(f'''
-                CREATE TABLE IF NOT EXISTS {self.image_table_name} (
-                    image_id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    image_name INTEGER,
-                    image_width INTEGER,
-                    image_height INTEGER,
-                    image_hash TEXT UNIQUE,
-                    image_mime TEXT,
-                    user_id INTEGER,
-                    classified_as TEXT,  -- New column for classification category
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,  -- New timestamp column
-                    FOREIGN KEY (user_id) REFERENCES {self.user_table_name}(user_id)
-                    ON DELETE CASCADE
-                )
-            ''')
-            conn.commit()
 
-    def _save_image_to_db(self, image_filename, image_width, image_height, image_hash, image_mime, user: UserContainer) -> Image:
-        try:
-            with self.db_adaptor.get_connection() as conn:
-                cursor = conn.cursor()
+    def _save_image_to_db(self, image_filename, image_width, image_height, image_hash, image_mime, user: UserContainer,
+                          ensure_stored: Optional[Callable[[], None]] = None) -> Image:
+        def save(cursor):
+            if ensure_stored is not None:
+                ensure_stored()
+            # Check if a row for this user already exists
+            query_check = f'''
+                SELECT image_id FROM {self.image_table_name} WHERE user_id = ? AND image_hash = ?
+            '''
+            cursor.execute(query_check, (user.id, image_hash))
+            row = cursor.fetchone()
+            unique = row is None
 
-                # Check if a row for this user already exists
-                query_check = f'''
-                    SELECT image_id FROM {self.image_table_name} WHERE user_id = ? AND image_hash = ?
+            if not unique:
+                # Update the existing row
+                image_id = row[0]  # Retrieve the ID of the existing image
+                self._update_image_basics(cursor, image_id, image_filename, image_width, image_height, image_hash, image_mime)
+            else:
+                # Insert a new row
+                query_insert = f'''
+                    INSERT INTO {self.image_table_name} 
+                    (image_name, image_width, image_height, image_hash, image_mime, classified_as, user_id) 
+                    VALUES (?, ?, ?, ?, ?, ?, ?)
                 '''
-                cursor.execute(query_check, (user.id, image_hash))
-                row = cursor.fetchone()
-                unique = row is None
-
-                if not unique:
-                    # Update the existing row
-                    self._update_image_basics(cursor, image_filename, image_width, image_height, image_hash, image_mime, user.id)
-                    image_id = row[0]  # Retrieve the ID of the existing image
-                else:
-                    # Insert a new row
-                    query_insert = f'''
-                        INSERT INTO {self.image_table_name} 
-                        (image_name, image_width, image_height, image_hash, image_mime, classified_as, user_id) 
-                        VALUES (?, ?, ?, ?, ?, ?, ?)
-                    '''
-                    cursor.execute(query_insert, (image_filename, image_width, image_height, image_hash, image_mime, None, user.id))
-                    image_id = cursor.lastrowid
-
-                conn.commit()
-                return Image(image_id, image_filename, image_width, image_height, image_mime, image_hash, unique)
+                cursor.execute(query_insert, (image_filename, image_width, image_height, image_hash, image_mime, None, user.id))
+                image_id = cursor.lastrowid
+
+            return Image(image_id, image_filename, image_width, image_height, image_mime, None, unique, image_hash)
 
+        try:
+            return self.db_adaptor.write(save)
         except sqlite3.IntegrityError as e:
-            # Handle database integrity errors if needed
+            # Someone else stored the same image first, hand back their row so it can still be classified
+            existing_image = self._get_image_from_db_by_hash(image_hash)
+            if existing_image is not None:
+                return existing_image.copy_with_not_unique()
             image_id = None  # Assign a default or error value
-            return Image(image_id, image_filename, image_width, image_height, image_mime, image_hash, False)
+            return Image(image_id, image_filename, image_width, image_height, image_mime, None, False, image_hash)
 
-    def _update_image_basics(self, cursor, image_filename, image_width, image_height, image_hash, image_mime, user_id):
+    def _update_image_basics(self, cursor, image_id, image_filename, image_width, image_height, image_hash, image_mime):
         query_update = f'''
             UPDATE {self.image_table_name}
             SET 
@@ -84,22 +92,45 @@ class SQLite3ImageController(ImageDataController):
                 image_height = ?, 
                 image_hash = ?, 
                 image_mime = ?
-            WHERE user_id = ?
+            WHERE image_id = ?
         '''
-        cursor.execute(query_update, (image_filename, image_width, image_height, image_hash, image_mime, user_id))
+        cursor.execute(query_update, (image_filename, image_width, image_height, image_hash, image_mime, image_id))
 
     def _update_classified_as(self, image_id, classified_as):
-        with self.db_adaptor.get_connection() as conn:
-            cursor = conn.cursor()
+        def update(cursor):
             query = f'UPDATE {self.image_table_name} SET classified_as = ? WHERE image_id = ?'
             cursor.execute(query, (classified_as, image_id))
-            conn.commit()
             return cursor.rowcount > 0  # Returns True if a row was updated
 
-    def _update_image_db(self, image_id, image_filename, image_width, image_height, image_hash, image_mime, user_id) -> Optional[str]:
+        return self.db_adaptor.write(update)
+
+    def _list_images(self, user: UserContainer, limit: int, after: Optional[Tuple[str, int]],
+                     classified_as: Optional[str], fields: List[str]) -> List[Dict[str, Any]]:
+        selected = dict.fromkeys(["id", "created_at"] + fields)
+        columns = ", ".join(f'{IMAGE_LIST_COLUMNS[field]} AS "{field}"' for field in selected)
+        conditions = ["user_id = ?"]
+        parameters = [user.id]
+        if classified_as is not None:
+            conditions.append("classified_as = ?")
+            parameters.append(classified_as)
+        if after is not None:
+            conditions.append("(created_at, image_id) < (?, ?)")
+            parameters.extend(after)
+        # A range scan of the (user_id[, classified_as], created_at) index, newest first
+        query = f'''
+            SELECT {columns} FROM {self.image_table_name}
+            WHERE {" AND ".join(conditions)}
+            ORDER BY created_at DESC, image_id DESC
+            LIMIT ?
+        '''
         with self.db_adaptor.get_connection() as conn:
+            rows = conn.execute(query, parameters + [limit]).fetchall()
+        return [dict(row) for row in rows]
+
+    def _update_image_db(self, image_id, image_filename, image_width, image_height, image_hash, image_mime, user_id) -> Optional[str]:
+        with self.db_adaptor.get_write_connection() as conn:
             cursor = conn.cursor()
-            self._update_image_basics(cursor, image_filename, image_width, image_height, image_hash, image_mime, user_id)
+            self._update_image_basics(cursor, image_id, image_filename, image_width, image_height, image_hash, image_mime)
         return True
 
     def _get_image_from_db(self, column, value) -> Optional[Image]:
@@ -110,7 +141,8 @@ class SQLite3ImageController(ImageDataController):
             conn.commit()
             if row is None:  # Check if no result was returned
                 return None  # Return None or handle this case as needed
-            return Image(row["IMAGE_ID"], row["IMAGE_NAME"], row["IMAGE_WIDTH"], row["IMAGE_HEIGHT"], row["IMAGE_MIME"], row["CLASSIFIED_AS"])
+            return Image(row["IMAGE_ID"], row["IMAGE_NAME"], row["IMAGE_WIDTH"], row["IMAGE_HEIGHT"], row["IMAGE_MIME"], row["CLASSIFIED_AS"],
+                         image_hash=row["IMAGE_HASH"])
 
     def _get_image_from_db_id(self, image_id: int) -> Optional[Image]:
         return self._get_image_from_db("image_id", image_id)
@@ -121,20 +153,131 @@ class SQLite3ImageController(ImageDataController):
     def _get_image_from_db_by_hash(self, image_hash: str) -> Optional[Image]:
         return self._get_image_from_db("image_hash", image_hash)
 
-    def delete_image(self, image_id: int):
+    def _get_cached_classification(self, image_hash: str, model_id: str) -> Optional[Prediction]:
         with self.db_adaptor.get_connection() as conn:
             cursor = conn.cursor()
-            user_query = f'DELETE FROM {self.image_table_name} WHERE image_id = ?'
-            cursor.execute(user_query, (image_id,))
+            query = f'SELECT label, scores FROM {self.classification_table_name} WHERE image_hash = ? AND model_id = ?'
+            row = cursor.execute(query, (image_hash, model_id)).fetchone()
+            if row is None:
+                return None
+            return Prediction(row["label"], json.loads(row["scores"]))
+
+    def _save_cached_classification(self, image_hash: str, model_id: str, prediction: Prediction):
+        with self.db_adaptor.get_write_connection() as conn:
+            cursor = conn.cursor()
+            query = f'''
+                INSERT OR REPLACE INTO {self.classification_table_name} 
+                (image_hash, model_id, label, scores) 
+                VALUES (?, ?, ?, ?)
+            '''
+            cursor.execute(query, (image_hash, model_id, prediction.label, json.dumps(prediction.scores)))
+            conn.commit()
+
+    def _invalidate_classification_cache(self, current_model_id: str):
+        with self.db_adaptor.get_write_connection() as conn:
+            cursor = conn.cursor()
+            query = f'DELETE FROM {self.classification_table_name} WHERE model_id != ?'
+            cursor.execute(query, (current_model_id,))
+            conn.commit()
+
+    def _enqueue_classification_job(self, image_id: int, user_id: int):
+        with self.db_adaptor.get_write_connection() as conn:
+            cursor = conn.cursor()
+            # Re-queueing an image whose job has finished starts it again, a pending or running job is left
+            # alone so it isn't claimed twice and keeps its attempts
+            query = f'''
+                INSERT INTO {self.job_table_name} (image_id, user_id) VALUES (?, ?)
+                ON CONFLICT (image_id) DO UPDATE SET
+                    status = 'pending', attempts = 0, error = NULL, next_attempt_at = 0,
+                    updated_at = CURRENT_TIMESTAMP
+                WHERE status IN ('done', 'failed')
+            '''
+            cursor.execute(query, (image_id, user_id))
+            conn.commit()
+
+    def _claim_classification_job(self, now: float) -> Optional[ClassificationJob]:
+        with self.db_adaptor.get_write_connection() as conn:
+            cursor = conn.cursor()
+            query = f'''
+                UPDATE {self.job_table_name}
+                SET status = 'running', attempts = attempts + 1, updated_at = CURRENT_TIMESTAMP
+                WHERE job_id = (
+                    SELECT job_id FROM {self.job_table_name}
+                    WHERE status = 'pending' AND next_attempt_at <= ?
+                    ORDER BY next_attempt_at, job_id LIMIT 1
+                )
+                RETURNING job_id, image_id, user_id, attempts
+            '''
+            row = cursor.execute(query, (now,)).fetchone()
+            conn.commit()
+            if row is None:
+                return None
+            return ClassificationJob(row["job_id"], row["image_id"], row["user_id"], row["attempts"])
+
+    def _finish_classification_job(self, job_id: int, status: str, error: Optional[str], next_attempt_at: float):
+        with self.db_adaptor.get_write_connection() as conn:
+            cursor = conn.cursor()
+            query = f'''
+                UPDATE {self.job_table_name}
+                SET status = ?, error = ?, next_attempt_at = ?, updated_at = CURRENT_TIMESTAMP
+                WHERE job_id = ?
+            '''
+            cursor.execute(query, (status, error, next_attempt_at, job_id))
+            conn.commit()
+
+    def _reset_running_classification_jobs(self):
+        with self.db_adaptor.get_write_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(f"UPDATE {self.job_table_name} SET status = 'pending' WHERE status = 'running'")
+            conn.commit()
+
+    def _get_classification_job_status(self, image_id: int) -> Optional[str]:
+        with self.db_adaptor.get_connection() as conn:
+            cursor = conn.cursor()
+            row = cursor.execute(f'SELECT status FROM {self.job_table_name} WHERE image_id = ?', (image_id,)).fetchone()
+            return row["status"] if row else None
+
+    def _delete_image_from_db(self, image_id: int) -> Optional[str]:
+        with self.db_adaptor.get_write_connection() as conn:
+            cursor = conn.cursor()
+            query = f'DELETE FROM {self.image_table_name} WHERE image_id = ? RETURNING image_name'
+            row = cursor.execute(query, (image_id,)).fetchone()
+            conn.commit()
+            return row["image_name"] if row else None
+
+    def _remove_unreferenced_files(self, relative_paths: Optional[List[str]],
+                                   remove: Callable[[str], None]) -> List[str]:
+        with self.db_adaptor.get_write_connection() as conn:
+            cursor = conn.cursor()
+            if relative_paths is None:
+                query = f'DELETE FROM {self.file_table_name} WHERE refcount <= 0 RETURNING relative_path'
+                unreferenced = [row["relative_path"] for row in cursor.execute(query).fetchall()]
+            else:
+                unreferenced = []
+                for relative_path in relative_paths:
+                    row = cursor.execute(f'SELECT refcount FROM {self.file_table_name} WHERE relative_path = ?',
+                                         (relative_path,)).fetchone()
+                    # A file without a row was written but never made it into the images table
+                    if row is None or row["refcount"] <= 0:
+                        cursor.execute(f'DELETE FROM {self.file_table_name} WHERE relative_path = ?', (relative_path,))
+                        unreferenced.append(relative_path)
             conn.commit()
+            # Still holding the writer, an upload of the same content only adds its row once this is done
+            for relative_path in unreferenced:
+                remove(relative_path)
+            return unreferenced
 
     def shutdown_controller(self, testing=False):
         if testing:
-            with self.db_adaptor.get_connection() as conn:
+            with self.db_adaptor.get_write_connection() as conn:
                 cursor = conn.cursor()
                 try:
-                    # Drop the user table
+                    # Drop the image tables
+                    cursor.execute(f'DROP TABLE IF EXISTS {self.job_table_name}')
                     cursor.execute(f'DROP TABLE IF EXISTS {self.image_table_name}')
+                    cursor.execute(f'DROP TABLE IF EXISTS {self.file_table_name}')
+                    cursor.execute(f'DROP TABLE IF EXISTS {self.classification_table_name}')
+                    reset_migrations(cursor, self.image_table_name)
                     conn.commit()
                 except sqlite3.Error as e:
                     raise DBError(f"Failed to drop table {self.image_table_name}: {e}")
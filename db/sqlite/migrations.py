@@ -0,0 +1,75 @@
+import sqlite3
+from dataclasses import dataclass
+from typing import Callable, List, Any
+
+from db.sqlite.sqlite_db_adaptor import SQLiteDBAdaptor
+from db.types.exceptions.db_error import DBError
+
+SCHEMA_VERSION_TABLE = "schema_version"
+
+
+@dataclass(frozen=True)
+class Migration:
+    """
+    One step of a component's schema. `apply` gets a cursor inside the migration's transaction and
+    the controller the schema belongs to, for its table names.
+    """
+    version: int
+    description: str
+    apply: Callable[[sqlite3.Cursor, Any], None]
+
+
+def _create_version_table(cursor: sqlite3.Cursor):
+    cursor.execute(f'''
+        CREATE TABLE IF NOT EXISTS {SCHEMA_VERSION_TABLE} (
+            component TEXT PRIMARY KEY,
+            version INTEGER NOT NULL,
+            description TEXT,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+
+def get_schema_version(cursor: sqlite3.Cursor, component: str) -> int:
+    row = cursor.execute(f'SELECT version FROM {SCHEMA_VERSION_TABLE} WHERE component = ?', (component,)).fetchone()
+    return row["version"] if row else 0
+
+
+def apply_migrations(adaptor: SQLiteDBAdaptor, component: str, migrations: List[Migration], controller) -> int:
+    """
+    Bring `component` up to its newest migration and return the version it ends up at.
+    Every migration runs in its own transaction together with the version bump, so a failed one
+    leaves the schema at the previous version and is tried again on the next start.
+    """
+    with adaptor.get_write_connection() as conn:
+        cursor = conn.cursor()
+        _create_version_table(cursor)
+        conn.commit()
+        version = get_schema_version(cursor, component)
+        for migration in sorted(migrations, key=lambda m: m.version):
+            if migration.version <= version:
+                continue
+            # Immediate, so another process starting up at the same time waits instead of applying it twice
+            cursor.execute("BEGIN IMMEDIATE")
+            try:
+                if get_schema_version(cursor, component) >= migration.version:
+                    conn.rollback()
+                    continue
+                migration.apply(cursor, controller)
+                cursor.execute(f'''
+                    INSERT INTO {SCHEMA_VERSION_TABLE} (component, version, description) VALUES (?, ?, ?)
+                    ON CONFLICT (component) DO UPDATE SET
+                        version = excluded.version, description = excluded.description, updated_at = CURRENT_TIMESTAMP
+                ''', (component, migration.version, migration.description))
+                conn.commit()
+            except sqlite3.Error as e:
+                conn.rollback()
+                raise DBError(f"Migration {migration.version} of {component} failed: {e}") from e
+            version = migration.version
+    return version
+
+
+def reset_migrations(cursor: sqlite3.Cursor, component: str):
+    """Forget the component's version, for when its tables have been dropped."""
+    _create_version_table(cursor)
+    cursor.execute(f'DELETE FROM {SCHEMA_VERSION_TABLE} WHERE component = ?', (component,))
@@ -1,20 +1,226 @@
 import sqlite3
+import threading
+import time
+from concurrent.futures import Future
+from queue import LifoQueue, Empty
 from sqlite3 import PARSE_DECLTYPES, PARSE_COLNAMES
+from typing import Dict, Optional
 
+from app.exceptions.service_unavailable import ServiceUnavailable
 from db.db_adaptor import DBAdaptor
+from db.sqlite.write_queue import SQLiteWriteQueue, WriteOperation
+
+# Applied to every connection when it is opened, see https://www.sqlite.org/pragma.html
+DEFAULT_PRAGMAS = {
+    "JOURNAL_MODE": "WAL",
+    "SYNCHRONOUS": "NORMAL",
+    "MMAP_SIZE": 0,
+    "CACHE_SIZE": -2000,
+    "BUSY_TIMEOUT": 5000,
+}
+
+
+class _ConnectionLease:
+    """
+    Hands out a connection for one `with` block. Like a plain sqlite3 connection the block is committed,
+    or rolled back if it raised, and the connection then goes back to where it came from.
+    """
+
+    def __init__(self, acquire, release):
+        self._acquire = acquire
+        self._release = release
+        self._connection: Optional[sqlite3.Connection] = None
+
+    def __enter__(self) -> sqlite3.Connection:
+        self._connection = self._acquire()
+        return self._connection
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        connection, self._connection = self._connection, None
+        try:
+            connection.__exit__(exc_type, exc_value, traceback)
+        finally:
+            self._release(connection)
+        return False
 
 
 class SQLiteDBAdaptor(DBAdaptor):
+    """
+    Readers share a bounded pool of connections (or get a fresh one each time with a pool size of 0),
+    writers take turns on a single connection so they never fight each other over the database lock.
+    """
 
-    def __init__(self, db_filename: str, **kwargs):
+    def __init__(self, db_filename: str, pool_size: int = 0, pool_timeout: float = 5.0,
+                 pragmas: Optional[Dict[str, object]] = None, write_queue: Optional[Dict[str, float]] = None,
+                 attached: Optional[Dict[str, str]] = None, **kwargs):
         # These can be optional. Check beforehand!
         self.user_table_name = kwargs.get("user_table_name")
         self.chat_table_name = kwargs.get("chat_table_name")
         self.image_table_name = kwargs.get("image_table_name")
         self.db_file_name = db_filename
+        self.pool_size = max(0, pool_size)
+        self.pool_timeout = pool_timeout
+        self.pragmas = {**DEFAULT_PRAGMAS, **(pragmas or {})}
+        # Schema name -> database file, attached to every connection
+        self.attached = dict(attached or {})
+        self._idle: LifoQueue = LifoQueue()
+        self._slots = threading.BoundedSemaphore(self.pool_size) if self.pool_size else None
+        self._writer: Optional[sqlite3.Connection] = None
+        # Not re-entrant, a nested block's commit or rollback would end the outer block's transaction
+        self._writer_lock = threading.Lock()
+        self._writer_owner: Optional[int] = None
+        self._stats_lock = threading.Lock()
+        self._stats = {"opened": 0, "in_use": 0, "waits": 0, "wait_seconds": 0.0, "timeouts": 0,
+                       "writer_waits": 0, "writer_wait_seconds": 0.0}
+        self._write_queue = None
+        if write_queue is not None:
+            self._write_queue = SQLiteWriteQueue(
+                self.get_write_connection,
+                max_batch_size=write_queue.get("MAX_BATCH_SIZE", 64),
+                max_wait=write_queue.get("MAX_WAIT_MS", 2) / 1000,
+                synchronous=self.pragmas["SYNCHRONOUS"]
+            )
 
     def get_connection(self):
-        conn = sqlite3.connect(self.db_file_name, detect_types=PARSE_DECLTYPES | PARSE_COLNAMES)
+        """A read connection for a `with` block, reads that turn into writes should use get_write_connection."""
+        return _ConnectionLease(self._acquire_reader, self._release_reader)
+
+    def get_write_connection(self):
+        """The single writer connection for a `with` block, held exclusively until the block ends."""
+        return _ConnectionLease(self._acquire_writer, self._release_writer)
+
+    def submit_write(self, operation: WriteOperation, durable: bool = False) -> Future:
+        """
+        Run `operation` with a cursor on the writer connection. With the write queue on it is committed together
+        with other writes, the future resolves once that has happened. `durable` writes are synced to disk
+        before their future resolves.
+        """
+        if self._write_queue is not None:
+            return self._write_queue.submit(operation, durable)
+
+        future = Future()
+        try:
+            with self.get_write_connection() as conn:
+                if durable:
+                    conn.execute("PRAGMA synchronous = FULL")
+                try:
+                    result = operation(conn.cursor())
+                    conn.commit()
+                finally:
+                    if durable:
+                        conn.execute(f"PRAGMA synchronous = {self.pragmas['SYNCHRONOUS']}")
+        except Exception as e:
+            future.set_exception(e)
+        else:
+            future.set_result(result)
+        return future
+
+    def write(self, operation: WriteOperation, durable: bool = False):
+        """Like submit_write, but waits for the commit and returns what the operation returned."""
+        return self.submit_write(operation, durable).result()
+
+    def stats(self) -> Dict[str, float]:
+        with self._stats_lock:
+            stats = dict(self._stats)
+        stats["pool_size"] = self.pool_size
+        stats["idle"] = self._idle.qsize()
+        if self._write_queue is not None:
+            stats.update(self._write_queue.stats())
+        return stats
+
+    def close(self):
+        """Stop the write queue and close every idle connection, reads open new ones if it is used again."""
+        if self._write_queue is not None:
+            self._write_queue.stop()
+            self._write_queue = None
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except Empty:
+                break
+        with self._writer_lock:
+            if self._writer is not None:
+                self._writer.close()
+                self._writer = None
+
+    def _open(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.db_file_name, detect_types=PARSE_DECLTYPES | PARSE_COLNAMES,
+                               check_same_thread=False)
+        # Busy timeout first, switching the journal mode needs the lock
+        conn.execute(f"PRAGMA busy_timeout = {int(self.pragmas['BUSY_TIMEOUT'])}")
+        conn.execute(f"PRAGMA journal_mode = {self.pragmas['JOURNAL_MODE']}")
+        for schema, filename in self.attached.items():
+            conn.execute("ATTACH DATABASE ? AS " + schema, (filename,))
+            conn.execute(f"PRAGMA {schema}.journal_mode = {self.pragmas['JOURNAL_MODE']}")
+        conn.execute(f"PRAGMA synchronous = {self.pragmas['SYNCHRONOUS']}")
+        conn.execute(f"PRAGMA mmap_size = {int(self.pragmas['MMAP_SIZE'])}")
+        conn.execute(f"PRAGMA cache_size = {int(self.pragmas['CACHE_SIZE'])}")
         conn.execute("PRAGMA foreign_keys = ON")
         conn.row_factory = sqlite3.Row
-        return conn
\ No newline at end of file
+        with self._stats_lock:
+            self._stats["opened"] += 1
+        return conn
+
+    def _acquire_reader(self) -> sqlite3.Connection:
+        if self._slots is not None:
+            if not self._slots.acquire(blocking=False):
+                start = time.monotonic()
+                acquired = self._slots.acquire(timeout=self.pool_timeout)
+                with self._stats_lock:
+                    self._stats["waits"] += 1
+                    self._stats["wait_seconds"] += time.monotonic() - start
+                    if not acquired:
+                        self._stats["timeouts"] += 1
+                if not acquired:
+                    raise ServiceUnavailable("No database connection available")
+        with self._stats_lock:
+            self._stats["in_use"] += 1
+        try:
+            return self._idle.get_nowait()
+        except Empty:
+            pass
+        try:
+            return self._open()
+        except BaseException:
+            self._release_slot()
+            raise
+
+    def _release_reader(self, conn: sqlite3.Connection):
+        if self._slots is None or conn.in_transaction:
+            conn.close()
+        else:
+            self._idle.put(conn)
+        self._release_slot()
+
+    def _release_slot(self):
+        with self._stats_lock:
+            self._stats["in_use"] -= 1
+        if self._slots is not None:
+            self._slots.release()
+
+    def _acquire_writer(self) -> sqlite3.Connection:
+        if self._writer_owner == threading.get_ident():
+            # Waiting would never end, say so instead
+            raise RuntimeError("This thread already holds the writer connection, writes can't be nested")
+        if not self._writer_lock.acquire(blocking=False):
+            start = time.monotonic()
+            self._writer_lock.acquire()
+            with self._stats_lock:
+                self._stats["writer_waits"] += 1
+                self._stats["writer_wait_seconds"] += time.monotonic() - start
+        try:
+            if self._writer is None:
+                self._writer = self._open()
+        except BaseException:
+            self._writer_lock.release()
+            raise
+        self._writer_owner = threading.get_ident()
+        return self._writer
+
+    def _release_writer(self, conn: sqlite3.Connection):
+        if conn.in_transaction:
+            # Left half done by something that bypassed commit and rollback, don't reuse it
+            conn.close()
+            self._writer = None
+        self._writer_owner = None
+        self._writer_lock.release()
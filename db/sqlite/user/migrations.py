@@ -0,0 +1,19 @@
+from db.sqlite.migrations import Migration
+
+
+def _create_users(cursor, controller):
+    # IF NOT EXISTS adopts databases created before migrations were tracked
+    cursor.execute(f'''
+        CREATE TABLE IF NOT EXISTS {controller.user_table_name} (
+            user_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_username TEXT NOT NULL UNIQUE,
+            user_email TEXT NOT NULL UNIQUE,
+            user_password TEXT NOT NULL,
+            user_type TEXT NOT NULL
+        )
+    ''')
+
+
+USER_MIGRATIONS = [
+    Migration(1, "Create the user table", _create_users),
+]
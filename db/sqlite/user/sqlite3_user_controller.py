@@ -2,8 +2,11 @@
 import sqlite3
 from typing import List, Optional
 
+from app.cache import TTLCache
 from app.exceptions.invalid_data import InvalidData
+from db.sqlite.migrations import apply_migrations, reset_migrations
 from db.sqlite.sqlite_db_adaptor import SQLiteDBAdaptor
+from db.sqlite.user.migrations import USER_MIGRATIONS
 from db.types.exceptions.db_error import DBError
 from db.types.user.complete_user import CompleteUser
 from db.types.user.user_container import UserContainer
@@ -13,9 +16,11 @@ from db.user_data_controller import UserDataController
 # User controller specifically for the sqlite dialect of SQL.
 class SQLite3UserController(UserDataController):
 
-    def __init__(self, sqlite_adaptor: SQLiteDBAdaptor):
-        super().__init__(sqlite_adaptor)
+    def __init__(self, sqlite_adaptor: SQLiteDBAdaptor, cache: Optional[TTLCache] = None):
+        super().__init__(sqlite_adaptor, cache)
         self.user_table_name = sqlite_adaptor.user_table_name
+        # Optional, only used to tell which images a user's deletion cascades to
+        self.image_table_name = sqlite_adaptor.image_table_name
 
     def _get_user_by_attrib(self, column_name: str, value) -> Optional[CompleteUser]:
         with self.db_adaptor.get_connection() as conn:
@@ -33,23 +38,11 @@ class SQLite3UserController(UserDataController):
             return None
 
     def init_controller(self):
-        with self.db_adaptor.get_connection() as conn:
-            cursor = conn.cursor()
-            # User Table (stores user info)
-            cursor.execute(f'''
-                CREATE TABLE IF NOT EXISTS {self.user_table_name} (
-                    user_id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    user_username TEXT NOT NULL UNIQUE,
-                    user_email TEXT NOT NULL UNIQUE,
-                    user_password TEXT NOT NULL,
-                    user_type TEXT NOT NULL
-                )
-            ''')
-            conn.commit()
+        apply_migrations(self.db_adaptor, self.user_table_name, USER_MIGRATIONS, self)
 
     def _create_user_impl(self, username: str, email: str, password: str, user_type: str) -> UserContainer:
         try:
-            with self.db_adaptor.get_connection() as conn:
+            with self.db_adaptor.get_write_connection() as conn:
                 cursor = conn.cursor()
                 query = f'''
                     INSERT INTO {self.user_table_name} 
@@ -66,7 +59,7 @@ class SQLite3UserController(UserDataController):
     def get_user_by_username(self, username: str) -> Optional[CompleteUser]:
         return self._get_user_by_attrib("user_username", username.lower())
 
-    def get_user_by_id(self, user_id: int) -> Optional[UserContainer]:
+    def _get_user_by_id(self, user_id: int) -> Optional[UserContainer]:
         return self._get_user_by_attrib("user_id", user_id)
 
     def get_user_by_email(self, email: str) -> Optional[UserContainer]:
@@ -88,16 +81,25 @@ class SQLite3UserController(UserDataController):
                 for row in rows
             ]
 
-    def delete_user(self, user: UserContainer):
-        with self.db_adaptor.get_connection() as conn:
+    def _delete_user_impl(self, user: UserContainer) -> List[int]:
+        with self.db_adaptor.get_write_connection() as conn:
             cursor = conn.cursor()
+            image_ids = []
+            # Read in the same transaction as the delete, so no image can be added in between
+            # The image controller creates its table, it may not have been started yet
+            if self.image_table_name is not None and cursor.execute(
+                    "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?",
+                    (self.image_table_name,)).fetchone():
+                image_ids = [row[0] for row in cursor.execute(
+                    f'SELECT image_id FROM {self.image_table_name} WHERE user_id = ?', (user.id,))]
             user_query = f'DELETE FROM {self.user_table_name} WHERE user_id = ?'
             cursor.execute(user_query, (user.id,))
             conn.commit()
+        return image_ids
 
 
     # ChatGPT partially
-    def update_user(self, user: UserContainer, attributes: dict[str, str]):
+    def _update_user_impl(self, user: UserContainer, attributes: dict[str, str]):
         # Validate the column name to prevent SQL injection
         valid_columns = {"user_username", "user_email", "user_password", "user_type"}
         # Find invalid keys that are not in the valid_columns set
@@ -105,25 +107,27 @@ class SQLite3UserController(UserDataController):
         if invalid_keys:
             # Raise an error with a message listing the invalid keys
             raise DBError(f"Invalid column names: {', '.join(invalid_keys)}")
+        def update(cursor):
+            for attribute, value in attributes.items():
+                query = f'UPDATE {self.user_table_name} SET {attribute} = ? WHERE user_id = ?'
+                cursor.execute(query, (value, user.id))
+                if cursor.rowcount == 0:
+                    raise InvalidData(f"No user found with ID {user.id}.")
+
         try:
-            with self.db_adaptor.get_connection() as conn:
-                for attribute, value in attributes.items():
-                    cursor = conn.cursor()
-                    query = f'UPDATE {self.user_table_name} SET {attribute} = ? WHERE user_id = ?'
-                    cursor.execute(query, (value, user.id))
-                    if cursor.rowcount == 0:
-                        raise InvalidData(f"No user found with ID {user.id}.")
-                    conn.commit()
+            # Account changes, e.g. a new password, must survive a crash straight after the request
+            self.db_adaptor.write(update, durable=True)
         except sqlite3.IntegrityError as e:
             raise DBError("Error updating user. This might be due to a unique constraint violation.") from e
 
     def shutdown_controller(self, testing=False):
         if testing:
-            with self.db_adaptor.get_connection() as conn:
+            with self.db_adaptor.get_write_connection() as conn:
                 cursor = conn.cursor()
                 try:
                     # Drop the user table
                     cursor.execute(f'DROP TABLE IF EXISTS {self.user_table_name}')
+                    reset_migrations(cursor, self.user_table_name)
                     conn.commit()
                 except sqlite3.Error as e:
                     raise DBError(f"Failed to drop table {self.user_table_name}: {e}")
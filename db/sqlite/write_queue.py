@@ -0,0 +1,99 @@
+import sqlite3
+import threading
+from concurrent.futures import Future
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, List, Optional
+
+from app.micro_batcher import MicroBatcher
+
+# A write, run with the writer connection's cursor inside a shared transaction. It must not commit.
+WriteOperation = Callable[[sqlite3.Cursor], Any]
+
+
+@dataclass
+class _Write:
+    operation: WriteOperation
+    durable: bool
+
+
+@dataclass
+class _Outcome:
+    result: Any = None
+    error: Optional[BaseException] = None
+
+
+class SQLiteWriteQueue:
+    """
+    Group commit for SQLite. Writes submitted from any thread are collected for up to `max_wait` seconds
+    and run by one thread in a single transaction, each inside its own savepoint so a failing write only
+    rolls itself back. The whole group then pays for one commit instead of one each.
+
+    Committing in WAL mode with synchronous=NORMAL can lose the last transactions on power loss. A group
+    that contains a durable write is committed with synchronous=FULL instead.
+    """
+
+    def __init__(self, get_write_connection: Callable, max_batch_size: int = 64, max_wait: float = 0.002,
+                 synchronous: str = "NORMAL"):
+        self._get_write_connection = get_write_connection
+        self.synchronous = synchronous
+        self._stats_lock = threading.Lock()
+        self._durable_commits = 0
+        self._failed_writes = 0
+        self._batcher = MicroBatcher(self._run_group, max_batch_size=max_batch_size, max_wait=max_wait,
+                                     name="sqlite-writer")
+
+    def submit(self, operation: WriteOperation, durable: bool = False) -> Future:
+        """Queue a write, the future resolves to what the operation returned once its group is committed."""
+        future = Future()
+
+        def resolve(batched: Future):
+            exception = batched.exception()
+            if exception is None:
+                outcome = batched.result()
+                exception, result = outcome.error, outcome.result
+            if exception is not None:
+                future.set_exception(exception)
+            else:
+                future.set_result(result)
+
+        self._batcher.submit(_Write(operation, durable)).add_done_callback(resolve)
+        return future
+
+    def stop(self):
+        self._batcher.stop()
+
+    def stats(self) -> Dict[str, float]:
+        stats = {f"write_{key}": value for key, value in self._batcher.stats().items()}
+        with self._stats_lock:
+            stats["durable_commits"] = self._durable_commits
+            stats["failed_writes"] = self._failed_writes
+        return stats
+
+    def _run_group(self, writes: List[_Write]) -> List[_Outcome]:
+        outcomes = []
+        durable = any(write.durable for write in writes)
+        with self._get_write_connection() as conn:
+            cursor = conn.cursor()
+            if durable:
+                cursor.execute("PRAGMA synchronous = FULL")
+            cursor.execute("BEGIN IMMEDIATE")
+            for write in writes:
+                cursor.execute("SAVEPOINT write")
+                try:
+                    outcome = _Outcome(result=write.operation(cursor))
+                except Exception as e:
+                    cursor.execute("ROLLBACK TO write")
+                    outcome = _Outcome(error=e)
+                    with self._stats_lock:
+                        self._failed_writes += 1
+                cursor.execute("RELEASE write")
+                outcomes.append(outcome)
+
+            try:
+                conn.commit()
+            finally:
+                if durable:
+                    cursor.execute(f"PRAGMA synchronous = {self.synchronous}")
+                    with self._stats_lock:
+                        self._durable_commits += 1
+        return outcomes
@@ -0,0 +1,16 @@
+from db.storage.image_storage import ImageStorage
+
+
+class ContentAddressedImageStorage(ImageStorage):
+    """
+    Images are named by their SHA-256 and sharded into two levels of subdirectories,
+    e.g. 3f/a2/3fa2....png, so no directory grows past a few thousand entries and
+    identical content always ends up in the same file.
+    """
+
+    SHARD_WIDTH = 2
+    SHARD_DEPTH = 2
+
+    def relative_path_for(self, image_hash: str, extension: str) -> str:
+        shards = [image_hash[i * self.SHARD_WIDTH:(i + 1) * self.SHARD_WIDTH] for i in range(self.SHARD_DEPTH)]
+        return "/".join(shards + [f"{image_hash}.{extension}"])
@@ -0,0 +1,10 @@
+import uuid
+
+from db.storage.image_storage import ImageStorage
+
+
+class FlatImageStorage(ImageStorage):
+    """Every image gets a random name directly in the upload directory."""
+
+    def relative_path_for(self, image_hash: str, extension: str) -> str:
+        return str(uuid.uuid4()) + "." + extension
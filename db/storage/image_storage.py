@@ -0,0 +1,54 @@
+import os
+import shutil
+import tempfile
+from abc import ABC, abstractmethod
+from pathlib import Path
+from typing import BinaryIO
+
+COPY_CHUNK_SIZE = 64 * 1024
+
+
+class ImageStorage(ABC):
+    """
+    Decides where image files live under the upload directory. Paths handed out are relative
+    to `root`, which is what gets stored in the database.
+    """
+
+    def __init__(self, root: Path):
+        self.root = root
+
+    def init_storage(self):
+        os.makedirs(self.root, exist_ok=True)
+
+    @abstractmethod
+    def relative_path_for(self, image_hash: str, extension: str) -> str:
+        pass
+
+    def path_for(self, relative_path: str) -> Path:
+        return self.root / relative_path
+
+    def store(self, source: BinaryIO, image_hash: str, extension: str) -> str:
+        """
+        Write `source` to its place in the storage and return the relative path.
+        The file is written next to its destination and renamed into place, so readers never see half a file.
+        """
+        relative_path = self.relative_path_for(image_hash, extension)
+        path = self.path_for(relative_path)
+        if path.exists():
+            return relative_path  # Only possible when paths are derived from content
+        os.makedirs(path.parent, exist_ok=True)
+        temp_file = tempfile.NamedTemporaryFile(dir=path.parent, prefix=".upload-", delete=False)
+        try:
+            with temp_file:
+                shutil.copyfileobj(source, temp_file, COPY_CHUNK_SIZE)
+            os.replace(temp_file.name, path)
+        except BaseException:
+            os.remove(temp_file.name)
+            raise
+        return relative_path
+
+    def remove(self, relative_path: str):
+        try:
+            os.remove(self.path_for(relative_path))
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,172 @@
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+from pathlib import Path
+from typing import Dict, Iterable, List
+
+from PIL import Image as PILImage
+
+# Format parameter -> (Pillow format, mime type)
+VARIANT_FORMATS = {
+    "webp": ("WEBP", "image/webp"),
+    "jpeg": ("JPEG", "image/jpeg"),
+    "png": ("PNG", "image/png"),
+}
+
+
+class ImageVariantCache:
+    """
+    Resized copies of stored images, kept under `root` as <hash[:2]>/<hash>-<size>.<format>.
+    Once the variants take up more than `max_bytes` the least recently used ones are removed.
+    Concurrent requests for a variant that doesn't exist yet wait on a single resize.
+    """
+
+    def __init__(self, root: Path, max_bytes: int = 256 * 1024 * 1024, sizes: Iterable[int] = (128, 256, 512, 1024),
+                 quality: int = 80):
+        self.root = root
+        self.max_bytes = max_bytes
+        # Only a fixed set of sizes, otherwise every width a client asks for would be another file
+        self.sizes = tuple(sorted(sizes))
+        self.quality = quality
+        self._lock = threading.Lock()
+        # Relative path -> size in bytes, least recently used first
+        self._entries: "OrderedDict[str, int]" = OrderedDict()
+        self._total_bytes = 0
+        self._in_progress: Dict[str, Future] = {}
+        self._hits = 0
+        self._misses = 0
+        self._coalesced = 0
+        self._evictions = 0
+
+    def init_cache(self):
+        """Pick up the variants already on disk, oldest first, and trim them to the budget."""
+        os.makedirs(self.root, exist_ok=True)
+        found = []
+        for path in self.root.rglob("*"):
+            if not path.is_file():
+                continue
+            if path.name.startswith("."):
+                os.remove(path)  # Left behind by a resize that never finished
+                continue
+            stat = path.stat()
+            found.append((stat.st_mtime, path.relative_to(self.root).as_posix(), stat.st_size))
+        with self._lock:
+            self._entries.clear()
+            for _, relative_path, size in sorted(found):
+                self._entries[relative_path] = size
+            self._total_bytes = sum(self._entries.values())
+            evicted = self._evict()
+        self._remove(evicted)
+
+    def relative_path_for(self, image_hash: str, size: int, image_format: str) -> str:
+        return f"{image_hash[:2]}/{image_hash}-{size}.{image_format}"
+
+    def path_for(self, relative_path: str) -> Path:
+        return self.root / relative_path
+
+    def get(self, source: Path, image_hash: str, size: int, image_format: str) -> str:
+        """
+        Relative path of the `size` pixel `image_format` variant of `source`, resized on the first request.
+        """
+        if size not in self.sizes:
+            raise ValueError(f"Unsupported variant size: {size}")
+        if image_format not in VARIANT_FORMATS:
+            raise ValueError(f"Unsupported variant format: {image_format}")
+
+        relative_path = self.relative_path_for(image_hash, size, image_format)
+        with self._lock:
+            if relative_path in self._entries and self.path_for(relative_path).is_file():
+                self._entries.move_to_end(relative_path)
+                self._hits += 1
+                return relative_path
+            future = self._in_progress.get(relative_path)
+            leader = future is None
+            if leader:
+                future = Future()
+                self._in_progress[relative_path] = future
+                self._misses += 1
+            else:
+                self._coalesced += 1
+
+        if not leader:
+            return future.result()
+
+        try:
+            variant_bytes = self._generate(source, relative_path, size, image_format)
+        except BaseException as e:
+            with self._lock:
+                del self._in_progress[relative_path]
+            future.set_exception(e)
+            raise
+
+        with self._lock:
+            del self._in_progress[relative_path]
+            self._total_bytes += variant_bytes - self._entries.pop(relative_path, 0)
+            self._entries[relative_path] = variant_bytes
+            evicted = self._evict()
+        future.set_result(relative_path)
+        self._remove(evicted)
+        return relative_path
+
+    def discard(self, image_hash: str):
+        """Remove every variant of the image, e.g. once it is deleted."""
+        prefix = f"{image_hash[:2]}/{image_hash}-"
+        with self._lock:
+            discarded = [relative_path for relative_path in self._entries if relative_path.startswith(prefix)]
+            for relative_path in discarded:
+                self._total_bytes -= self._entries.pop(relative_path)
+        self._remove(discarded)
+
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self._total_bytes,
+                "hits": self._hits,
+                "misses": self._misses,
+                "coalesced": self._coalesced,
+                "evictions": self._evictions,
+            }
+
+    def _generate(self, source: Path, relative_path: str, size: int, image_format: str) -> int:
+        pillow_format, _ = VARIANT_FORMATS[image_format]
+        path = self.path_for(relative_path)
+        os.makedirs(path.parent, exist_ok=True)
+        with PILImage.open(source) as image:
+            # JPEGs are decoded straight at a fraction of their full size
+            image.draft("RGB", (size, size))
+            image.thumbnail((size, size), PILImage.Resampling.LANCZOS, reducing_gap=3.0)
+            if pillow_format == "JPEG" and image.mode not in ("RGB", "L"):
+                image = image.convert("RGB")
+            elif image.mode not in ("RGB", "RGBA", "L", "LA"):
+                image = image.convert("RGBA")
+
+            temp_file = tempfile.NamedTemporaryFile(dir=path.parent, prefix=".variant-", delete=False)
+            try:
+                with temp_file:
+                    image.save(temp_file, format=pillow_format, quality=self.quality)
+                os.replace(temp_file.name, path)
+            except BaseException:
+                os.remove(temp_file.name)
+                raise
+        return path.stat().st_size
+
+    def _evict(self) -> List[str]:
+        """Drop the least recently used entries over the budget, the caller removes the returned files."""
+        evicted = []
+        # The newest entry always stays, even when it is bigger than the whole budget
+        while self._total_bytes > self.max_bytes and len(self._entries) > 1:
+            relative_path, size = self._entries.popitem(last=False)
+            self._total_bytes -= size
+            self._evictions += 1
+            evicted.append(relative_path)
+        return evicted
+
+    def _remove(self, relative_paths: List[str]):
+        for relative_path in relative_paths:
+            try:
+                os.remove(self.path_for(relative_path))
+            except FileNotFoundError:
+                pass
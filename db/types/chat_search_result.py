@@ -0,0 +1,10 @@
+from dataclasses import dataclass
+
+from db.types.chat_message import ChatMessage
+
+
+@dataclass
+class ChatSearchResult:
+    message: ChatMessage
+    snippet: str  # The matching part of the message, matches wrapped in [ and ]
+    rank: float  # Lower is a better match
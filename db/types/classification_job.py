@@ -0,0 +1,9 @@
+from dataclasses import dataclass
+
+
+@dataclass
+class ClassificationJob:
+    job_id: int
+    image_id: int
+    user_id: int
+    attempts: int
@@ -1,4 +1,5 @@
 from dataclasses import dataclass
+from typing import Optional
 
 
 @dataclass
@@ -10,6 +11,7 @@ class Image:
     mime: str
     classified_as: str
     unique: bool = True
+    image_hash: Optional[str] = None
     def to_dict(self):
         return {
             "id": self.id,
@@ -28,7 +30,8 @@ class Image:
             height=self.height,
             mime=self.mime,
             classified_as=classified_as,
-            unique=self.unique  # Keep other fields unchanged
+            unique=self.unique,  # Keep other fields unchanged
+            image_hash=self.image_hash
         )
     def copy_with_not_unique(self):
         # Create a copy of the existing Image instance with a new `classified_as` value
@@ -39,5 +42,6 @@ class Image:
             height=self.height,
             mime=self.mime,
             classified_as=self.classified_as,
-            unique=False  # Keep other fields unchanged
+            unique=False,  # Keep other fields unchanged
+            image_hash=self.image_hash
         )
\ No newline at end of file
@@ -1,12 +1,14 @@
 import json
 from abc import abstractmethod
-from typing import List, Optional
+from typing import Callable, List, Optional
 
 from email_validator import validate_email, EmailNotValidError
 from werkzeug.security import generate_password_hash, check_password_hash
 
+from app.cache import TTLCache, cached_lookup
 from app.exceptions.invalid_data import InvalidData
 from db.data_controller import DataController
+from db.db_adaptor import DBAdaptor
 from db.types.user.complete_user import CompleteUser
 from db.types.user.user_container import UserContainer
 
@@ -19,6 +21,13 @@ def user_to_dict(user: CompleteUser) -> dict:
 
 class UserDataController(DataController):
 
+    def __init__(self, db_adaptor: DBAdaptor, cache: Optional[TTLCache] = None):
+        super().__init__(db_adaptor)
+        # Users by id, every request of a logged in user looks theirs up
+        self.cache = cache
+        # Told the ids of the images a user's deletion took with it, so they can be dropped from the image cache
+        self.on_images_deleted: Optional[Callable[[List[int]], None]] = None
+
     def create_new_user(self, username: str, email: str, password: str, user_type: str) -> CompleteUser:
         try:
             valid = validate_email(email)
@@ -43,8 +52,11 @@ class UserDataController(DataController):
                 return user
         return None
 
-    @abstractmethod
     def get_user_by_id(self, user_id: int) -> Optional[CompleteUser]:
+        return cached_lookup(self.cache, user_id, self._get_user_by_id)
+
+    @abstractmethod
+    def _get_user_by_id(self, user_id: int) -> Optional[CompleteUser]:
         pass
 
     @abstractmethod
@@ -55,12 +67,30 @@ class UserDataController(DataController):
     def get_all_users(self) -> List[UserContainer]:
         pass
 
-    @abstractmethod
     def delete_user(self, user: UserContainer):
+        image_ids = self._delete_user_impl(user)
+        self._invalidate_user(user)
+        if image_ids and self.on_images_deleted is not None:
+            self.on_images_deleted(image_ids)
+
+    def update_user(self, user: UserContainer, attributes: dict[str, str]):
+        try:
+            self._update_user_impl(user, attributes)
+        finally:
+            # Also after a failure, some attributes may have been written before it
+            self._invalidate_user(user)
+
+    def _invalidate_user(self, user: UserContainer):
+        if self.cache is not None:
+            self.cache.invalidate(user.id)
+
+    @abstractmethod
+    def _delete_user_impl(self, user: UserContainer) -> List[int]:
+        """Delete the user and return the ids of the images deleted along with them."""
         pass
 
     @abstractmethod
-    def update_user(self, user: UserContainer, attributes: dict[str, str]):
+    def _update_user_impl(self, user: UserContainer, attributes: dict[str, str]):
         pass
 
     @abstractmethod
@@ -1,42 +1,106 @@
+if __name__ == '__main__':
+    # The chat socket runs on eventlet when it is installed. Its replies make blocking HTTP calls and wait on
+    # futures, which only give way to other clients once socket, threading and friends are made cooperative,
+    # and that has to happen before anything else imports them
+    try:
+        import eventlet
+    except ImportError:
+        pass
+    else:
+        eventlet.monkey_patch()
+
+import atexit
 import json
-import secrets
 import threading
+import uuid
+from datetime import timedelta
+from pathlib import Path
 
-from cachelib import FileSystemCache
-from flask import Flask, jsonify, request, Response
+from flask import Flask, jsonify, request, Response, session
 from flask_cors import CORS
 from flask_session import Session
 from flask_socketio import SocketIO, emit, join_room
 
 from app.data_resource_manager import DataResourceManager
 from app.exceptions.invalid_data import InvalidData
+from app.exceptions.service_unavailable import ServiceUnavailable
+from app.session_store import SQLiteSessionCache, load_secret_key
 from db.types.exceptions.db_error import DBError
 from routes.chat import create_chat_blueprint
+from routes.health import create_health_blueprint
 from routes.images import create_images_blueprint
 from routes.user import create_user_blueprint
 
 
-def create_app(testing=False):
+def _socket_async_mode() -> str:
+    """eventlet if the process has been monkey patched for it, unpatched it would stall every client on each reply."""
+    try:
+        from eventlet.patcher import is_monkey_patched
+    except ImportError:
+        return "threading"
+    return "eventlet" if is_monkey_patched("socket") else "threading"
+
+
+def _create_semaphore(async_mode: str, value: int):
+    """A semaphore that the socket's background tasks can wait on without blocking each other."""
+    if async_mode == "eventlet":
+        from eventlet.semaphore import BoundedSemaphore
+    elif async_mode.startswith("gevent"):
+        from gevent.lock import BoundedSemaphore
+    else:
+        from threading import BoundedSemaphore
+    return BoundedSemaphore(value)
+
+
+def create_app(testing=False, warm_up=True):
     flask_app = Flask(__name__)
     flask_app.config.from_file("config.json", load=json.load)
-
-    flask_app.config["SECRET_KEY"] = secrets.token_hex(16)
-    flask_app.config["SESSION_CACHELIB"] = FileSystemCache(cache_dir='sessions', threshold=500)
-    flask_app.config["SESSION_TYPE"] = "cachelib"
+    delivery_config = flask_app.config["MODULES"]["IMAGE_UPLOAD"].get("DELIVERY", {})
+    flask_app.config["USE_X_SENDFILE"] = delivery_config.get("MODE", "python") == "x-sendfile"
+
+    session_config = flask_app.config.get("SESSION", {})
+    # Stable across restarts, otherwise every deploy logs everyone out
+    flask_app.config["SECRET_KEY"] = load_secret_key(flask_app.config["SECRETS"].get("SESSION_TOKEN"),
+                                                     Path(session_config.get("KEY_FILE", "secret_key")))
+    flask_app.config["PERMANENT_SESSION_LIFETIME"] = timedelta(days=session_config.get("LIFETIME_DAYS", 31))
     flask_app.config['SESSION_PERMANENT'] = True
     CORS(flask_app, supports_credentials=True, resources={r"/*": {"origins": "*"}})
-    Session(flask_app)
+    session_backend = session_config.get("BACKEND", "sqlite")
+    if session_backend == "sqlite":
+        session_store = SQLiteSessionCache(
+            session_config.get("DB_FILENAME", "sessions.db"),
+            memory_entries=session_config.get("MEMORY_ENTRIES", 10_000),
+            sweep_interval=session_config.get("SWEEP_INTERVAL_MINUTES", 10) * 60
+        )
+        session_store.start_sweeper()
+        DataResourceManager.set_session_store(session_store)
+        flask_app.config["SESSION_TYPE"] = "cachelib"
+        flask_app.config["SESSION_CACHELIB"] = session_store
+        Session(flask_app)
+    elif session_backend == "cookie":
+        # Flask's own signed cookies, nothing is stored on the server
+        @flask_app.before_request
+        def make_session_permanent():
+            session.permanent = True
+    else:
+        raise ValueError(f"Unsupported session backend: {session_backend}")
 
 
     flask_app.register_blueprint(create_user_blueprint(flask_app.config["ENDPOINT"]))
     flask_app.register_blueprint(create_images_blueprint(flask_app.config["ENDPOINT"]))
     flask_app.register_blueprint(create_chat_blueprint(flask_app.config["ENDPOINT"]))
+    flask_app.register_blueprint(create_health_blueprint(flask_app.config["ENDPOINT"]))
 
     @flask_app.errorhandler(InvalidData)
     def handle_invalid_data(exception):
         if testing: flask_app.logger.exception(exception)
         return jsonify({"status": "error", "message": "Invalid data provided"}), 400
 
+    @flask_app.errorhandler(ServiceUnavailable)
+    def handle_service_unavailable(exception):
+        if testing: flask_app.logger.exception(exception)
+        return jsonify({"status": "error", "message": "Service unavailable, try again later"}), 503
+
     @flask_app.errorhandler(DBError)
     def handle_db_error(exception):
         if testing: flask_app.logger.exception(exception)
@@ -61,7 +125,12 @@ def create_app(testing=False):
             res.headers["Access-Control-Allow-Credentials"] = "true"
             return res
 
-    socket = SocketIO(flask_app, cors_allowed_origins="*", manage_session=False, debug=True)
+    socket = SocketIO(flask_app, cors_allowed_origins="*", manage_session=False, debug=True,
+                      async_mode=_socket_async_mode())
+    DataResourceManager.set_socket(socket)
+    chatbot_config = flask_app.config["MODULES"]["CHATBOT"]
+    # Replies being worked on at once, further messages wait for a free slot
+    reply_slots = _create_semaphore(socket.async_mode, chatbot_config.get("MAX_CONCURRENT_REPLIES", 8))
 
     @socket.on('connect', namespace='/chat')
     def handle_connect():
@@ -71,16 +140,50 @@ def create_app(testing=False):
 
     @socket.on('send_message', namespace='/chat')
     def handle_message(data):
-        print(f"Message received: {data}")
-        returned_json, from_user_id, to_user = DataResourceManager.get_chat_callback(data)
-        print(returned_json, from_user_id, to_user)
-        emit('receive_message', returned_json, to=str(from_user_id), namespace='/chat')
+        # The chatbot can take seconds to answer, so the reply is worked out in the background
+        # and this handler returns straight away, leaving the namespace free for everyone else
+        room = str(data.get("from_user_id"))
+
+        # Off by default, streamed prompts skip the batching
+        stream_replies = chatbot_config.get("STREAMING", False)
+        # Ties the chunks of a streamed answer together, and to the message that completes it
+        stream_id = uuid.uuid4().hex
+        chunks_sent = 0
+
+        def send_chunk(chunk: str):
+            nonlocal chunks_sent
+            socket.emit('receive_message_chunk', {"stream_id": stream_id, "index": chunks_sent, "chunk": chunk},
+                        to=room, namespace='/chat')
+            chunks_sent += 1
+
+        def reply():
+            try:
+                with reply_slots:
+                    returned_json, from_user_id, to_user = DataResourceManager.get_chat_callback(
+                        data, send_chunk if stream_replies else None)
+                if chunks_sent:
+                    returned_json = {**returned_json, "stream_id": stream_id}
+                socket.emit('receive_message', returned_json, to=room, namespace='/chat')
+            finally:
+                socket.emit('typing', {"typing": False}, to=room, namespace='/chat')
+
+        socket.emit('typing', {"typing": True}, to=room, namespace='/chat')
+        socket.start_background_task(reply)
+        # Acknowledges the message to a client that asked for it
+        return {"status": "accepted"}
 
     def run_socket():
         socket.run(flask_app, port=flask_app.config["MODULES"]["CHATBOT"]["PORT"], allow_unsafe_werkzeug=True)
 
     threading.Thread(target=run_socket, daemon=True).start()
 
+    # Lets the archiver, classification workers and session sweeper finish what they are doing on exit
+    atexit.register(DataResourceManager.stop_background_tasks)
+
+    if warm_up:
+        # Load the model now rather than on the first upload, /health/ready says when it's done
+        DataResourceManager.start_warm_up(flask_app)
+
     return flask_app
 
 
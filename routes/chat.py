@@ -1,10 +1,27 @@
-from flask import Blueprint, request, current_app, jsonify, g
+from flask import Blueprint, request, current_app, jsonify, g, Response
 from flask_cors import cross_origin
 
 from app.data_resource_manager import DataResourceManager
+from db.types.chat_message import ChatMessage
 from db.types.user.user_container import UserContainer
 from routes.util import login_required
 
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 500
+DEFAULT_SEARCH_LIMIT = 20
+MAX_SEARCH_LIMIT = 100
+
+
+def _message_to_dict(chat: ChatMessage):
+    return {
+        "id": chat.message_id,
+        "sender_id": chat.sender_id,
+        "receiver_id": chat.receiver_id,
+        "message": chat.message,
+        "type": chat.type,
+        "timestamp": chat.timestamp  # Ensure timestamp is serialized
+    }
+
 
 def create_chat_blueprint(blueprint):
 
@@ -19,27 +36,56 @@ def create_chat_blueprint(blueprint):
             chat_controller = DataResourceManager.get_chat_data_controller(current_app)
             user = UserContainer(user_id)
 
-            chat_messages = chat_controller.load_chat_messages(user)
-
-            messages_dict = [
-                {
-                    "id": chat.message_id,
-                    "sender_id": chat.sender_id,
-                    "receiver_id": chat.receiver_id,
-                    "message": chat.message,
-                    "type": chat.type,
-                    "timestamp": chat.timestamp  # Ensure timestamp is serialized
-                }
-                for chat in chat_messages
-            ]
-
-            return jsonify({"status": "success", "messages": messages_dict}), 200
+            before = request.args.get("before", type=int)
+            after = request.args.get("after", type=int)
+            limit = request.args.get("limit", DEFAULT_PAGE_SIZE, type=int)
+            if before is not None and after is not None:
+                return jsonify({"status": "error", "message": "Only one of before and after can be given"}), 400
+
+            if request.args.get("stream") or request.accept_mimetypes.best == "application/x-ndjson":
+                # One message per line, written as they are read so the history never sits in memory
+                chat_messages = chat_controller.iter_chat_messages(user, after=after, before=before)
+                # Same encoding as jsonify, taken now as the app context is gone by the time the body is written
+                dumps = current_app.json.dumps
+                lines = (dumps(_message_to_dict(chat)) + "\n" for chat in chat_messages)
+                return Response(lines, mimetype="application/x-ndjson")
+
+            limit = max(1, min(limit, MAX_PAGE_SIZE))
+            # One extra row tells whether there is another page
+            chat_messages = chat_controller.load_chat_messages_page(user, limit + 1, before=before, after=after)
+            has_more = len(chat_messages) > limit
+            if has_more:
+                chat_messages = chat_messages[1:] if after is None else chat_messages[:-1]
+
+            messages_dict = [_message_to_dict(chat) for chat in chat_messages]
+
+            return jsonify({
+                "status": "success",
+                "messages": messages_dict,
+                "has_more": has_more,
+                # Pass as `before` for older messages, or `after` to poll for newer ones
+                "oldest_id": messages_dict[0]["id"] if messages_dict else before,
+                "newest_id": messages_dict[-1]["id"] if messages_dict else after
+            }), 200
+
+    @chat_blueprint.route("/search", methods=["GET"])
+    @cross_origin(supports_credentials=True)
+    @login_required
+    def search():
+        chat_controller = DataResourceManager.get_chat_data_controller(current_app)
+        user = UserContainer(g.get("USER_ID"))
+
+        limit = max(1, min(request.args.get("limit", DEFAULT_SEARCH_LIMIT, type=int), MAX_SEARCH_LIMIT))
+        offset = max(0, request.args.get("offset", 0, type=int))
+        # Results are ordered by relevance rather than id, so they are paged by offset
+        results = chat_controller.search_chat_messages(user, request.args.get("q", ""), limit + 1, offset)
+        has_more = len(results) > limit
+
+        return jsonify({
+            "status": "success",
+            "results": [{**_message_to_dict(result.message), "snippet": result.snippet, "rank": result.rank}
+                        for result in results[:limit]],
+            "next_offset": offset + limit if has_more else None
+        }), 200
 
     return chat_blueprint
-
-
-
-
-
-
-
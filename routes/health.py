@@ -0,0 +1,31 @@
+from flask import Blueprint, jsonify
+from flask_cors import cross_origin
+
+from app.data_resource_manager import DataResourceManager
+
+
+def create_health_blueprint(endpoint):
+    health_blueprint = Blueprint('health', __name__, url_prefix=endpoint + '/health')
+
+    @health_blueprint.route("/live", methods=["GET"])
+    @cross_origin()
+    def live():
+        return jsonify({"status": "success", "message": "Alive"}), 200
+
+    @health_blueprint.route("/ready", methods=["GET"])
+    @cross_origin()
+    def ready():
+        # Load balancers should only send traffic once everything, including the model, is warm
+        subsystems = DataResourceManager.get_states()
+        is_ready = all(state == "ready" for state in subsystems.values())
+        return jsonify({
+            "status": "ready" if is_ready else "not_ready",
+            "subsystems": subsystems
+        }), 200 if is_ready else 503
+
+    @health_blueprint.route("/metrics", methods=["GET"])
+    @cross_origin()
+    def metrics():
+        return jsonify({"status": "success", "metrics": DataResourceManager.get_metrics()}), 200
+
+    return health_blueprint
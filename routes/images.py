@@ -1,10 +1,85 @@
-from flask import Blueprint, current_app, request, jsonify, send_file, g
+import base64
+import binascii
+import json
+from pathlib import Path
+from typing import Optional, Tuple
+
+from flask import Blueprint, current_app, request, jsonify, send_file, g, Response
 from flask_cors import cross_origin
 
 from app.data_resource_manager import DataResourceManager
+from db.storage.image_variant_cache import VARIANT_FORMATS
 from db.types.user.user_container import UserContainer
 from routes.util import login_required
 
+DELIVERY_MODES = ("python", "x-sendfile", "x-accel-redirect")
+# Files are stored under their content hash and never change, so they can be cached for good
+DEFAULT_MAX_AGE = 31536000
+
+
+def _send_image(path: Path, root: Path, mime: str, etag: Optional[str]) -> Response:
+    """
+    Answer with an image file under the upload directory `root`, revalidated by `etag`. Range requests and
+    If-None-Match are handled here, or by the web server in front of us when the transfer is offloaded to it.
+    """
+    delivery = current_app.config["MODULES"]["IMAGE_UPLOAD"].get("DELIVERY", {})
+    mode = delivery.get("MODE", "python")
+    max_age = delivery.get("MAX_AGE", DEFAULT_MAX_AGE)
+    if mode not in DELIVERY_MODES:
+        raise ValueError(f"Unsupported image delivery mode: {mode}")
+
+    if mode == "x-accel-redirect":
+        response = Response(mimetype=mime)
+        response.headers["X-Accel-Redirect"] = delivery.get("X_ACCEL_PREFIX", "/protected-images/") \
+            + path.relative_to(root).as_posix()
+        if etag:
+            response.set_etag(etag)
+        # Nginx serves the body and the ranges, only the revalidation is answered here
+        response.make_conditional(request)
+    else:
+        # USE_X_SENDFILE is set from the delivery mode in create_app.
+        # Rows from before hashes were stored fall back to werkzeug's mtime/size based tag
+        response = send_file(path, mimetype=mime, conditional=True, etag=etag or True, max_age=max_age)
+
+    # Images are only served to logged in users, so shared caches must not keep them
+    response.cache_control.public = False
+    response.cache_control.private = True
+    response.cache_control.max_age = max_age
+    response.cache_control.immutable = True
+    return response
+
+
+DEFAULT_LIST_LIMIT = 20
+MAX_LIST_LIMIT = 100
+
+
+def _encode_cursor(image: dict) -> str:
+    return base64.urlsafe_b64encode(json.dumps([image["created_at"], image["id"]]).encode()).decode()
+
+
+def _decode_cursor(cursor: str) -> Optional[Tuple[str, int]]:
+    try:
+        created_at, image_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (binascii.Error, ValueError, TypeError):
+        return None
+    if not isinstance(created_at, str) or not isinstance(image_id, int):
+        return None
+    return created_at, image_id
+
+
+def _parse_image_id(value) -> Optional[int]:
+    # Clients send the id as a number or a numeric string. JSON true is an int to Python, but not an image id
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, int):
+        return value
+    if isinstance(value, str):
+        try:
+            return int(value)
+        except ValueError:
+            return None
+    return None
+
 
 # chatgpt helped
 def create_images_blueprint(endpoint):
@@ -30,8 +105,17 @@ def create_images_blueprint(endpoint):
         image_controller = DataResourceManager.get_image_data_controller(current_app)
         saved_image = image_controller.save_image(image_file, UserContainer(user_id))
 
-        # Classify the image if it's new
-        if saved_image.unique:
+        # Classify the image if it hasn't been yet, repeat uploads are answered from the classification cache
+        if saved_image.id is not None and saved_image.classified_as is None:
+            if current_app.config["MODULES"]["IMAGE_RECOGNITION"].get("ASYNC", {}).get("ENABLED", False):
+                # Answer straight away, the label is pushed over the socket and shows up in get-info
+                image_controller.queue_classification(saved_image.id, UserContainer(user_id))
+                return jsonify({
+                    "status": "success",
+                    "image": saved_image.to_dict(),
+                    "classification": "pending"
+                }), 200
+
             classified_as = image_controller.classify_image(saved_image.id)
 
             return jsonify({
@@ -53,7 +137,11 @@ def create_images_blueprint(endpoint):
             image = image_controller.get_current_image(UserContainer(user_id))
 
             if image:
-                return jsonify({"status": "success", "image": image.to_dict()}), 200
+                return jsonify({
+                    "status": "success",
+                    "image": image.to_dict(),
+                    "classification": image_controller.get_classification_status(image)
+                }), 200
             else:
                 return jsonify({"status": "error", "message": "No image found for the user"}), 404
 
@@ -63,31 +151,96 @@ def create_images_blueprint(endpoint):
 
             if not image_id:
                 return jsonify({"status": "error", "message": "Image ID is required"}), 400
+            image_id = _parse_image_id(image_id)
+            if image_id is None:
+                return jsonify({"status": "error", "message": "Image ID must be an integer"}), 400
 
             image_controller = DataResourceManager.get_image_data_controller(current_app)
             image = image_controller.get_image_from_id(image_id)
 
             if image:
-                return jsonify({"status": "success", "image": image.to_dict()}), 200
+                return jsonify({
+                    "status": "success",
+                    "image": image.to_dict(),
+                    "classification": image_controller.get_classification_status(image)
+                }), 200
             else:
                 return jsonify({"status": "error", "message": "Image not found"}), 404
 
-    @images_blueprint.route('/get-file', methods=['POST'])
+    @images_blueprint.route('/list', methods=['GET'])
+    @cross_origin(supports_credentials=True)
+    @login_required
+    def list_images():
+        user_id = g.get("USER_ID")
+        image_controller = DataResourceManager.get_image_data_controller(current_app)
+
+        limit = max(1, min(request.args.get("limit", DEFAULT_LIST_LIMIT, type=int), MAX_LIST_LIMIT))
+        fields = [field for field in request.args.get("fields", "").split(",") if field] or None
+        after = None
+        if request.args.get("cursor"):
+            after = _decode_cursor(request.args["cursor"])
+            if after is None:
+                return jsonify({"status": "error", "message": "Invalid cursor"}), 400
+
+        # One extra row tells whether there is another page
+        images = image_controller.list_images(UserContainer(user_id), limit + 1, after=after,
+                                              classified_as=request.args.get("classified_as"), fields=fields)
+        next_cursor = _encode_cursor(images[limit - 1]) if len(images) > limit else None
+        images = images[:limit]
+
+        # The cursor columns are always read, only hand back what was asked for
+        if fields:
+            images = [{field: image[field] for field in fields} for image in images]
+
+        return jsonify({"status": "success", "images": images, "next_cursor": next_cursor}), 200
+
+    @images_blueprint.route('/get-file', methods=['GET', 'POST'])
     @cross_origin(supports_credentials=True)
     @login_required
     def get_image_file():
         user_id = g.get("USER_ID")
         image_controller = DataResourceManager.get_image_data_controller(current_app)
-        image_id = request.json.get("image_id")
+        # GET can be cached and revalidated by the browser, POST is kept for older clients
+        arguments = request.args if request.method == 'GET' else request.json
+        if request.method == 'GET':
+            # Query arguments are always strings, None when it isn't a number
+            image_id = request.args.get("image_id", type=int)
+        else:
+            image_id = request.json.get("image_id")
+        size = arguments.get("size")
+        image_format = arguments.get("format", "webp")
 
         if not image_id:
             return jsonify({"status": "error", "message": "Image ID is required"}), 400
+        image_id = _parse_image_id(image_id)
+        if image_id is None:
+            return jsonify({"status": "error", "message": "Image ID must be an integer"}), 400
 
         # Fetch image file from DB
-        path = image_controller.get_id_image_filepath(image_id)
-
-        if path:
-            return send_file(path)
-        return jsonify({"status": "error", "message": "Can't find image requested"}), 400
+        image = image_controller.get_image_from_id(image_id)
+
+        if not image:
+            return jsonify({"status": "error", "message": "Can't find image requested"}), 400
+
+        root = image_controller.storage.root
+        if size is None:
+            return _send_image(image_controller.storage.path_for(image.relative_filepath), root,
+                               image.mime, image.image_hash)
+
+        # A resized copy, e.g. a thumbnail for the gallery
+        variant_cache = image_controller.variant_cache
+        try:
+            size = int(size)
+        except (TypeError, ValueError):
+            size = None
+        if variant_cache is None or size not in variant_cache.sizes or image_format not in VARIANT_FORMATS:
+            return jsonify({
+                "status": "error",
+                "message": "Unsupported size or format",
+                "sizes": list(variant_cache.sizes) if variant_cache is not None else [],
+                "formats": list(VARIANT_FORMATS)
+            }), 400
+        path = image_controller.get_image_variant_filepath(image, size, image_format)
+        return _send_image(path, root, VARIANT_FORMATS[image_format][1], f"{image.image_hash}-{size}-{image_format}")
 
     return images_blueprint
@@ -1,14 +1,23 @@
 import os
+from unittest import mock
 
 import pytest
 from flask import Flask
 
+from app.data_resource_manager import DataResourceManager
+from chatbots.chatbot_controller import ChatBotController
+from db.sqlite.chat.sqlite3_chat_controller import SQLite3ChatController
+from db.sqlite.sqlite_db_adaptor import SQLiteDBAdaptor
+from db.sqlite.user.sqlite3_user_controller import SQLite3UserController
 from jjdmvision import create_app
 
 
 @pytest.fixture()
-def app():
-    flask_app = create_app()
+def app(tmp_path, monkeypatch):
+    # Session and database files are created relative to the working directory
+    monkeypatch.chdir(tmp_path)
+    # Route tests don't need the model loaded in the background
+    flask_app = create_app(warm_up=False)
     yield flask_app
 
 
@@ -27,3 +36,29 @@ def port(app: Flask):
     return app.config["PORT"]
 
 
+
+
+@pytest.fixture()
+def adaptor(tmp_path):
+    adaptor = SQLiteDBAdaptor(db_filename=str(tmp_path / "test.db"), user_table_name="users",
+                              chat_table_name="chat", image_table_name="images")
+    user_controller = SQLite3UserController(adaptor)
+    user_controller.init_controller()
+    # Straight to the insert, email validation needs DNS
+    user_controller._create_user_impl("first", "first@test.com", "hashed", "user")
+    user_controller._create_user_impl("second", "second@test.com", "hashed", "user")
+    return adaptor
+
+
+class EchoChatBot(ChatBotController):
+
+    def ask_chatbot(self, message: str) -> str:
+        return f"echo: {message}"
+
+
+@pytest.fixture()
+def chat_controller(adaptor):
+    controller = SQLite3ChatController(adaptor, EchoChatBot())
+    with mock.patch.object(DataResourceManager, "change_chat_callback"):
+        controller.init_controller()
+    return controller
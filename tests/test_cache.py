@@ -0,0 +1,47 @@
+from app.cache import TTLCache
+from db.sqlite.user.sqlite3_user_controller import SQLite3UserController
+from db.types.user.user_container import UserContainer
+
+
+def test_entries_expire_and_are_evicted():
+    now = [0.0]
+    cache = TTLCache(max_entries=2, ttl=10, clock=lambda: now[0])
+    loads = []
+
+    def load(key):
+        loads.append(key)
+        return f"value {key}"
+
+    for key in (1, 2, 1, 3):
+        cache.get_or_load(key, load)
+    assert loads == [1, 2, 3]  # 2 was the least recently used when 3 came in
+    assert cache.get_or_load(1, load) == "value 1" and loads == [1, 2, 3]
+
+    now[0] = 11
+    cache.get_or_load(1, load)
+    assert loads == [1, 2, 3, 1]
+    stats = cache.stats()
+    assert (stats["hits"], stats["misses"], stats["evictions"], stats["expired"]) == (2, 4, 1, 1)
+
+
+def test_a_load_overlapping_an_invalidation_is_not_kept():
+    cache = TTLCache()
+
+    def stale_load(key):
+        cache.invalidate(key)  # A write lands while the old row is being read
+        return "old"
+
+    assert cache.get_or_load(1, stale_load) == "old"
+    assert cache.get_or_load(1, lambda key: "new") == "new"
+
+
+def test_user_writes_invalidate_their_entry(adaptor):
+    controller = SQLite3UserController(adaptor, cache=TTLCache())
+    assert controller.get_user_by_id(1).username == controller.get_user_by_id(1).username
+    assert controller.cache.stats()["hits"] == 1
+
+    controller.update_user(UserContainer(1), {"user_username": "renamed"})
+    assert controller.get_user_by_id(1).username == "renamed"
+
+    controller.delete_user(UserContainer(1))
+    assert controller.get_user_by_id(1) is None
@@ -0,0 +1,102 @@
+import threading
+import time
+
+from chatbots.caching_chatbot import CachingChatBot, normalise_prompt
+from chatbots.chatbot_controller import ChatBotController
+
+
+class CountingChatBot(ChatBotController):
+    fallback_response = "no idea"
+
+    def __init__(self, delay: float = 0.0):
+        self.delay = delay
+        self.prompts = []
+
+    def ask_chatbot(self, message) -> str:
+        self.prompts.append(message)
+        time.sleep(self.delay)
+        return "no idea" if message == "?" else f"answer {len(self.prompts)}"
+
+
+def test_prompts_are_normalised():
+    assert normalise_prompt("  What IS   this?! ") == normalise_prompt("what is this") == "what is this"
+
+
+def test_identical_prompts_share_one_call(adaptor):
+    upstream = CountingChatBot(delay=0.2)
+    chatbot = CachingChatBot(upstream, model_id="model", adaptor=adaptor)
+    answers = []
+    threads = [threading.Thread(target=lambda: answers.append(chatbot.ask_chatbot("Hello!"))) for _ in range(5)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert answers == ["answer 1"] * 5 and upstream.prompts == ["Hello!"]
+    assert chatbot.ask_chatbot("hello") == "answer 1"
+    stats = chatbot.stats()
+    assert stats["upstream_calls"] == 1 and stats["hit_rate"] == 5 / 6 and stats["saved_seconds"] > 0
+
+    # Fallback answers aren't kept
+    assert chatbot.ask_chatbot("?") == chatbot.ask_chatbot("?") == "no idea"
+    assert len(upstream.prompts) == 3
+
+    # Another instance, e.g. after a restart, answers from the database, unless it is for another model
+    restarted = CachingChatBot(CountingChatBot(), model_id="model", adaptor=adaptor)
+    assert restarted.ask_chatbot("hello") == "answer 1" and restarted.stats()["stored_hits"] == 1
+    other_model = CachingChatBot(CountingChatBot(), model_id="other model", adaptor=adaptor)
+    other_model.ask_chatbot("hello")
+    assert other_model.stats()["upstream_calls"] == 1
+
+
+def test_expired_answers_are_swept(adaptor):
+    chatbot = CachingChatBot(CountingChatBot(), model_id="model", ttl=60, adaptor=adaptor)
+    chatbot.ask_chatbot("old")
+    chatbot.ask_chatbot("new")
+    adaptor.write(lambda cursor: cursor.execute("UPDATE chatbot_responses SET created_at = created_at - 120 "
+                                                "WHERE prompt_key = ?", (chatbot._key("old"),)))
+
+    assert chatbot.sweep(batch_size=1) == 1
+    assert chatbot.stats()["swept"] == 1
+    with adaptor.get_connection() as conn:
+        assert conn.execute("SELECT COUNT(*) FROM chatbot_responses").fetchone()[0] == 1
+
+    # The testing teardown drops the table along with its schema version
+    chatbot.shutdown_chatbot(testing=True)
+    with adaptor.get_connection() as conn:
+        assert conn.execute("SELECT name FROM sqlite_master WHERE name = 'chatbot_responses'").fetchone() is None
+        assert conn.execute("SELECT 1 FROM schema_version WHERE component = 'chatbot_responses'").fetchone() is None
+
+
+def test_streamed_answer_is_cached_once_complete():
+    upstream = CountingChatBot()
+    chatbot = CachingChatBot(upstream, model_id="model")
+
+    assert list(chatbot.stream_chatbot("Hello")) == ["answer 1"]
+    # Replayed whole, without asking again
+    assert list(chatbot.stream_chatbot("hello!")) == ["answer 1"]
+    assert chatbot.ask_chatbot("hello") == "answer 1"
+    assert upstream.prompts == ["Hello"]
+
+
+def test_identical_streams_share_one_call():
+    class StreamingChatBot(CountingChatBot):
+        def stream_chatbot(self, message):
+            self.prompts.append(message)
+            yield "ans"
+            time.sleep(0.2)
+            yield "wer"
+
+    upstream = StreamingChatBot()
+    chatbot = CachingChatBot(upstream, model_id="model")
+    answers = []
+    threads = [threading.Thread(target=lambda: answers.append(list(chatbot.stream_chatbot("Hello!"))))
+               for _ in range(3)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    # The first streams, the others wait for its whole answer
+    assert sorted(answers) == [["ans", "wer"], ["answer"], ["answer"]]
+    assert upstream.prompts == ["Hello!"] and chatbot.stats()["coalesced"] == 2
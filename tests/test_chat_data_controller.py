@@ -0,0 +1,140 @@
+from datetime import datetime
+from unittest import mock
+
+import pytest
+
+from app.data_resource_manager import DataResourceManager
+from db.sqlite.chat.sqlite3_chat_controller import SQLite3ChatController
+from db.sqlite.sqlite_db_adaptor import SQLiteDBAdaptor
+from db.types.chat_message import ChatMessage
+from db.types.exceptions.db_error import DBError
+from db.types.user.user_container import UserContainer
+
+
+def test_exchange_is_saved_together(chat_controller):
+    reply, from_user_id, to_user_id = chat_controller.chat_callback({"message": "hello", "from_user_id": 1})
+
+    assert reply["message"] == "echo: hello" and reply["type"] == "bot"
+    assert (from_user_id, to_user_id) == (1, -1)
+    messages = chat_controller.load_chat_messages(UserContainer(1))
+    assert [(message.message, message.type) for message in messages] == [("hello", "user"), ("echo: hello", "bot")]
+    assert messages[1].message_id == reply["message_id"]
+    assert messages[0].timestamp
+
+
+def test_streamed_answer_is_saved_once_complete(chat_controller):
+    chat_controller.chatbot_controller.stream_chatbot = lambda message: iter(["echo", ": ", message])
+    chunks = []
+
+    reply, _, _ = chat_controller.chat_callback({"message": "hello", "from_user_id": 1}, on_chunk=chunks.append)
+
+    assert chunks == ["echo", ": ", "hello"]
+    assert reply["message"] == "echo: hello"
+    messages = chat_controller.load_chat_messages(UserContainer(1))
+    assert [(message.message, message.type) for message in messages] == [("hello", "user"), ("echo: hello", "bot")]
+
+
+def test_unknown_user_saves_nothing(chat_controller):
+    with pytest.raises(DBError):
+        chat_controller._save_chat_exchange_impl(UserContainer(99), UserContainer(-1), "hello", "hi")
+
+    with chat_controller.db_adaptor.get_connection() as conn:
+        assert conn.execute("SELECT COUNT(*) FROM chat").fetchone()[0] == 0
+
+
+def test_import_chat_messages(chat_controller):
+    messages = [ChatMessage(None, -1, 2, f"question {i}", "user", "2024-01-01 10:00:00") for i in range(5)]
+    messages.append(ChatMessage(None, 2, -1, "answer", "bot", None))
+
+    assert chat_controller.import_chat_messages(messages, batch_size=4) == 6
+    loaded = chat_controller.load_chat_messages(UserContainer(2))
+    assert len(loaded) == 6
+    assert str(loaded[0].timestamp) == "2024-01-01 10:00:00"
+
+
+def test_pages_and_stream_follow_message_ids(chat_controller):
+    for i in range(5):
+        chat_controller._save_chat_exchange_impl(UserContainer(1), UserContainer(-1), f"question {i}", f"answer {i}")
+    chat_controller._save_chat_exchange_impl(UserContainer(2), UserContainer(-1), "someone else", "not yours")
+
+    latest = chat_controller.load_chat_messages_page(UserContainer(1), limit=4)
+    assert [message.message for message in latest] == ["question 3", "answer 3", "question 4", "answer 4"]
+    older = chat_controller.load_chat_messages_page(UserContainer(1), limit=4, before=latest[0].message_id)
+    assert [message.message for message in older] == ["question 1", "answer 1", "question 2", "answer 2"]
+    newer = chat_controller.load_chat_messages_page(UserContainer(1), limit=4, after=older[-1].message_id)
+    assert newer == latest
+
+    streamed = list(chat_controller.iter_chat_messages(UserContainer(1), after=older[0].message_id))
+    assert [message.message_id for message in streamed] == sorted(message.message_id for message in older[1:] + latest)
+
+
+
+def test_stream_reads_in_chunks_without_holding_a_connection(chat_controller, adaptor, monkeypatch):
+    monkeypatch.setattr("db.chat_data_controller.STREAM_CHUNK_SIZE", 3)
+    for i in range(5):
+        chat_controller._save_chat_exchange_impl(UserContainer(1), UserContainer(-1), f"question {i}", f"answer {i}")
+    everything = chat_controller.load_chat_messages(UserContainer(1))
+
+    stream = chat_controller.iter_chat_messages(UserContainer(1))
+    streamed = [next(stream)]
+    # Between chunks the reader is back in the pool, or closed
+    assert adaptor.stats()["in_use"] == 0
+    streamed += list(stream)
+    assert streamed == everything
+
+    bounded = chat_controller.iter_chat_messages(UserContainer(1), after=everything[1].message_id,
+                                                 before=everything[8].message_id)
+    assert list(bounded) == everything[2:8]
+
+def test_search_is_ranked_and_limited_to_the_user(chat_controller):
+    chat_controller._save_chat_exchange_impl(UserContainer(1), UserContainer(-1), "what is a red panda",
+                                             "a red panda is a small mammal")
+    chat_controller._save_chat_exchange_impl(UserContainer(1), UserContainer(-1), "tell me about pandas", "no")
+    chat_controller._save_chat_exchange_impl(UserContainer(2), UserContainer(-1), "red panda", "red panda red panda")
+
+    results = chat_controller.search_chat_messages(UserContainer(1), 'Red "panda', limit=10)
+    assert {result.message.message for result in results} == {"what is a red panda", "a red panda is a small mammal"}
+    assert results[0].rank <= results[1].rank
+    assert "[red] [panda]" in results[0].snippet
+    assert chat_controller.search_chat_messages(UserContainer(1), "red panda", limit=1, offset=1)[0] == results[1]
+
+    # Deleted messages leave the index through the trigger
+    chat_controller.delete_chat_message(results[0].message.message_id)
+    assert len(chat_controller.search_chat_messages(UserContainer(1), "panda", limit=10)) == 1
+
+
+def test_archived_messages_are_read_through(adaptor, tmp_path):
+    adaptor = SQLiteDBAdaptor(db_filename=adaptor.db_file_name, attached={"archive": str(tmp_path / "archive.db")},
+                              user_table_name="users", chat_table_name="chat", image_table_name="images")
+    controller = SQLite3ChatController(adaptor, None, archive_schema="archive")
+    with mock.patch.object(DataResourceManager, "change_chat_callback"):
+        controller.init_controller()
+    controller.import_chat_messages([
+        ChatMessage(0, -1, 1, f"old question {i} " * 10, "user", f"2020-01-0{i + 1} 10:00:00") for i in range(3)
+    ])
+    controller._save_chat_exchange_impl(UserContainer(1), UserContainer(-1), "new question", "new answer")
+    before = controller.load_chat_messages(UserContainer(1))
+
+    assert controller.archive_chat_messages(datetime(2021, 1, 1), batch_size=2) == 2
+    assert controller.archive_chat_messages(datetime(2021, 1, 1), batch_size=2) == 1
+    with adaptor.get_connection() as conn:
+        assert conn.execute("SELECT COUNT(*) FROM chat").fetchone()[0] == 2
+        assert isinstance(conn.execute("SELECT chat_content FROM archive.chat_archive").fetchone()[0], bytes)
+
+    assert controller.load_chat_messages(UserContainer(1)) == before
+    assert list(controller.iter_chat_messages(UserContainer(1))) == before
+    newest = controller.load_chat_messages_page(UserContainer(1), 3)
+    assert newest == before[2:]
+    assert controller.load_chat_messages_page(UserContainer(1), 3, before=newest[0].message_id) == before[:2]
+    assert controller.load_chat_messages_page(UserContainer(1), 2, after=before[0].message_id) == before[1:3]
+
+    # Searches cover the archive too, with its snippets cut from the decompressed text
+    results = controller.search_chat_messages(UserContainer(1), "question", limit=10)
+    assert sorted(result.message.message_id for result in results) == [message.message_id for message in before[:4]]
+    archived = [result for result in results if result.message.message_id == before[0].message_id][0]
+    assert archived.message == before[0] and "[question]" in archived.snippet
+    assert len(controller.search_chat_messages(UserContainer(1), "question", limit=2, offset=2)) == 2
+
+    controller.delete_chat_message(before[0].message_id)
+    assert len(controller.search_chat_messages(UserContainer(1), "old question", limit=10)) == 2
+    adaptor.close()
@@ -0,0 +1,44 @@
+import json
+from unittest import mock
+
+from app.data_resource_manager import DataResourceManager
+from db.types.user.user_container import UserContainer
+
+
+def test_messages_are_paged_and_streamed(client, endpoint, chat_controller):
+    for i in range(3):
+        chat_controller._save_chat_exchange_impl(UserContainer(1), UserContainer(-1), f"question {i}", f"answer {i}")
+    with client.session_transaction() as session:
+        session["USER_ID"] = 1
+
+    with mock.patch.object(DataResourceManager, "get_chat_data_controller", return_value=chat_controller):
+        page = client.get(f"{endpoint}chat/messages?limit=4").json
+        assert [message["message"] for message in page["messages"]] == ["question 1", "answer 1", "question 2",
+                                                                        "answer 2"]
+        assert page["has_more"]
+
+        page = client.get(f"{endpoint}chat/messages?limit=4&before={page['oldest_id']}").json
+        assert [message["message"] for message in page["messages"]] == ["question 0", "answer 0"]
+        assert not page["has_more"]
+
+        response = client.get(f"{endpoint}chat/messages?stream=1")
+        assert response.mimetype == "application/x-ndjson"
+        lines = [json.loads(line) for line in response.data.decode().splitlines()]
+        assert len(lines) == 6 and lines[0]["message"] == "question 0"
+
+
+def test_search_pages_by_offset(client, endpoint, chat_controller):
+    for i in range(3):
+        chat_controller._save_chat_exchange_impl(UserContainer(1), UserContainer(-1), f"panda {i}", f"bamboo {i}")
+    with client.session_transaction() as session:
+        session["USER_ID"] = 1
+
+    with mock.patch.object(DataResourceManager, "get_chat_data_controller", return_value=chat_controller):
+        page = client.get(f"{endpoint}chat/search?q=panda&limit=2").json
+        assert len(page["results"]) == 2 and page["next_offset"] == 2
+        assert page["results"][0]["snippet"].startswith("[panda]")
+
+        page = client.get(f"{endpoint}chat/search?q=panda&limit=2&offset=2").json
+        assert len(page["results"]) == 1 and page["next_offset"] is None
+
+        assert client.get(f"{endpoint}chat/search?q=").status_code == 400
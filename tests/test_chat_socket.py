@@ -0,0 +1,144 @@
+import json
+import os
+import subprocess
+import sys
+import textwrap
+import threading
+import time
+from pathlib import Path
+from unittest import mock
+
+import pytest
+
+from app.data_resource_manager import DataResourceManager
+from chatbots.batching_chatbot import BatchingChatBot
+from chatbots.caching_chatbot import CachingChatBot
+
+
+def test_send_message_is_acknowledged_before_the_reply(app):
+    release = threading.Event()
+
+    def slow_callback(data, on_chunk=None):
+        release.wait(5)
+        return {"message": f"echo: {data['message']}"}, data["from_user_id"], -1
+
+    socket = DataResourceManager._socket
+    client = socket.test_client(app, namespace="/chat", query_string="user_id=1")
+    client.get_received("/chat")  # The connect status
+    with mock.patch.object(DataResourceManager, "get_chat_callback", side_effect=slow_callback):
+        ack = client.emit("send_message", {"message": "hi", "from_user_id": 1}, namespace="/chat", callback=True)
+        assert ack == {"status": "accepted"}
+        assert [(event["name"], event["args"][0]) for event in client.get_received("/chat")] == \
+            [("typing", {"typing": True})]
+
+        release.set()
+        deadline = time.monotonic() + 5
+        received = []
+        while len(received) < 2 and time.monotonic() < deadline:
+            received += client.get_received("/chat")
+            time.sleep(0.01)
+    assert [(event["name"], event["args"][0]) for event in received] == \
+        [("receive_message", {"message": "echo: hi"}), ("typing", {"typing": False})]
+    client.disconnect(namespace="/chat")
+
+
+def test_streamed_reply_is_relayed_in_chunks(app):
+    app.config["MODULES"]["CHATBOT"]["STREAMING"] = True
+
+    def streaming_callback(data, on_chunk=None):
+        on_chunk("echo")
+        on_chunk(f": {data['message']}")
+        return {"message": f"echo: {data['message']}"}, data["from_user_id"], -1
+
+    socket = DataResourceManager._socket
+    client = socket.test_client(app, namespace="/chat", query_string="user_id=1")
+    client.get_received("/chat")
+    with mock.patch.object(DataResourceManager, "get_chat_callback", side_effect=streaming_callback):
+        client.emit("send_message", {"message": "hi", "from_user_id": 1}, namespace="/chat")
+        deadline = time.monotonic() + 5
+        received = []
+        while len(received) < 5 and time.monotonic() < deadline:
+            received += client.get_received("/chat")
+            time.sleep(0.01)
+
+    events = [(event["name"], event["args"][0]) for event in received]
+    stream_id = events[1][1]["stream_id"]
+    assert events == [
+        ("typing", {"typing": True}),
+        ("receive_message_chunk", {"stream_id": stream_id, "index": 0, "chunk": "echo"}),
+        ("receive_message_chunk", {"stream_id": stream_id, "index": 1, "chunk": ": hi"}),
+        ("receive_message", {"message": "echo: hi", "stream_id": stream_id}),
+        ("typing", {"typing": False}),
+    ]
+    client.disconnect(namespace="/chat")
+
+
+def test_default_config_batches_replies_instead_of_streaming(app):
+    chunk_callbacks = []
+
+    def callback(data, on_chunk=None):
+        chunk_callbacks.append(on_chunk)
+        return {"message": data["message"]}, data["from_user_id"], -1
+
+    socket = DataResourceManager._socket
+    client = socket.test_client(app, namespace="/chat", query_string="user_id=1")
+    with mock.patch.object(DataResourceManager, "get_chat_callback", side_effect=callback):
+        client.emit("send_message", {"message": "hi", "from_user_id": 1}, namespace="/chat")
+        deadline = time.monotonic() + 5
+        while not chunk_callbacks and time.monotonic() < deadline:
+            time.sleep(0.01)
+    client.disconnect(namespace="/chat")
+
+    # Asked without streaming, so the prompt goes through the batching chatbot behind the cache
+    assert chunk_callbacks == [None]
+    chatbot = DataResourceManager._create_chatbot(app)
+    chatbot.stop()
+    assert isinstance(chatbot, CachingChatBot) and isinstance(chatbot.chatbot, BatchingChatBot)
+
+
+EVENTLET_SCRIPT = textwrap.dedent("""
+    import eventlet
+    eventlet.monkey_patch()  # As the entry point does
+
+    import json
+    import threading
+    import time
+    from concurrent.futures import Future
+    from unittest import mock
+
+    from app.data_resource_manager import DataResourceManager
+    from jjdmvision import create_app
+
+    def callback(data, on_chunk=None):
+        if data["message"] == "slow":
+            # Waits on a future the way the chatbot wrappers do
+            answer = Future()
+            threading.Timer(1, answer.set_result, ("slow",)).start()
+            answer.result()
+        return {"message": data["message"]}, data["from_user_id"], -1
+
+    app = create_app(warm_up=False)
+    socket = DataResourceManager._socket
+    slow = socket.test_client(app, namespace="/chat", query_string="user_id=1")
+    fast = socket.test_client(app, namespace="/chat", query_string="user_id=2")
+    replies = []
+    with mock.patch.object(DataResourceManager, "get_chat_callback", side_effect=callback):
+        slow.emit("send_message", {"message": "slow", "from_user_id": 1}, namespace="/chat")
+        fast.emit("send_message", {"message": "fast", "from_user_id": 2}, namespace="/chat")
+        deadline = time.monotonic() + 10
+        while len(replies) < 2 and time.monotonic() < deadline:
+            for client in (slow, fast):
+                replies += [event["args"][0]["message"] for event in client.get_received("/chat")
+                            if event["name"] == "receive_message"]
+            time.sleep(0.01)
+    print(json.dumps({"async_mode": socket.async_mode, "replies": replies}))
+""")
+
+
+def test_slow_reply_does_not_hold_up_other_clients_under_eventlet(tmp_path):
+    pytest.importorskip("eventlet")
+    repo = Path(__file__).resolve().parent.parent
+    result = subprocess.run([sys.executable, "-c", EVENTLET_SCRIPT], cwd=tmp_path, capture_output=True, text=True,
+                            timeout=120, env={**os.environ, "PYTHONPATH": str(repo)})
+    assert result.returncode == 0, result.stderr
+    assert json.loads(result.stdout.splitlines()[-1]) == {"async_mode": "eventlet", "replies": ["fast", "slow"]}
@@ -0,0 +1,152 @@
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+from flask import Flask
+
+from app.exceptions.service_unavailable import ServiceUnavailable
+from chatbots.batching_chatbot import BatchingChatBot
+from chatbots.huggingface.flan_t5_chatbot import FlanT5ChatBot
+
+
+class Upstream(ThreadingHTTPServer):
+    """Stand-in for the inference API, answers with the scripted (status, delay) responses in turn."""
+    daemon_threads = True
+
+    def __init__(self, responses):
+        super().__init__(("127.0.0.1", 0), UpstreamHandler)
+        self.responses = list(responses)
+        self.clients = []
+        self.inputs = []
+
+
+class UpstreamHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # Keep-alive
+
+    def do_POST(self):
+        prompt = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        self.server.clients.append(self.client_address)
+        self.server.inputs.append(prompt["inputs"])
+        status, delay = self.server.responses.pop(0) if self.server.responses else (200, 0)
+        time.sleep(delay)
+        if prompt.get("stream") and status == 200:
+            return self._stream(prompt["inputs"])
+        inputs = prompt["inputs"] if isinstance(prompt["inputs"], list) else [prompt["inputs"]]
+        body = json.dumps([{"generated_text": f"answer to {text}"} for text in inputs] if status == 200
+                          else {"error": "Model is currently loading"}).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _stream(self, prompt):
+        # Token by token as server-sent events, without a Content-Length the connection ends the body
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        tokens = [{"text": "answer", "special": False}, {"text": f" to {prompt}", "special": False},
+                  {"text": "</s>", "special": True}]
+        for i, token in enumerate(tokens):
+            event = {"token": token, "generated_text": f"answer to {prompt}" if i == len(tokens) - 1 else None}
+            self.wfile.write(f"data:{json.dumps(event)}\n\n".encode())
+            self.wfile.flush()
+        self.close_connection = True
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture()
+def upstream():
+    servers = []
+
+    def start(*responses):
+        server = Upstream(responses)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+        return server
+
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+def make_chatbot(server, **http) -> FlanT5ChatBot:
+    app = Flask(__name__)
+    app.config["SECRETS"] = {"HUGGINGFACE": "token"}
+    app.config["MODULES"] = {"CHATBOT": {
+        "API_URL": f"http://127.0.0.1:{server.server_address[1]}/model",
+        "HTTP": {"BACKOFF_SECONDS": 0.01, "MAX_BACKOFF_SECONDS": 0.05, **http},
+    }}
+    return FlanT5ChatBot(app)
+
+
+def test_retries_busy_upstream_over_one_connection(upstream):
+    server = upstream((503, 0), (429, 0))
+    chatbot = make_chatbot(server)
+
+    assert chatbot.ask_chatbot("hi") == "answer to hi"
+    assert chatbot.ask_chatbot("again") == "answer to again"
+    # Four requests, all over the same kept-alive connection
+    assert len(server.clients) == 4 and len(set(server.clients)) == 1
+    stats = chatbot.stats()
+    assert (stats["calls"], stats["retries"], stats["failures"]) == (2, 2, 0)
+    assert stats["max_ms"] >= stats["p50_ms"] > 0
+
+
+def test_gives_up_after_max_retries(upstream):
+    server = upstream(*[(503, 0)] * 5)
+    chatbot = make_chatbot(server, MAX_RETRIES=2)
+
+    with pytest.raises(ServiceUnavailable):
+        chatbot.ask_chatbot("hi")
+    assert len(server.clients) == 3
+    assert chatbot.stats()["failures"] == 1
+
+
+def test_slow_upstream_times_out(upstream):
+    server = upstream((200, 2))
+    chatbot = make_chatbot(server, READ_TIMEOUT=0.2)
+
+    start = time.monotonic()
+    with pytest.raises(ServiceUnavailable):
+        chatbot.ask_chatbot("hi")
+    assert time.monotonic() - start < 1
+    assert len(server.clients) == 1  # Not retried, it would only hang again
+
+
+def test_concurrent_prompts_are_batched(upstream):
+    server = upstream()
+    chatbot = BatchingChatBot(make_chatbot(server), max_batch_size=4, max_wait_ms=200)
+
+    with ThreadPoolExecutor(4) as pool:
+        answers = list(pool.map(chatbot.ask_chatbot, ["a", "b", "c", "d"]))
+    assert answers == ["answer to a", "answer to b", "answer to c", "answer to d"]
+    assert server.inputs == [["a", "b", "c", "d"]]
+    chatbot.shutdown()
+
+
+def test_rejected_batch_falls_back_to_single_prompts(upstream):
+    server = upstream((422, 0))
+    chatbot = BatchingChatBot(make_chatbot(server), max_batch_size=2, max_wait_ms=200)
+
+    with ThreadPoolExecutor(2) as pool:
+        answers = list(pool.map(chatbot.ask_chatbot, ["a", "b"]))
+    assert answers == ["answer to a", "answer to b"]
+    assert sorted(map(str, server.inputs)) == ["['a', 'b']", "a", "b"]
+    assert chatbot.stats()["rejected_batches"] == 1
+    chatbot.shutdown()
+
+
+def test_streams_answer_token_by_token(upstream):
+    server = upstream()
+    chatbot = make_chatbot(server)
+
+    assert list(chatbot.stream_chatbot("hi")) == ["answer", " to hi"]
+    assert "first_chunk_p50_ms" in chatbot.stats()
@@ -0,0 +1,32 @@
+from unittest import mock
+
+from app.cache import TTLCache
+from app.data_resource_manager import DataResourceManager
+
+
+def test_live(client, endpoint):
+    response = client.get(f"{endpoint}health/live")
+    assert response.status_code == 200
+    assert response.json.get("status") == "success"
+
+
+def test_ready_reports_each_subsystem(client, endpoint):
+    states = {"database": "ready", "user": "ready", "chat": "ready", "image": "warming"}
+    with mock.patch.object(DataResourceManager, "_states", dict(states)):
+        response = client.get(f"{endpoint}health/ready")
+        assert response.status_code == 503
+        assert response.json == {"status": "not_ready", "subsystems": states}
+
+        DataResourceManager._set_state("image", "ready")
+        response = client.get(f"{endpoint}health/ready")
+        assert response.status_code == 200
+        assert response.json.get("status") == "ready"
+
+
+def test_metrics_include_caches(client, endpoint):
+    cache = TTLCache()
+    cache.get_or_load(1, lambda key: "user")
+    with mock.patch.object(DataResourceManager, "_caches", {"user": cache}):
+        response = client.get(f"{endpoint}health/metrics")
+    assert response.status_code == 200
+    assert response.json["metrics"]["user_cache"]["misses"] == 1
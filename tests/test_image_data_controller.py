@@ -0,0 +1,259 @@
+import io
+import threading
+
+import pytest
+from PIL import Image as PILImage
+from werkzeug.datastructures import FileStorage
+
+from app.classification_workers import ClassificationWorkerPool
+from app.exceptions.invalid_data import InvalidData
+from classifiers.image_classifier import ImageClassifier
+from classifiers.prediction import Prediction
+from db.sqlite.image.migrate_storage import migrate_storage
+from db.sqlite.image.sqlite3_image_controller import SQLite3ImageController
+from db.sqlite.user.sqlite3_user_controller import SQLite3UserController
+from db.storage.content_addressed_image_storage import ContentAddressedImageStorage
+from db.types.exceptions.db_error import DBError
+from db.types.user.user_container import UserContainer
+
+
+class CountingClassifier(ImageClassifier):
+    """Stands in for ResNet, labels every image by its width."""
+
+    def __init__(self, version="v1"):
+        self.version = version
+        self.calls = 0
+        super().__init__()
+
+    @property
+    def model_id(self) -> str:
+        return f"counting-{self.version}"
+
+    def load_model(self):
+        return None
+
+    def load_classes(self):
+        return []
+
+    def transform_image(self, image_path):
+        with PILImage.open(image_path) as image:
+            return image.width
+
+    def predict_batch(self, image_tensors):
+        self.calls += len(image_tensors)
+        return [Prediction(f"{width}px", {f"{width}px": 1.0}) for width in image_tensors]
+
+    def predict(self, image_path):
+        return self.predict_batch([self.transform_image(image_path)])[0]
+
+
+def make_upload(width=32, color="red"):
+    buffer = io.BytesIO()
+    PILImage.new("RGB", (width, 16), color).save(buffer, format="PNG")
+    buffer.seek(0)
+    return FileStorage(stream=buffer, filename="upload.png", content_type="image/png")
+
+
+def make_controller(adaptor, tmp_path, classifier, storage=None):
+    controller = SQLite3ImageController(adaptor, tmp_path / "images", classifier, storage=storage)
+    controller.init_controller()
+    return controller
+
+
+def test_repeat_classification_is_served_from_cache(adaptor, tmp_path):
+    classifier = CountingClassifier()
+    controller = make_controller(adaptor, tmp_path, classifier)
+
+    image = controller.save_image(make_upload(), UserContainer(1))
+    assert controller.classify_image(image.id) == "32px"
+    # Same row classified again, e.g. after classified_as was reset
+    assert controller.classify_image(image.id) == "32px"
+
+    assert classifier.calls == 1
+    assert controller.get_classification_cache_stats() == {"hits": 1, "misses": 1, "hit_rate": 0.5}
+
+
+def test_model_change_invalidates_cache(adaptor, tmp_path):
+    first = make_controller(adaptor, tmp_path, CountingClassifier("v1"))
+    image = first.save_image(make_upload(), UserContainer(1))
+    first.classify_image(image.id)
+
+    upgraded_classifier = CountingClassifier("v2")
+    upgraded = make_controller(adaptor, tmp_path, upgraded_classifier)
+    upgraded.classify_image(image.id)
+
+    assert upgraded_classifier.calls == 1
+    assert upgraded.get_classification_cache_stats()["misses"] == 1
+
+
+def test_queued_classification_is_finished_by_workers(adaptor, tmp_path):
+    controller = make_controller(adaptor, tmp_path, CountingClassifier())
+    image = controller.save_image(make_upload(width=48), UserContainer(1))
+
+    delivered = threading.Event()
+    results = []
+
+    def on_classified(user_id, image_id, classified_as):
+        results.append((user_id, image_id, classified_as))
+        delivered.set()
+
+    workers = ClassificationWorkerPool(controller, workers=2, poll_interval=0.05, on_classified=on_classified)
+    workers.start()
+    controller.queue_classification(image.id, UserContainer(1))
+    assert controller.get_classification_status(controller.get_image_from_id(image.id)) in ("pending", "running", "done")
+
+    assert delivered.wait(5)
+    workers.stop()
+
+    assert results == [(1, image.id, "48px")]
+    stored = controller.get_image_from_id(image.id)
+    assert stored.classified_as == "48px"
+    assert controller.get_classification_status(stored) == "done"
+
+
+def test_worker_survives_a_failure_to_record_a_job(adaptor, tmp_path):
+    controller = make_controller(adaptor, tmp_path, CountingClassifier())
+    images = [controller.save_image(make_upload(width=width), UserContainer(1)) for width in (16, 24)]
+    finish = controller.finish_classification_job
+    failures = [DBError("database is locked")]
+
+    def flaky_finish(*args, **kwargs):
+        if failures:
+            raise failures.pop()
+        finish(*args, **kwargs)
+
+    delivered = []
+    both_delivered = threading.Event()
+
+    def on_classified(user_id, image_id, classified_as):
+        delivered.append(image_id)
+        if len(delivered) == 2:
+            both_delivered.set()
+
+    controller.finish_classification_job = flaky_finish
+    workers = ClassificationWorkerPool(controller, workers=1, poll_interval=0.05, on_classified=on_classified)
+    workers.start()
+    for image in images:
+        controller.queue_classification(image.id, UserContainer(1))
+    assert both_delivered.wait(5)
+    workers.stop()
+
+    # The same worker went on to the next job, and the first one was recorded once the database let it
+    assert sorted(delivered) == sorted(image.id for image in images)
+    assert [controller._get_classification_job_status(image.id) for image in images] == ["done", "done"]
+
+
+def test_failed_job_is_not_claimed_again_until_it_is_due(adaptor, tmp_path):
+    controller = make_controller(adaptor, tmp_path, CountingClassifier())
+    image = controller.save_image(make_upload(), UserContainer(1))
+    controller.queue_classification(image.id, UserContainer(1))
+
+    job = controller.claim_classification_job()
+    assert job.attempts == 1
+    controller.finish_classification_job(job.job_id, "pending", "model crashed", retry_in=60)
+    assert controller.get_classification_status(controller.get_image_from_id(image.id)) == "pending"
+    assert controller.claim_classification_job() is None
+
+    controller.finish_classification_job(job.job_id, "pending", "model crashed")
+    assert controller.claim_classification_job().attempts == 2
+
+
+def test_requeueing_leaves_an_unfinished_job_alone(adaptor, tmp_path):
+    controller = make_controller(adaptor, tmp_path, CountingClassifier())
+    image = controller.save_image(make_upload(), UserContainer(1))
+    controller.queue_classification(image.id, UserContainer(1))
+
+    job = controller.claim_classification_job()
+    controller.queue_classification(image.id, UserContainer(1))
+    assert controller.get_classification_status(controller.get_image_from_id(image.id)) == "running"
+    assert controller.claim_classification_job() is None
+
+    controller.finish_classification_job(job.job_id, "failed", "model crashed")
+    controller.queue_classification(image.id, UserContainer(1))
+    assert controller.claim_classification_job().attempts == 1
+
+
+def test_duplicate_upload_writes_nothing(adaptor, tmp_path):
+    controller = make_controller(adaptor, tmp_path, CountingClassifier())
+    first = controller.save_image(make_upload(), UserContainer(1))
+    second = controller.save_image(make_upload(), UserContainer(2))
+
+    assert first.unique and not second.unique
+    assert second.id == first.id
+    assert [path.name for path in (tmp_path / "images").iterdir()] == [first.relative_filepath]
+
+
+def test_upload_is_validated_from_header(adaptor, tmp_path):
+    controller = SQLite3ImageController(adaptor, tmp_path / "images", CountingClassifier(), max_pixels=1000)
+    controller.init_controller()
+
+    with pytest.raises(InvalidData):
+        controller.save_image(make_upload(width=100), UserContainer(1))  # 100x16 pixels is over the limit
+
+    not_an_image = FileStorage(stream=io.BytesIO(b"definitely not a png"), filename="upload.png",
+                               content_type="image/png")
+    with pytest.raises(InvalidData):
+        controller.save_image(not_an_image, UserContainer(1))
+
+    assert list((tmp_path / "images").iterdir()) == []
+
+
+def test_content_addressed_files_are_reclaimed(adaptor, tmp_path):
+    storage = ContentAddressedImageStorage(tmp_path / "images")
+    controller = make_controller(adaptor, tmp_path, CountingClassifier(), storage)
+
+    kept = controller.save_image(make_upload(color="blue"), UserContainer(1))
+    deleted = controller.save_image(make_upload(color="green"), UserContainer(1))
+    assert kept.relative_filepath == storage.relative_path_for(kept.image_hash, "png")
+    assert kept.relative_filepath.startswith(f"{kept.image_hash[:2]}/{kept.image_hash[2:4]}/")
+
+    controller.delete_image(deleted.id)
+    assert not storage.path_for(deleted.relative_filepath).exists()
+    assert storage.path_for(kept.relative_filepath).exists()
+
+    # Deleting the user cascades to their images, the file goes on the next start
+    SQLite3UserController(adaptor).delete_user(UserContainer(1))
+    make_controller(adaptor, tmp_path, CountingClassifier(), storage)
+    assert not storage.path_for(kept.relative_filepath).exists()
+
+
+def test_upload_racing_a_reclaim_keeps_its_file(adaptor, tmp_path):
+    storage = ContentAddressedImageStorage(tmp_path / "images")
+    controller = make_controller(adaptor, tmp_path, CountingClassifier(), storage)
+    image = controller.save_image(make_upload(), UserContainer(1))
+    # A delete that has dropped the row, but not yet the file
+    controller._delete_image_from_db(image.id)
+
+    store = storage.store
+
+    def store_then_reclaim(*args):
+        # The delete finishes between the upload storing its file and writing its row
+        storage.store = store
+        relative_path = store(*args)
+        controller.reclaim_unreferenced_files([relative_path])
+        return relative_path
+
+    storage.store = store_then_reclaim
+    again = controller.save_image(make_upload(), UserContainer(2))
+    assert again.unique
+    assert storage.path_for(again.relative_filepath).exists()
+
+
+def test_flat_directory_migration(adaptor, tmp_path):
+    controller = make_controller(adaptor, tmp_path, CountingClassifier())
+    images = [controller.save_image(make_upload(width=w), UserContainer(1)) for w in (10, 20)]
+    (tmp_path / "images" / "orphan.png").write_bytes(b"left over")
+
+    counts = migrate_storage(adaptor, tmp_path / "images")
+    assert counts["migrated"] == 2 and counts["orphans"] == 1
+
+    storage = ContentAddressedImageStorage(tmp_path / "images")
+    migrated = make_controller(adaptor, tmp_path, CountingClassifier(), storage)
+    for image in images:
+        path = migrated.get_id_image_filepath(image.id)
+        assert path == storage.path_for(storage.relative_path_for(image.image_hash, "png"))
+        assert path.exists()
+        assert not (tmp_path / "images" / image.relative_filepath).exists()
+
+    # Running it again has nothing left to do
+    assert migrate_storage(adaptor, tmp_path / "images")["already_migrated"] == 2
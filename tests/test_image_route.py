@@ -0,0 +1,114 @@
+from unittest import mock
+
+from app.cache import TTLCache
+from app.data_resource_manager import DataResourceManager
+from db.sqlite.image.sqlite3_image_controller import SQLite3ImageController
+from db.sqlite.user.sqlite3_user_controller import SQLite3UserController
+from db.storage.image_variant_cache import ImageVariantCache
+from db.types.user.user_container import UserContainer
+from tests.test_image_data_controller import CountingClassifier, make_upload, make_controller
+
+
+def test_get_file_is_revalidated_by_hash(app, client, endpoint, adaptor, tmp_path):
+    controller = make_controller(adaptor, tmp_path, CountingClassifier())
+    image = controller.save_image(make_upload(), UserContainer(1))
+    with client.session_transaction() as session:
+        session["USER_ID"] = 1
+
+    with mock.patch.object(DataResourceManager, "get_image_data_controller", return_value=controller):
+        response = client.get(f"{endpoint}images/get-file?image_id={image.id}")
+        assert response.status_code == 200
+        assert response.headers["ETag"] == f'"{image.image_hash}"'
+        assert response.cache_control.immutable and response.cache_control.private
+        body = response.data
+
+        response = client.get(f"{endpoint}images/get-file?image_id={image.id}",
+                              headers={"If-None-Match": f'"{image.image_hash}"'})
+        assert response.status_code == 304
+        assert response.data == b""
+
+        response = client.get(f"{endpoint}images/get-file?image_id={image.id}", headers={"Range": "bytes=0-9"})
+        assert response.status_code == 206
+        assert response.data == body[:10]
+
+        controller.variant_cache = ImageVariantCache(tmp_path / "images" / "variants", sizes=(16,))
+        controller.variant_cache.init_cache()
+        response = client.get(f"{endpoint}images/get-file?image_id={image.id}&size=16")
+        assert response.mimetype == "image/webp"
+        assert response.headers["ETag"] == f'"{image.image_hash}-16-webp"'
+        assert client.get(f"{endpoint}images/get-file?image_id={image.id}&size=17").status_code == 400
+        assert client.post(f"{endpoint}images/get-file", json={"image_id": image.id, "size": [16]}).status_code == 400
+
+        # Deleting the image takes its variants with it
+        controller.delete_image(image.id)
+        assert controller.variant_cache.stats()["entries"] == 0
+        assert not any(path.is_file() for path in (tmp_path / "images" / "variants").rglob("*"))
+        image = controller.save_image(make_upload(), UserContainer(1))
+
+        app.config["MODULES"]["IMAGE_UPLOAD"]["DELIVERY"] = {"MODE": "x-accel-redirect", "X_ACCEL_PREFIX": "/internal/"}
+        response = client.get(f"{endpoint}images/get-file?image_id={image.id}")
+        assert response.headers["X-Accel-Redirect"] == "/internal/" + image.relative_filepath
+        assert response.data == b""
+
+
+def test_deleted_image_is_not_served_from_cache(client, endpoint, adaptor, tmp_path):
+    controller = SQLite3ImageController(adaptor, tmp_path / "images", CountingClassifier(), cache=TTLCache())
+    controller.init_controller()
+    image = controller.save_image(make_upload(), UserContainer(1))
+    with client.session_transaction() as session:
+        session["USER_ID"] = 1
+
+    with mock.patch.object(DataResourceManager, "get_image_data_controller", return_value=controller):
+        assert client.get(f"{endpoint}images/get-file?image_id={image.id}").status_code == 200
+        controller.delete_image(image.id)
+        assert client.get(f"{endpoint}images/get-file?image_id={image.id}").status_code == 400
+
+        assert client.get(f"{endpoint}images/get-file?image_id=abc").status_code == 400
+        assert client.post(f"{endpoint}images/get-info", json={"image_id": True}).status_code == 400
+        assert client.post(f"{endpoint}images/get-info", json={"image_id": "abc"}).status_code == 400
+        assert client.post(f"{endpoint}images/get-file", json={"image_id": [image.id]}).status_code == 400
+
+    # Images deleted along with their user are dropped from the cache too
+    image = controller.save_image(make_upload(width=20), UserContainer(2))
+    assert controller.get_image_from_id(image.id) is not None
+    user_controller = SQLite3UserController(adaptor)
+    user_controller.on_images_deleted = controller.forget_images
+    user_controller.delete_user(UserContainer(2))
+    assert controller.get_image_from_id(image.id) is None
+
+
+def test_numeric_string_id_is_accepted(client, endpoint, adaptor, tmp_path):
+    controller = make_controller(adaptor, tmp_path, CountingClassifier())
+    image = controller.save_image(make_upload(), UserContainer(1))
+    with client.session_transaction() as session:
+        session["USER_ID"] = 1
+
+    with mock.patch.object(DataResourceManager, "get_image_data_controller", return_value=controller):
+        info = client.post(f"{endpoint}images/get-info", json={"image_id": str(image.id)})
+        assert info.status_code == 200 and info.json["image"]["id"] == image.id
+        assert client.post(f"{endpoint}images/get-file", json={"image_id": str(image.id)}).status_code == 200
+
+
+def test_list_pages_newest_first(client, endpoint, adaptor, tmp_path):
+    controller = make_controller(adaptor, tmp_path, CountingClassifier())
+    images = [controller.save_image(make_upload(width=16 + i), UserContainer(1)) for i in range(5)]
+    controller.classify_image(images[0].id)
+    controller.save_image(make_upload(width=100), UserContainer(2))
+    with client.session_transaction() as session:
+        session["USER_ID"] = 1
+
+    with mock.patch.object(DataResourceManager, "get_image_data_controller", return_value=controller):
+        page = client.get(f"{endpoint}images/list?limit=3&fields=id,width").json
+        # Uploaded within the same second, so the id breaks the tie
+        assert [image["id"] for image in page["images"]] == [images[4].id, images[3].id, images[2].id]
+        assert set(page["images"][0]) == {"id", "width"}
+
+        page = client.get(f"{endpoint}images/list?limit=3&cursor={page['next_cursor']}").json
+        assert [image["id"] for image in page["images"]] == [images[1].id, images[0].id]
+        assert page["next_cursor"] is None
+
+        page = client.get(f"{endpoint}images/list?classified_as=16px").json
+        assert [image["classified_as"] for image in page["images"]] == ["16px"]
+
+        assert client.get(f"{endpoint}images/list?fields=image_name").status_code == 400
+        assert client.get(f"{endpoint}images/list?cursor=nope").status_code == 400
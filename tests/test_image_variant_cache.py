@@ -0,0 +1,60 @@
+import threading
+import time
+from unittest import mock
+
+from PIL import Image as PILImage
+
+from db.storage.image_variant_cache import ImageVariantCache
+
+
+def make_source(tmp_path, name="source.png", width=400):
+    path = tmp_path / name
+    PILImage.new("RGB", (width, 300), "blue").save(path)
+    return path
+
+
+def test_concurrent_misses_resize_once(tmp_path):
+    cache = ImageVariantCache(tmp_path / "variants", sizes=(128,))
+    cache.init_cache()
+    source = make_source(tmp_path)
+    original_generate = cache._generate
+
+    def slow_generate(*args):
+        time.sleep(0.1)  # Long enough for the other threads to miss too
+        return original_generate(*args)
+
+    results = []
+    with mock.patch.object(cache, "_generate", side_effect=slow_generate) as generate:
+        threads = [threading.Thread(target=lambda: results.append(cache.get(source, "ab" * 32, 128, "webp")))
+                   for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    assert generate.call_count == 1
+    assert len(set(results)) == 1
+    with PILImage.open(cache.path_for(results[0])) as variant:
+        assert variant.format == "WEBP"
+        assert variant.size == (128, 96)
+    stats = cache.stats()
+    assert stats["misses"] == 1 and stats["coalesced"] > 0
+
+
+def test_least_recently_used_variants_are_evicted(tmp_path):
+    source = make_source(tmp_path)
+    cache = ImageVariantCache(tmp_path / "variants", sizes=(64,), max_bytes=1)
+    cache.init_cache()
+
+    first = cache.get(source, "aa" * 32, 64, "png")
+    second = cache.get(source, "bb" * 32, 64, "png")
+
+    assert not cache.path_for(first).exists()
+    assert cache.path_for(second).exists()
+    assert cache.stats()["evictions"] == 1
+
+    # A restart picks the remaining variant back up
+    restarted = ImageVariantCache(tmp_path / "variants", sizes=(64,))
+    restarted.init_cache()
+    assert restarted.get(source, "bb" * 32, 64, "png") == second
+    assert restarted.stats()["hits"] == 1
@@ -0,0 +1,46 @@
+import threading
+
+import pytest
+
+from app.micro_batcher import MicroBatcher
+
+
+def test_concurrent_submissions_share_a_batch():
+    seen_batches = []
+    release = threading.Event()
+
+    def handler(items):
+        release.wait(1)
+        seen_batches.append(list(items))
+        return [item * 2 for item in items]
+
+    batcher = MicroBatcher(handler, max_batch_size=4, max_wait=0.2)
+    futures = [batcher.submit(i) for i in range(4)]
+    release.set()
+
+    # Every caller gets back the result for its own item
+    assert [future.result(timeout=2) for future in futures] == [0, 2, 4, 6]
+    assert seen_batches == [[0, 1, 2, 3]]
+    assert batcher.stats()["mean_batch_size"] == 4
+    batcher.stop()
+
+
+def test_batch_is_flushed_after_max_wait():
+    batcher = MicroBatcher(lambda items: items, max_batch_size=100, max_wait=0.01)
+    assert batcher.submit("only").result(timeout=2) == "only"
+    batcher.stop()
+
+
+def test_handler_errors_reach_every_caller():
+    def handler(items):
+        raise ValueError("model exploded")
+
+    batcher = MicroBatcher(handler, max_batch_size=2, max_wait=0.05)
+    futures = [batcher.submit(1), batcher.submit(2)]
+    for future in futures:
+        with pytest.raises(ValueError):
+            future.result(timeout=2)
+    batcher.stop()
+
+    with pytest.raises(RuntimeError):
+        batcher.submit(3)
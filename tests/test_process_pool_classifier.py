@@ -0,0 +1,104 @@
+import os
+import threading
+import time
+
+import pytest
+import torch
+
+from app.exceptions.service_unavailable import ServiceUnavailable
+from classifiers.image_classifier import ImageClassifier
+from classifiers.prediction import Prediction
+from classifiers.process_pool_classifier import ProcessPoolClassifier
+
+CRASH = -1.0
+
+
+class SignClassifier(ImageClassifier):
+    """Labels an image by the sign of its mean, brings its process down when given all -1s."""
+
+    def load_model(self):
+        return None
+
+    def load_classes(self):
+        return ["negative", "positive"]
+
+    def transform_image(self, image_path):
+        raise NotImplementedError
+
+    def predict_batch(self, image_tensors):
+        batch = torch.cat(image_tensors)
+        if bool((batch == CRASH).all()):
+            os._exit(1)
+        return [Prediction(self.classes[int(image.mean() > 0)], {"pid": os.getpid()}) for image in batch]
+
+    def predict(self, image_path):
+        raise NotImplementedError
+
+
+class BrokenClassifier(SignClassifier):
+    """Can never load its model."""
+
+    def load_model(self):
+        raise RuntimeError("Weights are missing")
+
+
+@pytest.fixture()
+def pool():
+    pool = ProcessPoolClassifier(SignClassifier, transform_image=None, model_id="sign", workers=1,
+                                 queue_size=4, health_check_interval=0.1)
+    yield pool
+    pool.shutdown()
+
+
+def test_predictions_come_from_worker_process(pool):
+    images = [torch.ones(1, 3, 4, 4), -torch.ones(1, 3, 4, 4) * 0.5]
+    predictions = pool.predict_batch(images)
+
+    assert [prediction.label for prediction in predictions] == ["positive", "negative"]
+    assert predictions[0].scores["pid"] != os.getpid()
+
+
+def test_crashed_worker_is_restarted(pool):
+    pool.predict_batch([torch.ones(1, 3, 4, 4)])
+
+    with pytest.raises(ServiceUnavailable):
+        pool.predict_batch([torch.full((1, 3, 4, 4), CRASH)])
+
+    # The replacement serves the next request
+    assert pool.predict_batch([torch.ones(1, 3, 4, 4)])[0].label == "positive"
+    assert pool.stats()["restarts"] == 1
+
+
+def test_worker_that_never_starts_is_given_up_on():
+    failed = threading.Event()
+    pool = ProcessPoolClassifier(BrokenClassifier, transform_image=None, model_id="broken", workers=1,
+                                 health_check_interval=0.05, restart_backoff=0.2, max_failed_starts=3,
+                                 on_failed=failed.set)
+    try:
+        start = time.monotonic()
+        assert failed.wait(60)
+        # Waited 0.2s, then 0.4s between the three starts
+        assert time.monotonic() - start >= 0.6
+        assert pool.stats()["restarts"] == 2
+        assert pool.stats()["failed"]
+
+        with pytest.raises(ServiceUnavailable):
+            pool.predict_batch([torch.ones(1, 3, 4, 4)])
+        time.sleep(0.5)
+        assert pool.stats()["restarts"] == 2
+    finally:
+        pool.shutdown()
+
+
+def test_full_queue_is_rejected():
+    pool = ProcessPoolClassifier(SignClassifier, transform_image=None, model_id="sign", workers=1,
+                                 queue_size=1, queue_timeout=0.01)
+    try:
+        pool._slots.acquire()  # Occupy the only slot
+        start = time.monotonic()
+        with pytest.raises(ServiceUnavailable):
+            pool.predict_batch([torch.ones(1, 3, 4, 4)])
+        assert time.monotonic() - start < 1
+    finally:
+        pool._slots.release()
+        pool.shutdown()
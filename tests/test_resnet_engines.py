@@ -0,0 +1,36 @@
+import pytest
+import torch
+from torchvision import models
+
+from classifiers.resnet import DEFAULT_ENGINE, compile_model, to_engine_layout
+
+
+@pytest.fixture(scope="module")
+def eager_model():
+    # Same architecture family as the served ResNet-152, without downloading weights
+    torch.manual_seed(0)
+    return models.resnet18(weights=None).eval()
+
+
+@pytest.mark.parametrize("engine", [
+    {"MODE": "trace"},
+    {"MODE": "trace", "FREEZE": False},
+    {"MODE": "script"},
+    {"MODE": "trace", "CHANNELS_LAST": True},
+    {"MODE": "eager", "QUANTIZE": True},
+])
+def test_engine_mode_matches_eager(eager_model, engine):
+    engine = {**DEFAULT_ENGINE, **engine}
+    torch.manual_seed(1)
+    batch = torch.rand(2, 3, 224, 224)
+    with torch.inference_mode():
+        expected = eager_model(batch)
+        actual = compile_model(eager_model, engine)(to_engine_layout(batch, engine))
+
+    assert actual.shape == expected.shape
+    if engine["QUANTIZE"]:
+        # Only the final Linear layer is quantized, the logits stay close
+        assert torch.allclose(actual, expected, atol=0.1)
+    else:
+        assert torch.allclose(actual, expected, atol=1e-4)
+    assert torch.equal(actual.argmax(1), expected.argmax(1))
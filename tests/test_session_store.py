@@ -0,0 +1,31 @@
+import time
+
+from app.session_store import SQLiteSessionCache, load_secret_key
+
+
+def test_sessions_persist_and_expire(tmp_path):
+    store = SQLiteSessionCache(str(tmp_path / "sessions.db"), memory_entries=1)
+    store.set("a", {"USER_ID": 1}, timeout=3600)
+    store.set("b", {"USER_ID": 2}, timeout=3600)  # Pushes a out of memory
+    store.set("expired", {"USER_ID": 3}, timeout=3600)
+    store.adaptor.write(lambda cursor: cursor.execute(
+        "UPDATE sessions SET expires_at = ? WHERE session_key = 'expired'", (time.time() - 1,)))
+    store._memory.clear()
+
+    assert store.get("a") == {"USER_ID": 1}
+    assert store.get("expired") is None
+    # Refreshing an unchanged session with nearly the same expiry doesn't write
+    store.set("a", {"USER_ID": 1}, timeout=3600)
+    assert store.stats()["skipped_writes"] == 1
+
+    assert store.sweep() == 1
+    store.delete("a")
+    assert store.get("a") is None and store.get("b") == {"USER_ID": 2}
+    store.stop()
+
+
+def test_generated_secret_key_is_kept(tmp_path):
+    key = load_secret_key("", tmp_path / "secret_key")
+    assert len(key) == 64
+    assert load_secret_key(None, tmp_path / "secret_key") == key
+    assert load_secret_key("configured", tmp_path / "secret_key") == "configured"
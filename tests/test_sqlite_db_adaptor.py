@@ -0,0 +1,67 @@
+import threading
+
+import pytest
+
+from app.exceptions.service_unavailable import ServiceUnavailable
+from db.sqlite.sqlite_db_adaptor import SQLiteDBAdaptor
+
+
+def test_pooled_connections_are_reused_and_tuned(tmp_path):
+    adaptor = SQLiteDBAdaptor(db_filename=str(tmp_path / "test.db"), pool_size=2)
+    for _ in range(5):
+        with adaptor.get_connection() as conn:
+            assert conn.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+            assert conn.execute("PRAGMA foreign_keys").fetchone()[0] == 1
+
+    stats = adaptor.stats()
+    assert stats["opened"] == 1
+    assert stats["idle"] == 1 and stats["in_use"] == 0
+    adaptor.close()
+
+
+def test_exhausted_pool_is_rejected(tmp_path):
+    adaptor = SQLiteDBAdaptor(db_filename=str(tmp_path / "test.db"), pool_size=1, pool_timeout=0.01)
+    with adaptor.get_connection():
+        with pytest.raises(ServiceUnavailable):
+            with adaptor.get_connection():
+                pass
+    assert adaptor.stats()["timeouts"] == 1
+    adaptor.close()
+
+
+def test_concurrent_writers_take_turns(tmp_path):
+    adaptor = SQLiteDBAdaptor(db_filename=str(tmp_path / "test.db"), pool_size=4)
+    with adaptor.get_write_connection() as conn:
+        conn.execute("CREATE TABLE counter (value INTEGER)")
+        conn.execute("INSERT INTO counter VALUES (0)")
+
+    def increment():
+        for _ in range(20):
+            with adaptor.get_write_connection() as conn:
+                value = conn.execute("SELECT value FROM counter").fetchone()[0]
+                conn.execute("UPDATE counter SET value = ?", (value + 1,))
+
+    threads = [threading.Thread(target=increment) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    with adaptor.get_connection() as conn:
+        assert conn.execute("SELECT value FROM counter").fetchone()[0] == 80
+    adaptor.close()
+
+
+def test_nested_write_is_refused(tmp_path):
+    adaptor = SQLiteDBAdaptor(db_filename=str(tmp_path / "test.db"))
+    with adaptor.get_write_connection() as conn:
+        conn.execute("CREATE TABLE t (x INTEGER)")
+        conn.execute("INSERT INTO t VALUES (1)")
+        with pytest.raises(RuntimeError):
+            with adaptor.get_write_connection():
+                pass
+        conn.rollback()
+    # The writer is free again afterwards, and the outer block's insert never committed
+    with adaptor.get_write_connection() as conn:
+        assert conn.execute("SELECT COUNT(*) FROM t").fetchone()[0] == 0
+    adaptor.close()
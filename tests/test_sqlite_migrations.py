@@ -0,0 +1,86 @@
+import pytest
+
+from db.sqlite.chat.migrations import CHAT_MIGRATIONS
+from db.sqlite.chat.sqlite3_chat_controller import SQLite3ChatController
+from db.sqlite.image.migrations import IMAGE_MIGRATIONS
+from db.sqlite.image.sqlite3_image_controller import SQLite3ImageController
+from db.sqlite.migrations import Migration, apply_migrations, get_schema_version
+from db.types.exceptions.db_error import DBError
+from db.types.user.user_container import UserContainer
+
+
+@pytest.fixture()
+def controllers(adaptor, tmp_path):
+    chat_controller = SQLite3ChatController(adaptor, None)
+    image_controller = SQLite3ImageController(adaptor, tmp_path / "images", None)
+    apply_migrations(adaptor, adaptor.chat_table_name, CHAT_MIGRATIONS, chat_controller)
+    apply_migrations(adaptor, adaptor.image_table_name, IMAGE_MIGRATIONS, image_controller)
+    return chat_controller, image_controller
+
+
+def test_migrations_are_applied_once(adaptor, controllers):
+    _, image_controller = controllers
+    assert apply_migrations(adaptor, "images", IMAGE_MIGRATIONS, image_controller) == len(IMAGE_MIGRATIONS)
+    with adaptor.get_connection() as conn:
+        assert get_schema_version(conn.cursor(), "images") == len(IMAGE_MIGRATIONS)
+        assert get_schema_version(conn.cursor(), "chat") == len(CHAT_MIGRATIONS)
+
+
+def test_failed_migration_is_rolled_back(adaptor, controllers):
+    def broken(cursor, controller):
+        cursor.execute("CREATE TABLE half_done (id INTEGER)")
+        cursor.execute("SELECT * FROM missing_table")
+
+    with pytest.raises(DBError):
+        apply_migrations(adaptor, "broken", [Migration(1, "Broken", broken)], None)
+
+    with adaptor.get_connection() as conn:
+        assert get_schema_version(conn.cursor(), "broken") == 0
+        assert conn.execute("SELECT name FROM sqlite_master WHERE name = 'half_done'").fetchone() is None
+
+
+def _run_hot_paths(chat_controller, image_controller):
+    """The lookups made on every request or job, through the controllers themselves."""
+    user = UserContainer(1)
+    image_controller.get_current_image(user)
+    image_controller.list_images(user, 20, after=("2024-01-01 00:00:00", 10))
+    image_controller.list_images(user, 20, after=("2024-01-01 00:00:00", 10), classified_as="cat")
+    image_controller._get_image_from_db_by_hash("abc")
+    image_controller.get_image_from_id(1)
+    image_controller.claim_classification_job()
+    chat_controller.load_chat_messages(user)
+    chat_controller.load_chat_messages_page(user, 50)
+    chat_controller.load_chat_messages_page(user, 50, before=100)
+    chat_controller.load_chat_messages_page(user, 50, after=100)
+    list(chat_controller.iter_chat_messages(user))
+    chat_controller.search_chat_messages(user, "red panda", 20)
+
+
+def test_hot_queries_use_indexes(adaptor, controllers):
+    statements = []
+    open_connection = adaptor._open
+
+    def traced_open():
+        conn = open_connection()
+        # Called with each statement as run, its parameters filled in
+        conn.set_trace_callback(statements.append)
+        return conn
+
+    adaptor.close()  # Connections opened from here on are traced
+    adaptor._open = traced_open
+    _run_hot_paths(*controllers)
+    adaptor._open = open_connection
+
+    queries = [statement for statement in statements
+               if statement.lstrip().upper().startswith(("SELECT", "UPDATE", "DELETE", "WITH"))]
+    assert len(queries) >= 10
+    with adaptor.get_connection() as conn:
+        tables = {row["name"] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+        # Deleting a user cascades into the chat table through both foreign keys, SQLite runs that itself
+        queries.append("SELECT chat_id FROM chat WHERE to_id = 1")
+        for query in queries:
+            plan = [row["detail"] for row in conn.execute(f"EXPLAIN QUERY PLAN {query}")]
+            # A full scan of a real table, not of a subquery or a full-text index
+            scans = [step for step in plan
+                     if step.startswith("SCAN") and step.split()[1] in tables and "VIRTUAL TABLE" not in step]
+            assert not scans, (query, plan)
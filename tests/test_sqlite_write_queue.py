@@ -0,0 +1,50 @@
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from db.sqlite.sqlite_db_adaptor import SQLiteDBAdaptor
+
+
+@pytest.fixture()
+def queued_adaptor(tmp_path):
+    adaptor = SQLiteDBAdaptor(db_filename=str(tmp_path / "test.db"), pool_size=2,
+                              write_queue={"MAX_BATCH_SIZE": 16, "MAX_WAIT_MS": 50})
+    adaptor.write(lambda cursor: cursor.execute("CREATE TABLE notes (id INTEGER PRIMARY KEY, body TEXT UNIQUE)"))
+    yield adaptor
+    adaptor.close()
+
+
+def insert(body):
+    def operation(cursor):
+        cursor.execute("INSERT INTO notes (body) VALUES (?)", (body,))
+        return cursor.lastrowid
+    return operation
+
+
+def test_concurrent_writes_share_a_commit(queued_adaptor):
+    with ThreadPoolExecutor(8) as executor:
+        row_ids = list(executor.map(lambda i: queued_adaptor.write(insert(f"note {i}")), range(16)))
+
+    assert sorted(row_ids) == list(range(1, 17))
+    stats = queued_adaptor.stats()
+    assert stats["write_items"] == 17
+    assert stats["write_batches"] < 17
+
+
+def test_failed_write_only_rolls_itself_back(queued_adaptor):
+    futures = [queued_adaptor.submit_write(insert("first")),
+               queued_adaptor.submit_write(insert("first")),
+               queued_adaptor.submit_write(insert("second"), durable=True)]
+
+    assert futures[0].result() == 1
+    with pytest.raises(sqlite3.IntegrityError):
+        futures[1].result()
+    assert futures[2].result() == 2
+
+    with queued_adaptor.get_connection() as conn:
+        assert [row["body"] for row in conn.execute("SELECT body FROM notes ORDER BY id")] == ["first", "second"]
+    with queued_adaptor.get_write_connection() as conn:
+        # Back to NORMAL once the durable write is committed
+        assert conn.execute("PRAGMA synchronous").fetchone()[0] == 1
+    assert queued_adaptor.stats()["durable_commits"] == 1